@@ -321,9 +321,10 @@ def postProcessSlice(im, ms, globalArgs={}):
         result[i+1] = blendedColor.y;
         result[i+2] = blendedColor.z;
     }
-    """ % (width, height, colors, ms, startMs, distanceToMove, cycleMinMs, cycleMaxMs)
+    """ % (width, height, colors, ms, startMs, distanceToMove * getValue(globalArgs, "previewScale", 1.0), cycleMinMs, cycleMaxMs)
 
-    ctx, prg = loadGPUProgram(srcCode)
+    # the source changes every frame, so don't keep the compiled program
+    ctx, prg = loadGPUProgram(srcCode, cache=False)
     # Create queue for each kernel execution
     queue = cl.CommandQueue(ctx)
     mf = cl.mem_flags
@@ -2,6 +2,7 @@ from lib.audio_utils import *
 from lib.collection_utils import *
 from lib.io_utils import *
 from lib.math_utils import *
+from lib.trace_utils import *
 import os
 from pydub import AudioSegment
 import sys
@@ -33,7 +34,7 @@ def makeTrack(duration, instructions, segments, sfx=True, sampleWidth=4, sampleR
         sys.stdout.flush()
     return baseAudio
 
-def mixAudio(instructions, duration, outfilename, sfx=True, sampleWidth=4, sampleRate=48000, channels=2, fxPad=3000, masterDb=0.0, outputTracks=False, tracksDir="output/tracks/%s.wav"):
+def mixAudio(instructions, duration, outfilename, sfx=True, sampleWidth=4, sampleRate=48000, channels=2, fxPad=3000, masterDb=0.0, outputTracks=False, tracksDir="output/tracks/%s.wav", tracer=None):
     # remove instructions with no volume
     instructions = [i for i in instructions if "volume" not in i or i["volume"] > 0]
     audioFiles = list(set([i["filename"] for i in instructions]))
@@ -58,7 +59,8 @@ def mixAudio(instructions, duration, outfilename, sfx=True, sampleWidth=4, sampl
         audioFiles[i]["index"] = i
 
         # load audio file
-        audio = getAudio(filename, sampleWidth, sampleRate, channels)
+        with traceSpan(tracer, "load audio", file=os.path.basename(filename)):
+            audio = getAudio(filename, sampleWidth, sampleRate, channels)
         audioDurationMs = len(audio)
 
         # look through instructions to find unique clips
@@ -81,8 +83,9 @@ def mixAudio(instructions, duration, outfilename, sfx=True, sampleWidth=4, sampl
         # make the track
         trackInstructions = [ii for ii in instructions if ii["filename"]==af["filename"]]
         print("Making track %s of %s with %s segments and %s instructions..." % (i+1, trackCount, len(segments), len(trackInstructions)))
-        trackAudio = makeTrack(duration, trackInstructions, segments, sfx=sfx, sampleWidth=sampleWidth, sampleRate=sampleRate, channels=channels, fxPad=fxPad)
-        baseAudio = baseAudio.overlay(trackAudio)
+        with traceSpan(tracer, "make track", file=os.path.basename(filename), segments=len(segments), instructions=len(trackInstructions)):
+            trackAudio = makeTrack(duration, trackInstructions, segments, sfx=sfx, sampleWidth=sampleWidth, sampleRate=sampleRate, channels=channels, fxPad=fxPad)
+            baseAudio = baseAudio.overlay(trackAudio)
         if outputTracks:
             trackfilename = tracksDir % getBasename(filename)
             format = trackfilename.split(".")[-1]
@@ -98,7 +101,8 @@ def mixAudio(instructions, duration, outfilename, sfx=True, sampleWidth=4, sampl
     # adjust master volume
     if masterDb != 0.0:
         baseAudio = baseAudio.apply_gain(masterDb)
-    f = baseAudio.export(outfilename, format=format)
+    with traceSpan(tracer, "export audio"):
+        f = baseAudio.export(outfilename, format=format)
     print("Wrote to %s" % outfilename)
 
 def plotAudioSequence(seq):
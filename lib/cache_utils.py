@@ -1,10 +1,14 @@
 # Reference: https://stackoverflow.com/questions/9619199/best-way-to-preserve-numpy-arrays-on-disk
 
 import bz2
+from collections import OrderedDict
 from lib.io_utils import *
 from lib.math_utils import *
+import multiprocessing
+import numpy as np
 import os
 import pickle
+import threading
 
 def loadCacheFile(fn, compressed=True):
     loaded = False
@@ -40,3 +44,193 @@ def saveCacheFile(fn, data, overwrite=False, compressed=True):
     else:
         print("Already exists %s" % fn)
     return True
+
+# uncompressed per-video frame cache: a raw pixel blob (.bin) that is memory-mapped for reading, plus an append-only index (.idx) of
+# [ms, offset, height, width, colors] records; re-extracted frames are appended and the later record wins, so nothing is rewritten
+class FrameCache:
+
+    recordSize = 5
+
+    def __init__(self, fn=None, bufferSize=-1):
+        self.fn = fn
+        self.bufferSize = bufferSize # bytes of pixels to buffer before writing to disk; -1 for python's default
+        self.dataFn = fn + ".bin" if fn else None
+        self.indexFn = fn + ".idx" if fn else None
+        self.times = []
+        self.records = []
+        self.slots = {} # ms => index into times/records
+        self.memoryFrames = []
+        self.data = None
+        self.dataSize = 0
+        self.dataFile = None
+        self.indexFile = None
+        self.load()
+
+    def __contains__(self, t):
+        return t in self.slots
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, t, pixels):
+        pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+        h, w, c = pixels.shape
+        offset = len(self.memoryFrames)
+
+        # no file; just keep the frames in memory
+        if self.fn is None:
+            self.memoryFrames.append(pixels)
+
+        else:
+            if self.dataFile is None:
+                self.dataFile = open(self.dataFn, "ab", buffering=self.bufferSize)
+                self.indexFile = open(self.indexFn, "ab")
+            offset = self.dataSize
+            # write the pixels before the record so a partial write never points at missing data
+            self.dataFile.write(pixels.tobytes())
+            self.indexFile.write(np.array([t, offset, h, w, c], dtype=np.int64).tobytes())
+            self.dataSize += pixels.size
+
+        self.setRecord(t, [offset, h, w, c])
+
+    def close(self):
+        self.flush()
+        if self.dataFile is not None:
+            self.dataFile.close()
+            self.indexFile.close()
+            self.dataFile = None
+            self.indexFile = None
+        self.data = None
+
+    def exists(self):
+        return self.fn is not None and os.path.isfile(self.dataFn) and os.path.isfile(self.indexFn)
+
+    def flush(self):
+        if self.dataFile is not None:
+            self.dataFile.flush()
+            self.indexFile.flush()
+
+    def getFrame(self, index):
+        offset, h, w, c = self.records[index]
+        if self.fn is None:
+            return self.memoryFrames[offset]
+
+        # (re)map the file if frames have been appended since it was last mapped
+        size = h * w * c
+        if self.data is None or len(self.data) < (offset + size):
+            self.flush()
+            self.data = np.memmap(self.dataFn, dtype=np.uint8, mode="r")
+        return self.data[offset:offset+size].reshape(h, w, c)
+
+    def getIndex(self, t):
+        return self.slots.get(t, None)
+
+    def getShape(self, index):
+        offset, h, w, c = self.records[index]
+        return (h, w, c)
+
+    def load(self):
+        if not self.exists():
+            return False
+
+        print("Loading frame cache %s..." % self.fn)
+        records = np.fromfile(self.indexFn, dtype=np.int64)
+        # ignore a partially written trailing record
+        recordCount = int(len(records) / self.recordSize)
+        records = records[:recordCount*self.recordSize].reshape(-1, self.recordSize)
+        dataSize = os.path.getsize(self.dataFn)
+        for t, offset, h, w, c in records.tolist():
+            if (offset + h * w * c) > dataSize:
+                print("Warning: frame cache %s is truncated; ignoring frames from %s ms" % (self.fn, t))
+                break
+            self.setRecord(t, [offset, h, w, c])
+        self.dataSize = dataSize
+        print("Loaded %s frames from %s" % (len(self.times), self.fn))
+        return len(self.times) > 0
+
+    # one-shot conversion from a bz2-pickled (clipTimes, clipPixels) cache file
+    def migrate(self, legacyFn):
+        loaded, legacyData = loadCacheFile(legacyFn)
+        if not loaded:
+            return False
+        print("Migrating %s to %s..." % (legacyFn, self.fn))
+        clipTimes, clipPixels = legacyData
+        for t, pixels in zip(clipTimes, clipPixels):
+            self.append(t, pixels)
+        self.flush()
+        print("Migrated %s frames" % len(clipTimes))
+        return True
+
+    def setRecord(self, t, record):
+        index = self.getIndex(t)
+        if index is not None:
+            self.records[index] = record
+        else:
+            self.slots[t] = len(self.times)
+            self.times.append(t)
+            self.records.append(record)
+
+# least-recently-used cache of clip frames that have already been rotated, blurred, and resized for drawing,
+# keyed by (frame, rotation, blur, width, height) and limited to maxBytes of pixels;
+# threads share one cache, and each process gets its own empty copy (with the same hit/miss counters) when it's pickled
+class EffectCache:
+
+    def __init__(self, maxBytes, rotationStep=0.0, blurStep=0.0):
+        self.maxBytes = maxBytes
+        self.rotationStep = rotationStep
+        self.blurStep = blurStep
+        self.hits = multiprocessing.Value('l', 0)
+        self.misses = multiprocessing.Value('l', 0)
+        self.reset()
+
+    def __getstate__(self):
+        return (self.maxBytes, self.rotationStep, self.blurStep, self.hits, self.misses)
+
+    def __setstate__(self, state):
+        self.maxBytes, self.rotationStep, self.blurStep, self.hits, self.misses = state
+        self.reset()
+
+    def addCount(self, counter):
+        with counter.get_lock():
+            counter.value += 1
+
+    def get(self, key):
+        with self.lock:
+            pixels = self.items.get(key, None)
+            if pixels is not None:
+                self.items.move_to_end(key)
+        self.addCount(self.hits if pixels is not None else self.misses)
+        return pixels
+
+    def put(self, key, pixels):
+        if pixels.nbytes > self.maxBytes:
+            return
+        # the cached pixels are shared by every frame that uses them
+        pixels.setflags(write=False)
+        with self.lock:
+            if key in self.items:
+                return
+            self.items[key] = pixels
+            self.size += pixels.nbytes
+            while self.size > self.maxBytes:
+                _key, evicted = self.items.popitem(last=False)
+                self.size -= evicted.nbytes
+
+    # snap rotation and blur to steps so nearby values share cached frames
+    def quantize(self, rotation, blur):
+        if self.rotationStep > 0.0:
+            rotation = round(rotation / self.rotationStep) * self.rotationStep
+        if self.blurStep > 0.0:
+            blur = round(blur / self.blurStep) * self.blurStep
+        return (rotation, blur)
+
+    def printStats(self):
+        hits = self.hits.value
+        total = hits + self.misses.value
+        if total > 0:
+            print("Effect cache: %s hits, %s misses (%s%% hit rate)" % (formatNumber(hits), formatNumber(total - hits), round(100.0 * hits / total, 1)))
+
+    def reset(self):
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
@@ -1,3 +1,4 @@
+from bisect import bisect_left, bisect_right
 from multiprocessing import Pool
 from multiprocessing.dummy import Pool as ThreadPool
 
@@ -29,6 +30,8 @@ class Vector:
         self.pos = [0.0, 0.0, 0.0]
         self.size = [100.0, 100.0]
         self.keyframes = []
+        # sorted keyframes per property; only valid once sortFrames() has run
+        self.tracks = None
 
         # for caching
         self.cache = defaults["cache"]
@@ -68,6 +71,7 @@ class Vector:
             keyframe.update({"name": "pos", "dimension": 1})
 
         self.keyframes.append(keyframe)
+        self.tracks = None
         if sortFrames:
             self.sortFrames()
 
@@ -133,8 +137,15 @@ class Vector:
         if ms is None:
             return value
 
+        # binary search the sorted keyframes for this property
+        if self.tracks is not None:
+            value = self.getTrackValue(self.getKeyframeTrack(name, dimension), ms, value)
+            if self.cache:
+                self.cacheProps[nameKey] = value
+            return value
+
         # retrieve keyframes for this property
-        keyframes = [k for k in self.keyframes if k["name"]==name and (k["dimension"]==dimension or k["dimension"] is None or dimension is None)]
+        keyframes = self.getKeyframes(name, dimension)
         kcount = len(keyframes)
 
         # assuming keyframes are sorted
@@ -163,6 +174,21 @@ class Vector:
 
         return value
 
+    def getKeyframes(self, name, dimension=None):
+        return [k for k in self.keyframes if k["name"]==name and (k["dimension"]==dimension or k["dimension"] is None or dimension is None)]
+
+    def getKeyframeTrack(self, name, dimension=None):
+        nameKey = (name, dimension)
+        if nameKey not in self.tracks:
+            keyframes = self.getKeyframes(name, dimension)
+            self.tracks[nameKey] = {
+                "ms": [k["ms"] for k in keyframes],
+                "values": [k["value"] for k in keyframes],
+                "easings": [k["easing"] for k in keyframes],
+                "cursor": 0
+            }
+        return self.tracks[nameKey]
+
     def getProps(self):
         return self.getPropsAtTime(None)
 
@@ -179,6 +205,33 @@ class Vector:
         }
         return props
 
+    # same result as the linear search in getPropValue, for a sorted track
+    def getTrackValue(self, track, ms, defaultValue):
+        kms = track["ms"]
+        kcount = len(kms)
+        if kcount <= 0:
+            return defaultValue
+
+        # index of the first keyframe after ms; frames are usually rendered in order, so try where the last lookup landed first
+        i = track["cursor"]
+        if (i <= 0 or kms[i-1] <= ms) and (i >= kcount or kms[i] > ms):
+            pass
+        elif i < kcount and kms[i] <= ms and (i+1 >= kcount or kms[i+1] > ms):
+            i += 1
+        else:
+            i = bisect_right(kms, ms)
+        track["cursor"] = i
+
+        values = track["values"]
+        # we're after the last frame, just take the last frame's value
+        if i >= kcount:
+            return values[-1]
+        # we're before the first keyframe, just take the first keyframe value
+        if i <= 0:
+            return values[0]
+        # lerp between the current and previous keyframe
+        return lerpEase((values[i-1], values[i]), norm(ms, (kms[i-1], kms[i])), track["easings"][i])
+
     def getRotation(self, ms=None):
         return self.getPropValue("rotation", ms=ms)
 
@@ -288,6 +341,7 @@ class Vector:
 
     def sortFrames(self):
         self.keyframes = sorted(self.keyframes, key=lambda k: k["ms"])
+        self.tracks = {}
 
     def toDict(self, ms):
         return {
@@ -325,6 +379,7 @@ class Clip:
         self.start = defaults["start"]
         self.dur = defaults["dur"]
         self.plays = defaults["plays"]
+        self.playIndex = None
         self.initialOffset = defaults["initialOffset"]
 
         if self.dur <= 0 and self.filename is not None:
@@ -341,18 +396,16 @@ class Clip:
         if ms is None:
             return 0.0
 
-        plays = [t for t in self.plays if t[0] <= ms <= t[1]]
         time = 0.0
         start = self.initialOffset
+        activePlay, closestPlay = self.getPlaysAtTime(ms)
 
         # check if we are playing this clip at this time
-        if len(plays) > 0:
-            start, end, params = plays[0]
+        if activePlay is not None:
+            start, end, params = activePlay
 
         # otherwise, find the closest play
-        elif len(self.plays) > 0:
-            plays = sorted(self.plays, key=lambda p: abs(ms - lerp((p[0], p[1]), 0.5)))
-            closestPlay = plays[0]
+        elif closestPlay is not None:
             start, end, params =  closestPlay
 
             # assumes plays are sorted
@@ -412,12 +465,38 @@ class Clip:
 
         return neighbors
 
+    # returns the first play that contains ms, or if there isn't one, the play whose middle is closest to ms
+    def getPlaysAtTime(self, ms):
+        if len(self.plays) <= 0:
+            return (None, None)
+
+        playIndex = self.getPlayIndex()
+
+        # plays aren't sorted, so check them all
+        if playIndex is None:
+            plays = [t for t in self.plays if t[0] <= ms <= t[1]]
+            if len(plays) > 0:
+                return (plays[0], None)
+            plays = sorted(self.plays, key=lambda p: abs(ms - lerp((p[0], p[1]), 0.5)))
+            return (None, plays[0])
+
+        i = findActivePlay(playIndex, ms)
+        if i is not None:
+            return (self.plays[i], None)
+        return (None, self.plays[findClosestPlay(playIndex, ms)])
+
+    def getPlayIndex(self):
+        if self.playIndex is None or self.playIndex["count"] != len(self.plays):
+            self.playIndex = getPlayIndex(self.plays)
+        return self.playIndex if self.playIndex["isSorted"] else None
+
     def getState(self, name):
         return self.state[name] if name in self.state else None
 
     def queuePlay(self, ms, params={}):
         dur = params["dur"] if "dur" in params else self.dur
         self.plays.append((ms, ms+dur, params))
+        self.playIndex = None
 
     def queueTween(self, ms, dur="auto", tweens=[], sortFrames=False):
         if isinstance(tweens, tuple):
@@ -456,6 +535,7 @@ class Clip:
 
     def sortPlays(self):
         self.plays = sorted(self.plays, key=lambda p: p[0])
+        self.playIndex = None
 
     def toDict(self, ms=None, containerW=None, containerH=None, parent=None, customProps=None):
         props = self.props.copy()
@@ -513,6 +593,10 @@ def clipsToNpArr(clips, ms=None, containerW=None, containerH=None, precision=3,
     # startTime = logTime()
     parentProps = clips[0].vector.parent.toDict(ms) if len(clips) > 0 and clips[0].vector.parent is not None else None
     clipCount = len(clips)
+    # evaluate all the clips at once if they were compiled into a batch (see lib/clip_batch.py)
+    clipBatch = getValue(globalArgs, "clipBatch", None)
+    if customClipToArrFunction is None and clipBatch is not None and clipBatch.clipCount == clipCount and ms is not None:
+        return clipBatch.toNpArr(ms, containerW, containerH, precision, parentProps)
     propertyCount = Clip.npPropertyCount()
     arr = np.zeros((clipCount, propertyCount), dtype=np.int32)
     for i, clip in enumerate(clips):
@@ -565,6 +649,48 @@ def filterClips(clips, filters):
     indices = set([c["index"] for c in clipProps])
     return [c for i, c in enumerate(clips) if i in indices]
 
+# the index of the first play in playIndex that contains ms, or None
+def findActivePlay(playIndex, ms):
+    # plays are sorted by start, so the first one whose end (or any earlier play's end) reaches ms is the first one that contains it,
+    # as long as it has started
+    startedCount = bisect_right(playIndex["starts"], ms)
+    i = bisect_left(playIndex["maxEnds"], ms)
+    return i if i < startedCount else None
+
+# the index of the play in playIndex whose middle is closest to ms; ties go to the earlier play
+def findClosestPlay(playIndex, ms):
+    mids = playIndex["sortedMids"]
+    order = playIndex["midOrder"]
+    count = len(mids)
+    k = bisect_left(mids, ms)
+    # the closest middle is either the last one before ms or the first one at or after it;
+    # plays with the same middle are ordered by index, so take the first of each
+    candidates = []
+    if k > 0:
+        candidates.append((abs(ms - mids[k-1]), order[bisect_left(mids, mids[k-1])]))
+    if k < count:
+        candidates.append((abs(ms - mids[k]), order[k]))
+    return min(candidates)[1]
+
+# plays as sorted arrays so the active and closest play can be found with a binary search;
+# only usable if the plays are sorted by start (e.g. after Clip.sortPlays)
+def getPlayIndex(plays):
+    starts = [p[0] for p in plays]
+    isSorted = all(starts[i] <= starts[i+1] for i in range(len(starts)-1))
+    maxEnds = []
+    for p in plays:
+        maxEnds.append(p[1] if len(maxEnds) <= 0 else max(maxEnds[-1], p[1]))
+    mids = [lerp((p[0], p[1]), 0.5) for p in plays]
+    midOrder = sorted(range(len(plays)), key=lambda i: (mids[i], i))
+    return {
+        "count": len(plays),
+        "isSorted": isSorted,
+        "starts": starts,
+        "maxEnds": maxEnds,
+        "sortedMids": [mids[i] for i in midOrder],
+        "midOrder": midOrder
+    }
+
 def getClipFadeDur(clipDur, percentage=0.1, maxDur=100):
     dur = roundInt(clipDur * percentage)
     if maxDur > 0:
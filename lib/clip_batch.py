@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+import numbers
+import numpy as np
+from pprint import pprint
+import sys
+
+from lib.clip import *
+from lib.math_utils import *
+
+# the vector properties a clip's array row is calculated from, as (name, dimension) like Vector.getPropValue takes them
+BATCH_TRACKS = [("pos", 0), ("pos", 1), ("size", 0), ("size", 1), ("scale", 0), ("scale", 1), ("translate", 0), ("translate", 1), ("alpha", None), ("rotation", None), ("blur", None), ("brightness", None)]
+
+# one property's keyframes for every clip, padded into (clips, keyframes) arrays;
+# keyframes stay in the order they were added so lookups match Vector.getPropValue even if they were never sorted
+class KeyframeTrack:
+
+    def __init__(self, baseValues, keyframeLists):
+        self.base = np.array(baseValues, dtype=np.float64)
+        counts = np.array([len(keyframes) for keyframes in keyframeLists], dtype=np.int64)
+        # only clips that have keyframes for this property need to be looked at per frame
+        self.rows = np.nonzero(counts > 0)[0]
+        rowCount = len(self.rows)
+        maxCount = int(np.max(counts)) if len(counts) > 0 else 0
+        self.lastIndices = counts[self.rows] - 1
+        self.ms = np.full((rowCount, maxCount), -np.inf, dtype=np.float64)
+        self.values = np.zeros((rowCount, maxCount), dtype=np.float64)
+        self.easings = np.zeros((rowCount, maxCount), dtype=np.int32)
+        self.easingNames = []
+        easingLookup = {}
+        for i, row in enumerate(self.rows):
+            for j, kf in enumerate(keyframeLists[row]):
+                easing = kf["easing"]
+                if easing not in easingLookup:
+                    easingLookup[easing] = len(self.easingNames)
+                    self.easingNames.append(easing)
+                self.ms[i, j] = kf["ms"]
+                self.values[i, j] = kf["value"]
+                self.easings[i, j] = easingLookup[easing]
+
+    def getValues(self, ms):
+        values = self.base.copy()
+        rowCount = len(self.rows)
+        if rowCount <= 0:
+            return values
+
+        # the first keyframe after ms; if there isn't one, take the last keyframe's value
+        after = self.ms > ms
+        hasAfter = np.any(after, axis=1)
+        indices = np.where(hasAfter, np.argmax(after, axis=1), self.lastIndices)
+        rowIndices = np.arange(rowCount)
+        rowValues = self.values[rowIndices, indices]
+
+        # lerp between the previous keyframe and the next one, unless we're before the first keyframe
+        lerped = hasAfter & (indices > 0)
+        if np.any(lerped):
+            r = rowIndices[lerped]
+            j = indices[lerped]
+            fromMs = self.ms[r, j-1]
+            toMs = self.ms[r, j]
+            fromValues = self.values[r, j-1]
+            toValues = self.values[r, j]
+            span = toMs - fromMs
+            amounts = np.zeros(len(r), dtype=np.float64)
+            nonzero = span != 0
+            amounts[nonzero] = 1.0 * (ms - fromMs[nonzero]) / span[nonzero]
+            easings = self.easings[r, j]
+            for easingIndex in np.unique(easings):
+                easing = self.easingNames[easingIndex]
+                if easing == "linear":
+                    continue
+                mask = easings == easingIndex
+                amounts[mask] = easeArray(amounts[mask], easing)
+            rowValues[lerped] = (toValues - fromValues) * amounts + fromValues
+
+        values[self.rows] = rowValues
+        return values
+
+# all of the clips' keyframes, plays, and transform origins compiled into arrays once,
+# so the rows clipsToNpArr returns can be calculated for every clip at once instead of clip by clip;
+# the results are the same as Clip.toNpArr for clips without a custom clip-to-array function
+class ClipBatch:
+
+    def __init__(self, clips):
+        self.clipCount = len(clips)
+        self.indices = np.array([clip.props["index"] for clip in clips], dtype=np.int64)
+        vectors = [clip.vector for clip in clips]
+
+        self.tracks = {}
+        for name, dimension in BATCH_TRACKS:
+            baseValues = []
+            keyframeLists = []
+            for v in vectors:
+                value = getattr(v, name)
+                baseValues.append(value if dimension is None else value[dimension])
+                keyframeLists.append(v.getKeyframes(name, dimension))
+            self.tracks[(name, dimension)] = KeyframeTrack(baseValues, keyframeLists)
+
+        self.origins = np.array([[v.origin[0], v.origin[1]] for v in vectors], dtype=np.float64).reshape(-1, 2)
+        self.transformOrigins = np.array([[v.transformOrigin[0], v.transformOrigin[1]] for v in vectors], dtype=np.float64).reshape(-1, 2)
+
+        self.starts = np.array([clip.start for clip in clips], dtype=np.float64)
+        self.durs = np.array([clip.dur for clip in clips], dtype=np.float64)
+        self.loopDurs = np.array([int(clip.dur*2) for clip in clips], dtype=np.float64)
+        self.initialOffsets = np.array([clip.initialOffset for clip in clips], dtype=np.float64)
+        self.zindices = np.array([roundInt(clip.props["zindex"] if "zindex" in clip.props else clip.props["index"]+1) for clip in clips], dtype=np.int64)
+
+        # every clip's play index (see getPlayIndex in lib/clip.py) concatenated into flat arrays
+        playIndices = [clip.getPlayIndex() for clip in clips]
+        self.playCounts = np.array([len(clip.plays) for clip in clips], dtype=np.int64)
+        self.playOffsets = np.zeros(self.clipCount, dtype=np.int64)
+        if self.clipCount > 1:
+            self.playOffsets[1:] = np.cumsum(self.playCounts)[:-1]
+        self.playStarts = np.array([start for index in playIndices for start in index["starts"]], dtype=np.float64)
+        self.playMaxEnds = np.array([end for index in playIndices for end in index["maxEnds"]], dtype=np.float64)
+        self.playSortedMids = np.array([mid for index in playIndices for mid in index["sortedMids"]], dtype=np.float64)
+        self.playMidOrder = np.array([i for index in playIndices for i in index["midOrder"]], dtype=np.int64)
+        self.firstPlayStarts = np.array([clip.plays[0][0] if len(clip.plays) > 0 else 0 for clip in clips], dtype=np.float64)
+        self.lastPlayEnds = np.array([clip.plays[-1][1] if len(clip.plays) > 0 else 0 for clip in clips], dtype=np.float64)
+
+    # a batch only reproduces what clipsToNpArr would do if the clips share the first clip's parent (or have none),
+    # all of their keyframe values are plain numbers, and their plays are sorted
+    @staticmethod
+    def canBatch(clips):
+        if len(clips) <= 0:
+            return False
+        if clips[0].vector.parent is None and any(clip.vector.parent is not None for clip in clips):
+            return False
+        trackNames = set([name for name, dimension in BATCH_TRACKS])
+        for clip in clips:
+            if len(clip.plays) > 0 and clip.getPlayIndex() is None:
+                return False
+            for k in clip.vector.keyframes:
+                if k["name"] in trackNames and not isinstance(k["value"], numbers.Number):
+                    return False
+        return True
+
+    def getClipTimes(self, ms):
+        start = self.initialOffsets.copy()
+        if len(self.playStarts) > 0:
+            offsets = self.playOffsets
+            counts = self.playCounts
+            # same as findActivePlay, for every clip at once
+            startedCounts = bisectRows(self.playStarts, offsets, counts, ms, right=True)
+            activeIndices = bisectRows(self.playMaxEnds, offsets, counts, ms)
+            isPlaying = activeIndices < startedCounts
+            playingStarts = takeRows(self.playStarts, offsets, activeIndices)
+
+            # same as findClosestPlay, for every clip at once
+            k = bisectRows(self.playSortedMids, offsets, counts, ms)
+            hasLeft = k > 0
+            hasRight = k < counts
+            leftMids = takeRows(self.playSortedMids, offsets, k-1)
+            rightMids = takeRows(self.playSortedMids, offsets, k)
+            leftIndices = takeRows(self.playMidOrder, offsets, bisectRows(self.playSortedMids, offsets, counts, leftMids))
+            rightIndices = takeRows(self.playMidOrder, offsets, k)
+            leftDistances = np.abs(ms - leftMids)
+            rightDistances = np.abs(ms - rightMids)
+            useLeft = hasLeft & (~hasRight | (leftDistances < rightDistances) | ((leftDistances == rightDistances) & (leftIndices < rightIndices)))
+            closestStarts = takeRows(self.playStarts, offsets, np.where(useLeft, leftIndices, rightIndices))
+
+            # use the closest play unless we are before the first play or after the last one
+            useClosest = (counts > 0) & ~isPlaying & ~((ms < self.firstPlayStarts) | (ms > self.lastPlayEnds))
+            start = np.where(isPlaying, playingStarts, np.where(useClosest, closestStarts, start))
+
+        # play forward and backward
+        remainder = np.mod(ms - start, self.loopDurs)
+        backward = remainder > self.durs
+        remainder = np.where(backward, self.durs - (remainder - self.durs) - 1, remainder)
+        remainder = np.maximum(0, np.minimum(self.durs - 1, remainder))
+        return np.round(self.starts + remainder)
+
+    def getProps(self, ms, parent=None):
+        props = {}
+        values = dict([(key, self.tracks[key].getValues(ms)) for key in self.tracks])
+        for i, key in enumerate(["x", "y"]):
+            length = values[("size", i)]
+            d = values[("pos", i)] - length * self.origins[:, i]
+            tlength = length * values[("scale", i)]
+            d = d - (tlength - length) * self.transformOrigins[:, i]
+            d = d + values[("translate", i)]
+            if parent is not None:
+                d = parent["size"][i] * (1.0 * d / parent["baseSize"][i]) + parent["pos"][i]
+            props[key] = d
+        for i, key in enumerate(["width", "height"]):
+            d = values[("size", i)] * values[("scale", i)]
+            if parent is not None:
+                d = d * parent["scale"][i]
+            props[key] = d
+        for key in ["alpha", "rotation", "blur", "brightness"]:
+            props[key] = values[(key, None)]
+
+        t = self.getClipTimes(ms)
+        span = (self.starts + self.durs) - self.starts
+        tn = np.zeros(self.clipCount, dtype=np.float64)
+        nonzero = span != 0
+        tn[nonzero] = 1.0 * (t[nonzero] - self.starts[nonzero]) / span[nonzero]
+        props["t"] = t
+        props["tn"] = np.maximum(0, np.minimum(1, tn))
+        return props
+
+    def toNpArr(self, ms, containerW=None, containerH=None, precision=3, parent=None):
+        precisionMultiplier = int(10 ** precision)
+        props = self.getProps(ms, parent)
+
+        # update properties if not visible
+        if containerW is not None and containerH is not None:
+            isVisible = (props["x"]+props["width"] > 0) & (props["y"]+props["height"] > 0) & (props["x"] < containerW) & (props["y"] < containerH) & (props["alpha"] > 0)
+            for key in ["x", "y", "width", "height", "alpha"]:
+                props[key] = np.where(isVisible, props[key], 0)
+
+        arr = np.zeros((self.clipCount, Clip.npPropertyCount()), dtype=np.int32)
+        rows = np.zeros((self.clipCount, Clip.npPropertyCount()), dtype=np.int64)
+        for i, p in enumerate(Clip.npProperties):
+            pkey, ptype = p
+            if pkey == "zindex":
+                rows[:, i] = self.zindices
+            else:
+                rows[:, i] = np.round(props[pkey] * precisionMultiplier)
+        arr[self.indices] = rows
+        return arr
+
+# bisect_left (or bisect_right) of each target in its own row of a flat array of sorted rows;
+# targets can be one value for all rows or one per row
+def bisectRows(values, offsets, counts, targets, right=False):
+    targets = np.broadcast_to(targets, counts.shape)
+    lo = np.zeros(len(counts), dtype=np.int64)
+    hi = counts.copy()
+    lastIndex = max(0, len(values)-1)
+    while True:
+        active = lo < hi
+        if not np.any(active):
+            break
+        mid = (lo + hi) // 2
+        midValues = values[np.minimum(offsets + mid, lastIndex)]
+        isBefore = midValues <= targets if right else midValues < targets
+        lo = np.where(active & isBefore, mid + 1, lo)
+        hi = np.where(active & ~isBefore, mid, hi)
+    return lo
+
+# the value at index i of each row of a flat array; indices outside a row return whatever is nearby, so mask them out afterwards
+def takeRows(values, offsets, indices):
+    return values[np.clip(offsets + indices, 0, max(0, len(values)-1))]
+
+# adds a compiled batch of the clips to a copy of globalArgs so clipsToNpArr can use it
+def addClipBatch(clips, globalArgs={}):
+    if "clipBatch" in globalArgs or not ClipBatch.canBatch(clips):
+        return globalArgs
+    globalArgs = globalArgs.copy()
+    globalArgs["clipBatch"] = ClipBatch(clips)
+    return globalArgs
@@ -2,7 +2,39 @@ import colorsys
 from lib.math_utils import *
 import numpy as np
 
+# how many steps between 0 and 1 the lookup tables have for eased values
+COLOR_LUT_SIZE = 65536
+
+# gradients and lookup tables are only built once per process
+colorGradients = {}
+colorGradientLUTs = {}
+
 def getColorGradient(name="inferno", multiply=255, toInt=True):
+    key = (name, multiply, toInt)
+    if key not in colorGradients:
+        colorGradients[key] = loadColorGradient(name, multiply, toInt)
+    return colorGradients[key].copy()
+
+# a uint8 color for each of COLOR_LUT_SIZE evenly spaced values from 0 to 1, with the easing already applied;
+# with no easing, the gradient itself is the lookup table
+def getColorGradientLUT(name="inferno", easingFunction="linear"):
+    key = (name, easingFunction)
+    if key not in colorGradientLUTs:
+        cdata = getColorGradient(name=name)
+        if easingFunction == "linear":
+            lut = cdata
+        else:
+            nvalues = easeArray(np.linspace(0.0, 1.0, COLOR_LUT_SIZE), easingFunction)
+            lut = np.take(cdata, getColorGradientIndices(nvalues, len(cdata)), axis=0, mode="clip")
+        colorGradientLUTs[key] = lut
+    return colorGradientLUTs[key]
+
+def getColorGradientIndices(nvalues, count):
+    # NaNs become out of range indices, which are clipped when they're looked up
+    with np.errstate(invalid="ignore"):
+        return np.rint(nvalues * (count-1)).astype(np.intp)
+
+def loadColorGradient(name="inferno", multiply=255, toInt=True):
     data = []
     if name == "magma":
         data = [[0.001462, 0.000466, 0.013866],
@@ -1809,29 +1841,15 @@ def getColorGradient(name="inferno", multiply=255, toInt=True):
         data = data.astype(np.uint8)
     return data
 
+# values outside of 0 to 1 get the colors at the ends of the gradient (and NaNs the first color)
 def getColorGradientMatrix(nvalues, name="inferno", easingFunction="linear"):
-    h, w = nvalues.shape
-    cdata = getColorGradient(name=name)
-    clen = len(cdata)
-
-    newShape = (h, w, 3)
-    newValues = np.zeros(newShape, dtype=np.uint8)
-
-    for y in range(h):
-        for x in range(w):
-            nvalue = nvalues[y, x]
-            if easingFunction != "linear":
-                nvalue = ease(nvalue, easingFunction)
-            cindex = roundInt(nvalue * (clen-1))
-            color = tuple(cdata[cindex])
-            newValues[y, x] = color
-
-    return newValues
+    lut = getColorGradientLUT(name, easingFunction)
+    return np.take(lut, getColorGradientIndices(np.asarray(nvalues), len(lut)), axis=0, mode="clip")
 
 def getColorGradientValue(nvalue, name="inferno", easingFunction="linear"):
     if easingFunction != "linear":
         nvalue = ease(nvalue, easingFunction)
-    cdata = getColorGradient(name=name)
+    cdata = getColorGradientLUT(name)
     clen = len(cdata)
     cindex = roundInt(nvalue * (clen-1))
     return tuple(cdata[cindex])
@@ -6,6 +6,7 @@ from lib.image_utils import *
 from lib.io_utils import *
 from lib.math_utils import *
 from lib.sampler import *
+from lib.trace_utils import *
 from lib.video_utils import *
 import math
 import os
@@ -232,6 +233,9 @@ def limitAudioClips(samples, maxAudioClips, keyName, invert=False, keepFirst=64,
 
 def processComposition(a, clips, videoDurationMs, sampler=None, stepTime=False, startTime=False, customClipToArrFunction=None, containsAlphaClips=False, isSequential=False, customClipToArrCalcFunction=None, baseImage=None, container=None, postProcessingFunction=None, preProcessingFunction=None, renderOnTheFly=False, audioSequence=None):
 
+    # record where the time goes
+    tracer = Tracer(a.TRACE) if len(a.TRACE) > 0 else None
+
     # get audio sequence
     samplerClips = sampler.getClips() if sampler is not None else []
 
@@ -243,7 +247,8 @@ def processComposition(a, clips, videoDurationMs, sampler=None, stepTime=False,
         return True
 
     if audioSequence is None:
-        audioSequence = clipsToSequence(clips + samplerClips)
+        with traceSpan(tracer, "audio sequence"):
+            audioSequence = clipsToSequence(clips + samplerClips)
         stepTime = logTime(stepTime, "Processed audio clip sequence")
 
     # plotAudioSequence(audioSequence)
@@ -286,6 +291,17 @@ def processComposition(a, clips, videoDurationMs, sampler=None, stepTime=False,
         print("Total ms: %s" % durationMs)
         sys.exit()
 
+    # previews lay clips out at full size, then draw them scaled down; the encoder needs an even width and height
+    previewScale = a.PREVIEW if "PREVIEW" in vars(a) else 1.0
+    frameWidth = a.WIDTH
+    frameHeight = a.HEIGHT
+    if previewScale < 1.0:
+        frameWidth = max(2, roundInt(a.WIDTH * previewScale * 0.5) * 2)
+        frameHeight = max(2, roundInt(a.HEIGHT * previewScale * 0.5) * 2)
+        print("Previewing at %sx%s" % (frameWidth, frameHeight))
+        if baseImage is not None:
+            baseImage = baseImage.resize((frameWidth, frameHeight), resample=Image.BOX)
+
     # get frame sequence
     videoFrames = []
     print("Making video frame sequence...")
@@ -305,8 +321,11 @@ def processComposition(a, clips, videoDurationMs, sampler=None, stepTime=False,
             "frame": frame,
             "filename": a.OUTPUT_FRAME % zeroPad(frame, totalFrames),
             "ms": ms,
-            "width": a.WIDTH,
-            "height": a.HEIGHT,
+            "width": frameWidth,
+            "height": frameHeight,
+            "containerWidth": a.WIDTH,
+            "containerHeight": a.HEIGHT,
+            "scale": previewScale,
             "overwrite": a.OVERWRITE,
             "debug": a.DEBUG
         })
@@ -317,37 +336,138 @@ def processComposition(a, clips, videoDurationMs, sampler=None, stepTime=False,
         videoFrames = [videoFrames[a.OUTPUT_SINGLE_FRAME-1]]
         print("Procesing single frame: %s" % videoFrames[0]["filename"])
 
-    rebuildAudio = (not a.VIDEO_ONLY and (not os.path.isfile(a.AUDIO_OUTPUT_FILE) or a.OVERWRITE))
-    rebuildVideo = (not a.AUDIO_ONLY and (len(videoFrames) > 0 and not os.path.isfile(videoFrames[-1]["filename"]) or a.OVERWRITE))
-
-    if rebuildAudio:
-        mixAudio(audioSequence, durationMs, a.AUDIO_OUTPUT_FILE, masterDb=a.MASTER_DB)
-        stepTime = logTime(stepTime, "Mix audio")
-
-    if rebuildVideo:
-        colors = 4 if containsAlphaClips else 3
-        globalArgs = {
-            "colors": colors,
-            "isSequential": isSequential,
-            "frameAlpha": a.FRAME_ALPHA,
-            "resizeMode": a.RESIZE_MODE,
-            "baseImage": baseImage,
-            "container": container,
-            "recalculateClipSizes": a.RECALC_CLIP_SIZE,
-            "vthreads": a.VIDEO_THREADS
-        }
-        clipsPixelData = None
-        if not renderOnTheFly:
-            clipsPixelData = loadVideoPixelDataFromFrames(videoFrames, clips, a.WIDTH, a.HEIGHT, a.FPS, a.CACHE_DIR, a.CACHE_KEY, a.VERIFY_CACHE, cache=True, debug=a.DEBUG, precision=a.PRECISION, customClipToArrFunction=customClipToArrFunction, customClipToArrCalcFunction=customClipToArrCalcFunction, globalArgs=globalArgs)
-        stepTime = logTime(stepTime, "Loaded pixel data")
-        if a.OVERWRITE:
-            removeFiles(a.OUTPUT_FRAME % "*")
-        processFrames(videoFrames, clips, clipsPixelData, threads=a.THREADS, precision=a.PRECISION, customClipToArrFunction=customClipToArrFunction, postProcessingFunction=postProcessingFunction, preProcessingFunction=preProcessingFunction, globalArgs=globalArgs)
-
-    if not a.AUDIO_ONLY and a.OUTPUT_SINGLE_FRAME < 1 and frameStart <= 1:
+    # render just this machine's shard of the frames
+    shard = a.SHARD if "SHARD" in vars(a) else None
+    allVideoFrames = videoFrames
+    shardManifest = shardLock = None
+    # the shard's lock is released however the render ends, so the other shards aren't kept waiting on it
+    try:
+        if shard is not None and a.OUTPUT_SINGLE_FRAME < 1:
+            shardIndex, shardCount = shard
+            propagateFrames = (0.0 <= a.FRAME_ALPHA < 1.0)
+            if isSequential or propagateFrames:
+                print("Warning: frames build on the ones before them, so each shard will restart that at the beginning of its frames")
+            videoFrames = getShardFrames(videoFrames, shardIndex, shardCount, a.FPS, contiguous=(isSequential or propagateFrames))
+            shardManifest = getShardFilename(a.OUTPUT_FRAME, shardIndex, shardCount, "txt")
+            shardLockFn = getShardFilename(a.OUTPUT_FRAME, shardIndex, shardCount, "lock")
+            if not acquireLock(shardLockFn):
+                print("Shard %s/%s is already being rendered (%s); exiting" % (shardIndex, shardCount, (readLockFile(shardLockFn) or "").strip()))
+                sys.exit()
+            shardLock = shardLockFn
+            if a.OVERWRITE and os.path.isfile(shardManifest):
+                os.remove(shardManifest)
+            # a frame that a previous run didn't mark done may have been cut off while it was saved, so render it again
+            completed = readManifest(shardManifest)
+            shardFrameCount = len(videoFrames)
+            videoFrames = [f for f in videoFrames if f["frame"] not in completed]
+            for i, f in enumerate(videoFrames):
+                videoFrames[i]["overwrite"] = True
+            print("Shard %s/%s: %s of %s frames left to render" % (shardIndex, shardCount, formatNumber(len(videoFrames)), formatNumber(shardFrameCount)))
+
+        # only stream straight to the output file when rendering the whole thing
+        streamOutput = (a.STREAM_OUTPUT or previewScale < 1.0) and a.OUTPUT_SINGLE_FRAME < 1 and frameStart <= 1 and shardManifest is None
+        if a.STREAM_OUTPUT and not streamOutput:
+            print("Warning: only full renders can be streamed; saving frames as images instead")
+
+        rebuildAudio = (not a.VIDEO_ONLY and (not os.path.isfile(a.AUDIO_OUTPUT_FILE) or a.OVERWRITE))
+        rebuildVideo = (not a.AUDIO_ONLY and (len(videoFrames) > 0 and not os.path.isfile(videoFrames[-1]["filename"]) or a.OVERWRITE))
+        if streamOutput:
+            rebuildVideo = (not a.AUDIO_ONLY and len(videoFrames) > 0 and (not os.path.isfile(a.OUTPUT_FILE) or a.OVERWRITE))
+        # shards only render the frames they haven't finished, and the first shard mixes the audio for everyone
+        if shardManifest is not None:
+            rebuildAudio = rebuildAudio and shard[0] == 1
+            rebuildVideo = (not a.AUDIO_ONLY and len(videoFrames) > 0)
+
+        if rebuildAudio:
+            with traceSpan(tracer, "mix audio"):
+                mixAudio(audioSequence, durationMs, a.AUDIO_OUTPUT_FILE, masterDb=a.MASTER_DB, tracer=tracer)
+            stepTime = logTime(stepTime, "Mix audio")
+
+        if rebuildVideo:
+            colors = 4 if containsAlphaClips else 3
+            globalArgs = {
+                "colors": colors,
+                "isSequential": isSequential,
+                "frameAlpha": a.FRAME_ALPHA,
+                "resizeMode": a.RESIZE_MODE,
+                "baseImage": baseImage,
+                "container": container,
+                "recalculateClipSizes": a.RECALC_CLIP_SIZE,
+                "vthreads": a.VIDEO_THREADS,
+                "backend": a.BACKEND,
+                "cachethreads": a.CACHE_THREADS,
+                "cachemem": a.CACHE_MEMORY,
+                "sizeSample": a.SIZE_SAMPLE,
+                "mipmaps": not a.NO_MIPMAPS,
+                "effectmem": a.EFFECT_MEMORY,
+                "rotationStep": a.ROTATION_STEP,
+                "blurStep": a.BLUR_STEP,
+                "reuseFrames": not a.NO_REUSE,
+                "procs": a.PROCESSES,
+                "maxReaders": a.MAX_READERS,
+                "previewScale": previewScale,
+                "frameManifest": shardManifest,
+                "tracer": tracer
+            }
+            if streamOutput:
+                globalArgs["streamOutput"] = {
+                    "filename": a.OUTPUT_FILE,
+                    "fps": a.FPS,
+                    "audioFile": a.AUDIO_OUTPUT_FILE if not a.VIDEO_ONLY and os.path.isfile(a.AUDIO_OUTPUT_FILE) else None,
+                    "quality": "preview" if previewScale < 1.0 else ("medium" if a.DEBUG else "high")
+                }
+            clipsPixelData = None
+            if not renderOnTheFly:
+                # shards share the cache directory, so only one of them builds the caches at a time and the rest load what it built
+                cacheLock = os.path.join(a.CACHE_DIR, a.CACHE_KEY + ".lock")
+                if shardManifest is not None:
+                    acquireLock(cacheLock, wait=True)
+                try:
+                    with traceSpan(tracer, "load pixel data"):
+                        clipsPixelData = loadVideoPixelDataFromFrames(videoFrames, clips, a.WIDTH, a.HEIGHT, a.FPS, a.CACHE_DIR, a.CACHE_KEY, a.VERIFY_CACHE, cache=True, debug=a.DEBUG, precision=a.PRECISION, customClipToArrFunction=customClipToArrFunction, customClipToArrCalcFunction=customClipToArrCalcFunction, globalArgs=globalArgs)
+                finally:
+                    if shardManifest is not None:
+                        releaseLock(cacheLock)
+            stepTime = logTime(stepTime, "Loaded pixel data")
+            if a.OVERWRITE and shardManifest is None:
+                removeFiles(a.OUTPUT_FRAME % "*")
+            with traceSpan(tracer, "render frames", frames=len(videoFrames)):
+                processFrames(videoFrames, clips, clipsPixelData, threads=a.THREADS, precision=a.PRECISION, customClipToArrFunction=customClipToArrFunction, postProcessingFunction=postProcessingFunction, preProcessingFunction=preProcessingFunction, globalArgs=globalArgs)
+    finally:
+        if shardLock is not None:
+            releaseLock(shardLock)
+
+    # the video can only be encoded once every shard is done, and only by one of them
+    compileVideo = not a.AUDIO_ONLY and a.OUTPUT_SINGLE_FRAME < 1 and frameStart <= 1 and not streamOutput
+    if compileVideo and shardManifest is not None:
+        shardCount = shard[1]
+        completedCount = len(getCompletedFrames(a.OUTPUT_FRAME, shardCount) & set([f["frame"] for f in allVideoFrames]))
+        manifests = [fn for fn in getShardManifests(a.OUTPUT_FRAME, shardCount) if os.path.isfile(fn)]
+        isEncoded = len(manifests) > 0 and os.path.isfile(a.OUTPUT_FILE) and os.path.getmtime(a.OUTPUT_FILE) > max([os.path.getmtime(fn) for fn in manifests])
+        mergeLock = getShardFilename(a.OUTPUT_FRAME, "all", shardCount, "lock")
+        compileVideo = False
+        if completedCount < len(allVideoFrames):
+            print("%s of %s frames are done; the video will be encoded when the rest of the shards finish" % (formatNumber(completedCount), formatNumber(len(allVideoFrames))))
+        elif isEncoded:
+            print("Every shard is done and %s is up to date" % a.OUTPUT_FILE)
+        elif not acquireLock(mergeLock):
+            print("Every shard is done and another shard is encoding %s" % a.OUTPUT_FILE)
+        else:
+            compileVideo = True
+
+    if compileVideo:
         audioFile = a.AUDIO_OUTPUT_FILE if not a.VIDEO_ONLY and os.path.isfile(a.AUDIO_OUTPUT_FILE) else False
-        quality = "medium" if a.DEBUG else "high"
-        compileFrames(a.OUTPUT_FRAME, a.FPS, a.OUTPUT_FILE, getZeroPadding(totalFrames), audioFile=audioFile, quality=quality)
+        quality = "preview" if previewScale < 1.0 else ("medium" if a.DEBUG else "high")
+        try:
+            with traceSpan(tracer, "encode video"):
+                compileFrames(a.OUTPUT_FRAME, a.FPS, a.OUTPUT_FILE, getZeroPadding(totalFrames), audioFile=audioFile, quality=quality)
+        finally:
+            if shardManifest is not None:
+                releaseLock(mergeLock)
+
+    if tracer is not None:
+        tracer.close()
+        print("Wrote trace to %s" % a.TRACE)
 
     logTime(startTime, "Total execution time")
 
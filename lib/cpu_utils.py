@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+# NumPy port of the makeImage kernel in gpu_utils.py for machines without OpenCL;
+# each clip is composited in one vectorized pass per window of tiles it can be seen in, in the same order the kernel composites clips
+
+import numpy as np
+from pprint import pprint
+import sys
+
+from lib.clip import *
+from lib.tile_utils import *
+
+# OpenCL's round() rounds half away from zero; all color values here are non-negative
+def roundF(values):
+    return np.floor(values + np.float32(0.5)).astype(np.int32)
+
+def blendColorsCPU(color1, color2, amount):
+    amount = amount[..., np.newaxis] if np.ndim(amount) > 0 else amount
+    invAmount = np.float32(1.0) - amount
+    return roundF(color1.astype(np.float32) * amount + color2.astype(np.float32) * invAmount)
+
+def getClipPixelGrid(pdata, xs, ys, h, w, dim, offset):
+    # check bounds; retain rgb color of edge, but make alpha=0
+    xVisible = (xs >= 0) & (xs < w)
+    yVisible = (ys >= 0) & (ys < h)
+    xs = np.clip(xs, 0, w-1)
+    ys = np.clip(ys, 0, h-1)
+    src = pdata[offset:offset+h*w*dim].reshape(h, w, dim)
+    grid = src[np.ix_(ys, xs)].astype(np.int32)
+    colors = np.zeros((len(ys), len(xs), 4), dtype=np.int32)
+    colors[:,:,:3] = grid[:,:,:3]
+    colors[:,:,3] = grid[:,:,3] if dim > 3 else 255
+    colors[~(yVisible[:, np.newaxis] & xVisible[np.newaxis, :]), 3] = 0
+    return colors
+
+def getClipPixelsBilinear(pdata, srcXF, srcYF, h, w, dim, offset):
+    srcXF = np.clip(srcXF, np.float32(-1.0), np.float32(w+1))
+    srcYF = np.clip(srcYF, np.float32(-1.0), np.float32(h+1))
+
+    x0 = np.floor(srcXF).astype(np.int32)
+    x1 = np.ceil(srcXF).astype(np.int32)
+    xLerp = np.float32(1.0) - (srcXF - x0.astype(np.float32))
+    y0 = np.floor(srcYF).astype(np.int32)
+    y1 = np.ceil(srcYF).astype(np.int32)
+    yLerp = np.float32(1.0) - (srcYF - y0.astype(np.float32))
+
+    colorTL = getClipPixelGrid(pdata, x0, y0, h, w, dim, offset)
+    colorTR = getClipPixelGrid(pdata, x1, y0, h, w, dim, offset)
+    colorBL = getClipPixelGrid(pdata, x0, y1, h, w, dim, offset)
+    colorBR = getClipPixelGrid(pdata, x1, y1, h, w, dim, offset)
+
+    xLerpGrid = np.broadcast_to(xLerp[np.newaxis, :], colorTL.shape[:2])
+    yLerpGrid = np.broadcast_to(yLerp[:, np.newaxis], colorTL.shape[:2])
+    colorT = blendColorsCPU(colorTL, colorTR, xLerpGrid)
+    colorB = blendColorsCPU(colorBL, colorBR, xLerpGrid)
+    return blendColorsCPU(colorT, colorB, yLerpGrid)
+
+def getSourceCoordinates(count, remainder, tF, remainderT, size):
+    n = np.arange(count, dtype=np.float32)
+    a = np.float32(remainder)
+    b = np.float32(remainder) + np.float32(tF) - np.float32(1.0)
+    srcN = (n - a) / (b - a)
+    srcF = srcN * np.float32(size-1)
+    srcF[srcN < 0.0] = -np.float32(remainder)
+    srcF[srcN > 1.0] = np.float32(size-1) + (np.float32(1.0) - np.float32(remainderT))
+    return srcF
+
+def compositeClipCPU(result, zvalues, pdata, props, colorDimensions, precisionMultiplier, window=None):
+    canvasH, canvasW, _ = result.shape
+    offset, xP, yP, w, h, twP, thP, alphaP, zdindex, brightnessP = tuple([int(v) for v in props])
+    pm = np.float32(precisionMultiplier)
+    xF = np.float32(xP) / pm
+    yF = np.float32(yP) / pm
+    x = int(np.floor(xF))
+    y = int(np.floor(yF))
+    remainderX = xF - np.float32(x)
+    remainderY = yF - np.float32(y)
+    twF = np.float32(twP) / pm
+    thF = np.float32(thP) / pm
+    remainderW = (remainderX+twF) - np.floor(remainderX+twF)
+    remainderH = (remainderY+thF) - np.floor(remainderY+thF)
+    tw = int(np.ceil(remainderX+twF))
+    th = int(np.ceil(remainderY+thF))
+    falpha = np.float32(alphaP) / pm
+    fbrightness = np.float32(brightnessP) / pm
+
+    # only the part of the target rectangle that is on the canvas
+    col0 = max(0, -x)
+    col1 = min(tw, canvasW - x)
+    row0 = max(0, -y)
+    row1 = min(th, canvasH - y)
+    # ... and the part of the canvas where it can still be seen (x0, y0, x1, y1)
+    if window is not None:
+        wx0, wy0, wx1, wy1 = tuple([int(v) for v in window])
+        col0 = max(col0, wx0 - x)
+        col1 = min(col1, wx1 - x)
+        row0 = max(row0, wy0 - y)
+        row1 = min(row1, wy1 - y)
+    if col0 >= col1 or row0 >= row1 or w <= 0 or h <= 0:
+        return
+
+    srcXF = getSourceCoordinates(tw, remainderX, twF, remainderW, w)[col0:col1]
+    srcYF = getSourceCoordinates(th, remainderY, thF, remainderH, h)[row0:row1]
+    srcColor = getClipPixelsBilinear(pdata, srcXF, srcYF, h, w, colorDimensions, offset)
+    if fbrightness < 1.0:
+        srcColor[:,:,:3] = roundF(srcColor[:,:,:3].astype(np.float32) * fbrightness)
+
+    dstX0, dstX1 = (x + col0, x + col1)
+    dstY0, dstY1 = (y + row0, y + row1)
+    destRGB = result[dstY0:dstY1, dstX0:dstX1]
+    destZ = zvalues[dstY0:dstY1, dstX0:dstX1]
+    destZValue = destZ[:,:,0]
+    destZAlpha = destZ[:,:,1].copy()
+    # mirror the kernel, which treats the first canvas pixel as already fully opaque
+    if dstX0 == 0 and dstY0 == 0:
+        destZAlpha[0, 0] = 255
+
+    dalpha = destZAlpha.astype(np.float32) / np.float32(255.0)
+    salpha = srcColor[:,:,3].astype(np.float32) / np.float32(255.0)
+    talpha = salpha * falpha
+    # if alpha is greater than zero and there's not already a pixel there with full opacity and higher zindex
+    mask = (talpha > 0.0) & ((zdindex > destZValue) | (dalpha < 1.0))
+    if not np.any(mask):
+        return
+
+    # there's already a pixel there; place it behind it using its alpha
+    talpha = np.where(zdindex < destZValue, (np.float32(1.0) - dalpha) * talpha, talpha)
+
+    # mix the existing color with new color if necessary
+    destColor = np.zeros(srcColor.shape, dtype=np.int32)
+    destColor[:,:,:3] = destRGB
+    destColor[:,:,3] = destZAlpha
+    blendedColor = blendColorsCPU(srcColor, destColor, talpha)
+    destRGB[mask] = blendedColor[mask][:,:3].astype(np.uint8)
+
+    # assign new zindex if it's greater
+    zmask = mask & (zdindex > destZValue)
+    destZ[zmask, 0] = zdindex
+    destZ[zmask, 1] = blendedColor[zmask][:,3]
+
+def clipsToImageCPU(width, height, flatPixelData, properties, colorDimensions, precision, baseImage=None, dynamicPixelData=None, dynamicOffset=0):
+    count, pcount = properties.shape
+
+    # blank image if no clip data
+    if count <= 0 and baseImage is None:
+        return np.zeros((height, width, 3), dtype=np.uint8)
+    # base image if exists
+    elif count <= 0:
+        return np.array(baseImage, dtype=np.uint8)
+
+    precisionMultiplier = int(10 ** precision)
+    zvalues = np.zeros((height, width, 2), dtype=np.int32)
+    result = np.zeros((height, width, 3), dtype=np.uint8) if baseImage is None else np.array(baseImage, dtype=np.uint8).reshape(height, width, 3)
+
+    # skip the clips (and parts of clips) that are off the canvas or hidden behind opaque clips
+    windows = getClipWindows(properties, width, height, precision, colorDimensions)
+    for window in windows:
+        props = properties[window[0]]
+        pdata = flatPixelData
+        # per-frame pixels live in their own array after the resident pixel data
+        if dynamicPixelData is not None and props[0] >= dynamicOffset:
+            pdata = dynamicPixelData
+            props = props.copy()
+            props[0] -= dynamicOffset
+        compositeClipCPU(result, zvalues, pdata, props, colorDimensions, precisionMultiplier, window[1:])
+
+    return result
+
+# same interface as GPURenderSession so the frame loop doesn't need to know which backend it is using
+class CPURenderSession:
+
+    def __init__(self, width, height, colorDimensions=3, precision=3, pixelData=None, pixelAtlas=None):
+        self.width = width
+        self.height = height
+        self.colorDimensions = colorDimensions
+        self.precision = precision
+        self.pixelData = np.zeros(0, dtype=np.uint8)
+        self.pixelAtlas = pixelAtlas
+        if pixelData is not None:
+            self.setPixelData(pixelData, pixelAtlas)
+
+    def getDynamicOffset(self):
+        return self.pixelData.size
+
+    def render(self, properties, dynamicPixels=None, baseImage=None):
+        return clipsToImageCPU(self.width, self.height, self.pixelData, properties, self.colorDimensions, self.precision, baseImage=baseImage, dynamicPixelData=dynamicPixels, dynamicOffset=self.getDynamicOffset())
+
+    def setPixelData(self, pixelData, pixelAtlas=None):
+        self.pixelData = np.ascontiguousarray(pixelData, dtype=np.uint8).reshape(-1)
+        self.pixelAtlas = pixelAtlas
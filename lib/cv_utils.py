@@ -1,5 +1,4 @@
 
-from moviepy.editor import VideoFileClip
 import multiprocessing
 from multiprocessing import Pool
 from multiprocessing.dummy import Pool as ThreadPool
@@ -21,30 +20,43 @@ def analyzeAndAdjustVideoFileSamples(p, startKey, durKey, minDur, targetDur, var
     fp = p["filepath"]
     fileIndex = p["fileIndex"]
 
-    video = VideoFileClip(fp, audio=False)
-    videoDur = video.duration
     msStep = frameToMs(1, fps, False)
 
     if verbose:
         print("Reading %s with %s samples" % (fp, len(samples)))
 
+    # each sample's time range
+    ranges = []
     for i, s in enumerate(samples):
         start = s["start"]
         dur = s["dur"] if s["dur"] > targetDur else int(math.ceil(1.0 * targetDur / s["dur"]) * s["dur"])
         variance = pseudoRandom(fileIndex + i, range=(0, varDur), isInt=True)
         end = start + dur + variance
+        ranges.append((start, end))
 
+    # read every frame the samples need in one pass through the video
+    ts = set([])
+    for start, end in ranges:
+        ms = start
+        while ms < end:
+            ts.add(roundInt(ms))
+            ms += msStep
+    requests = [(t, frameW, frameH, "warp") for t in sorted(ts)]
+    meanHSVs = {}
+    for j, pixels in streamVideoFrames(fp, requests, resampleType=Image.NEAREST):
+        im = Image.fromarray(pixels, mode="RGB").convert('HSV')
+        pixels = np.array(im, dtype=np.uint8)
+        meanHSV = np.mean(pixels, axis=(0,1)) # get the mean of each of the h, s, and v values
+        meanHSVs[requests[j][0]] = np.mean(meanHSV) # then get the mean of those three values
+
+    for i, (start, end) in enumerate(ranges):
         ms = start
         prev = None
         ys = []
         xs = []
         while ms < end:
             t = roundInt(ms)
-            im = getVideoClipImage(video, videoDur, {"width": frameW, "height": frameH}, t, resizeMode="warp", resampleType=Image.NEAREST)
-            im = im.convert('HSV')
-            pixels = np.array(im, dtype=np.uint8)
-            meanHSV = np.mean(pixels, axis=(0,1)) # get the mean of each of the h, s, and v values
-            meanHSV = np.mean(meanHSV) # then get the mean of those three values
+            meanHSV = meanHSVs[t]
             if prev is not None:
                 delta = abs(meanHSV-prev)
                 ys.append(delta)
@@ -95,10 +107,6 @@ def analyzeAndAdjustVideoFileSamples(p, startKey, durKey, minDur, targetDur, var
         samples[i][durKey] = roundInt(newEnd-newStart)
         # print("--")
 
-    # close video to free up memory
-    video.reader.close()
-    del video
-
     return samples
 
 def analyzeAndAdjustVideoSamples(samples, startKey, durKey, minDur, targetDur, varDur, frameW, frameH, fps, threads=1, overwrite=False):
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import io
+from lib.trace_utils import *
+import numpy as np
+import os
+from PIL import Image
+import subprocess
+import threading
+
+# https://trac.ffmpeg.org/wiki/Encode/H.264
+# presets: veryfast, faster, fast, medium, slow, slower, veryslow
+#   slower = better quality
+# crf: 0 is lossless, 23 is the default, and 51 is worst possible quality
+#   17 or 18 to be visually lossless or nearly so
+def getEncodingSettings(quality="high"):
+    preset = "veryslow"
+    crf = "18"
+    if quality=="medium":
+        preset = "medium"
+        crf = "23"
+    elif quality=="low":
+        preset = "medium"
+        crf = "28"
+    elif quality=="preview":
+        preset = "ultrafast"
+        crf = "32"
+    return (preset, crf)
+
+# pipes rendered frames straight into an ffmpeg encoder instead of saving each one as an image and compiling them afterwards;
+# frames can be written from any thread in any order: they are sent to ffmpeg in frame order,
+# and a thread that gets too far ahead waits until there is room in the reorder buffer
+class FrameWriter:
+
+    def __init__(self, outfile, width, height, fps, audioFile=None, quality="high", startFrame=1, maxBuffer=16):
+        self.outfile = outfile
+        self.width = width
+        self.height = height
+        self.nextFrame = startFrame
+        self.maxBuffer = max(1, maxBuffer)
+        self.buffer = {}
+        self.condition = threading.Condition()
+
+        preset, crf = getEncodingSettings(quality)
+        command = ['ffmpeg','-y',
+                    '-f','rawvideo',
+                    '-vcodec','rawvideo',
+                    '-pix_fmt','rgb24',
+                    '-s','%sx%s' % (width, height),
+                    '-framerate',str(fps)+'/1',
+                    '-i','-']
+        if audioFile:
+            command += ['-i',audioFile]
+        command += ['-c:v','libx264',
+                    '-preset', preset,
+                    '-crf', crf,
+                    '-r',str(fps),
+                    '-pix_fmt','yuv420p']
+        if audioFile:
+            command += ['-c:a','aac',
+                        '-b:a', '192k']
+        command += [outfile]
+        print(" ".join(command))
+        self.proc = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def close(self):
+        with self.condition:
+            if len(self.buffer) > 0:
+                print("Warning: %s frames were never written to %s because frame %s is missing" % (len(self.buffer), self.outfile, self.nextFrame))
+            self.buffer = {}
+        self.proc.stdin.close()
+        self.proc.wait()
+        print("Wrote %s" % self.outfile)
+
+    def write(self, frame, im):
+        pixels = np.array(im.convert("RGB") if hasattr(im, "convert") else im, dtype=np.uint8)
+        with self.condition:
+            # the frame ffmpeg is waiting for never has to wait
+            while frame != self.nextFrame and len(self.buffer) >= self.maxBuffer:
+                self.condition.wait()
+            self.buffer[frame] = pixels
+            while self.nextFrame in self.buffer:
+                self.proc.stdin.write(self.buffer.pop(self.nextFrame).tobytes())
+                self.nextFrame += 1
+            self.condition.notify_all()
+
+# remembers the most recently rendered frame and what it was rendered from, so a frame drawn from exactly the same clip properties
+# (and the same base image) can reuse it instead of being rendered again; each process gets its own when it's pickled
+class LastFrame:
+
+    def __init__(self):
+        self.reset()
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.reset()
+
+    # returns (filename, image) of the last frame if it has the same signature
+    def get(self, signature, baseImage=None):
+        with self.lock:
+            if self.signature is None or signature != self.signature or baseImage is not self.baseImage:
+                return None
+            return (self.filename, self.image)
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.signature = None
+        self.baseImage = None
+        self.filename = None
+        self.image = None
+
+    def set(self, signature, baseImage, filename, image):
+        with self.lock:
+            self.signature = signature
+            self.baseImage = baseImage
+            self.filename = filename
+            self.image = image
+
+def getFrameSignature(clipArr, width, height, *args):
+    clipArr = np.ascontiguousarray(clipArr)
+    return (width, height, clipArr.shape, hashlib.sha1(clipArr.tobytes()).hexdigest()) + tuple(args)
+
+# stands in for a FrameWriter in a worker process: keeps the frames so they can be sent back to the process that is writing them
+class FrameCollector:
+
+    def __init__(self):
+        self.frames = []
+
+    def write(self, frame, im):
+        self.frames.append((frame, np.array(im.convert("RGB") if hasattr(im, "convert") else im, dtype=np.uint8)))
+
+# saves frame images in a few background threads so encoding them doesn't hold up rendering the next frame;
+# saving waits when there are already maxPending frames waiting to be saved
+class FrameSaver:
+
+    def __init__(self, threads=2, maxPending=None, tracer=None):
+        self.tracer = tracer
+        self.maxPending = max(1, maxPending if maxPending is not None else threads * 2)
+        self.pending = []
+        self.condition = threading.Condition()
+        self.error = None
+        self.workers = [threading.Thread(target=self.work, daemon=True) for i in range(max(1, threads))]
+        self.closed = False
+        for worker in self.workers:
+            worker.start()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+        if self.error is not None:
+            raise self.error
+
+    # onSaved is called (from a saving thread) once the file has been completely written
+    def save(self, im, filename, onSaved=None):
+        with self.condition:
+            while len(self.pending) >= self.maxPending and self.error is None:
+                self.condition.wait()
+            if self.error is not None:
+                raise self.error
+            self.pending.append((im, filename, onSaved))
+            self.condition.notify_all()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while len(self.pending) <= 0 and not self.closed:
+                    self.condition.wait()
+                if len(self.pending) <= 0:
+                    return
+                im, filename, onSaved = self.pending.pop(0)
+                self.condition.notify_all()
+            try:
+                saveFrameImage(im, filename, self.tracer)
+                if onSaved is not None:
+                    onSaved()
+            except Exception as e:
+                with self.condition:
+                    self.error = e
+                    self.condition.notify_all()
+
+# when tracing, encode the image in memory before writing it so the two show up separately in the timeline
+def saveFrameImage(im, filename, tracer=None):
+    if tracer is None:
+        im.save(filename)
+        return
+    with traceSpan(tracer, "encode"):
+        buffer = io.BytesIO()
+        im.save(buffer, format=Image.registered_extensions()[os.path.splitext(filename)[1].lower()])
+    with traceSpan(tracer, "write", bytes=buffer.tell()):
+        with open(filename, "wb") as f:
+            f.write(buffer.getvalue())
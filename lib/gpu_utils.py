@@ -1,17 +1,40 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
 import numpy as np
 import os
 from pprint import pprint
-import pyopencl as cl
 import sys
+import threading
+
+try:
+    import pyopencl as cl
+except ImportError:
+    cl = None
 
 from lib.clip import *
+from lib.tile_utils import *
 
 os.environ['PYOPENCL_COMPILER_OUTPUT'] = '1'
 
+# compiled programs are saved here so later runs (and other processes) can load them instead of compiling them again; empty to turn this off
+GPU_PROGRAM_CACHE_DIR = "tmp/opencl/"
+
+# each process gets its own context and programs; ones inherited from a parent process can't be used
+gpuContexts = {}
+gpuPrograms = {}
+gpuProgramsLock = threading.Lock()
+
+# the opencl backend falls back to numpy when pyopencl isn't installed
+def getRenderBackend(backend="opencl"):
+    if backend != "numpy" and cl is None:
+        print("Warning: pyopencl module not found, so using the numpy backend instead")
+        return "numpy"
+    return backend
+
 def loadMakeImageProgram(width, height, pcount, colorDimensions, precision):
     precisionMultiplier = int(10 ** precision)
+    tilesX, tilesY = getTileCount(width, height)
     # the kernel function
     srcCode = """
     static float normF(float value, float a, float b) {
@@ -99,144 +122,230 @@ def loadMakeImageProgram(width, height, pcount, colorDimensions, precision):
         return finalcolor;
     }
 
-    __kernel void makeImage(__global uchar *pdata, __global int *props, __global int *zvalues, __global uchar *result){
+    // one work item per canvas pixel; each one composites the clips binned into its tile (see lib/tile_utils.py) in order,
+    // keeping the pixel's color, zindex, and alpha in registers
+    __kernel void makeImage(__global uchar *pdata, __global int *props, __global int *tileRanges, __global int *tileClips, __global uchar *result){
         int canvasW = %d;
         int canvasH = %d;
-        int i = get_global_id(0);
         int pcount = %d;
         int colorDimensions = %d;
         int precisionMultiplier = %d;
-        int offset = props[i*pcount];
-        float xF = (float) props[i*pcount+1] / (float) precisionMultiplier;
-        float yF = (float) props[i*pcount+2] / (float) precisionMultiplier;
-        int x = (int) floor(xF);
-        int y = (int) floor(yF);
-        float remainderX = xF - (float) x;
-        float remainderY = yF - (float) y;
-        int w = props[i*pcount+3];
-        int h = props[i*pcount+4];
-        float twF = (float) props[i*pcount+5] / (float) precisionMultiplier;
-        float thF = (float) props[i*pcount+6] / (float) precisionMultiplier;
-        float remainderW = (remainderX+twF) - floor(remainderX+twF);
-        float remainderH = (remainderY+thF) - floor(remainderY+thF);
-        //int tw = (int) ceil(twF);
-        //int th = (int) ceil(thF);
-        int tw = (int) ceil(remainderX+twF);
-        int th = (int) ceil(remainderY+thF);
-        float falpha = (float) props[i*pcount+7] / (float) precisionMultiplier;
-        int alpha = (int)round(falpha*(float)255.0);
-        int zdindex = props[i*pcount+8];
-        float fbrightness = (float) props[i*pcount+9] / (float) precisionMultiplier;
-
-        for (int row=0; row<th; row++) {
-            for (int col=0; col<tw; col++) {
-                int dstX = col + x;
-                int dstY = row + y;
-
-                float srcNX = normF((float) col, remainderX, remainderX+twF-1.0);
-                float srcNY = normF((float) row, remainderY, remainderY+thF-1.0);
-                float srcXF = srcNX * (float) (w-1);
-                float srcYF = srcNY * (float) (h-1);
-                //float srcXF = normF((float) col, remainderX, remainderX+twF) * (float) (w-1);
-                //float srcYF = normF((float) row, remainderY, remainderY+thF) * (float) (h-1);
+        int tileSize = %d;
+        int tilesX = %d;
+        int dstX = get_global_id(0);
+        int dstY = get_global_id(1);
+        if (dstX >= canvasW || dstY >= canvasH) {
+            return;
+        }
 
-                if (srcNX < 0.0) { srcXF = -remainderX; }
-                if (srcNY < 0.0) { srcYF = -remainderY; }
-                if (srcNX > 1.0) { srcXF = (float) (w-1) + (1.0-remainderW); }
-                if (srcNY > 1.0) { srcYF = (float) (h-1) + (1.0-remainderH); }
+        int tile = (dstY / tileSize) * tilesX + (dstX / tileSize);
+        int start = tileRanges[tile*2];
+        int end = tileRanges[tile*2+1];
+        int destIndex = dstY * canvasW * 3 + dstX * 3;
+        int dr = result[destIndex];
+        int dg = result[destIndex+1];
+        int db = result[destIndex+2];
+        int destZValue = 0;
+        int destZAlpha = 0;
+
+        for (int k=start; k<end; k++) {
+            int i = tileClips[k];
+            int offset = props[i*pcount];
+            float xF = (float) props[i*pcount+1] / (float) precisionMultiplier;
+            float yF = (float) props[i*pcount+2] / (float) precisionMultiplier;
+            int x = (int) floor(xF);
+            int y = (int) floor(yF);
+            float remainderX = xF - (float) x;
+            float remainderY = yF - (float) y;
+            int w = props[i*pcount+3];
+            int h = props[i*pcount+4];
+            float twF = (float) props[i*pcount+5] / (float) precisionMultiplier;
+            float thF = (float) props[i*pcount+6] / (float) precisionMultiplier;
+            float remainderW = (remainderX+twF) - floor(remainderX+twF);
+            float remainderH = (remainderY+thF) - floor(remainderY+thF);
+            int tw = (int) ceil(remainderX+twF);
+            int th = (int) ceil(remainderY+thF);
+            int col = dstX - x;
+            int row = dstY - y;
+            if (col < 0 || col >= tw || row < 0 || row >= th) {
+                continue;
+            }
+            float falpha = (float) props[i*pcount+7] / (float) precisionMultiplier;
+            int zdindex = props[i*pcount+8];
+            float fbrightness = (float) props[i*pcount+9] / (float) precisionMultiplier;
+
+            float srcNX = normF((float) col, remainderX, remainderX+twF-1.0);
+            float srcNY = normF((float) row, remainderY, remainderY+thF-1.0);
+            float srcXF = srcNX * (float) (w-1);
+            float srcYF = srcNY * (float) (h-1);
+
+            if (srcNX < 0.0) { srcXF = -remainderX; }
+            if (srcNY < 0.0) { srcYF = -remainderY; }
+            if (srcNX > 1.0) { srcXF = (float) (w-1) + (1.0-remainderW); }
+            if (srcNY > 1.0) { srcYF = (float) (h-1) + (1.0-remainderH); }
+
+            int4 srcColor = getPixelF(pdata, srcXF, srcYF, h, w, colorDimensions, offset);
+            if (fbrightness < 1.0) {
+                srcColor = setBrightness(srcColor, fbrightness);
+            }
+            int zAlpha = destZAlpha;
+            // nothing is there yet, give it full opacity
+            if (dstX == 0 && dstY == 0) {
+                zAlpha = 255;
+            }
+            float dalpha = (float) zAlpha / (float) 255.0;
+            float salpha = (float) srcColor.w / (float) 255.0;
+            float talpha = salpha * falpha;
+            // r, g, b, a = x, y, z, w
+            // if alpha is greater than zero and there's not already a pixel there with full opacity and higher zindex
+            if (talpha > 0.0 && (zdindex > destZValue || dalpha < 1.0)) {
+
+                // there's already a pixel there; place it behind it using its alpha
+                if (zdindex < destZValue) {
+                    talpha = (1.0 - dalpha) * talpha;
+                }
 
-                if (dstX >= 0 && dstX < canvasW && dstY >= 0 && dstY < canvasH) {
-                    int4 srcColor = getPixelF(pdata, srcXF, srcYF, h, w, colorDimensions, offset);
-                    if (fbrightness < 1.0) {
-                        srcColor = setBrightness(srcColor, fbrightness);
-                    }
-                    int destIndex = dstY * canvasW * 3 + dstX * 3;
-                    int destZIndex = dstY * canvasW * 2 + dstX * 2;
-                    int destZValue = zvalues[destZIndex];
-                    int destZAlpha = zvalues[destZIndex+1];
-                    // nothing is there yet, give it full opacity
-                    if (destZIndex <= 0) {
-                        destZAlpha = 255;
-                    }
-                    float dalpha = (float) destZAlpha / (float) 255.0;
-                    float salpha = (float) srcColor.w / (float) 255.0;
-                    float talpha = salpha * falpha;
-                    // r, g, b, a = x, y, z, w
-                    // if alpha is greater than zero and there's not already a pixel there with full opacity and higher zindex
-                    if (talpha > 0.0 && (zdindex > destZValue || dalpha < 1.0)) {
-
-                        // there's already a pixel there; place it behind it using its alpha
-                        if (zdindex < destZValue) {
-                            talpha = (1.0 - dalpha) * talpha;
-                        }
-
-                        // mix the existing color with new color if necessary
-                        int dr = result[destIndex];
-                        int dg = result[destIndex+1];
-                        int db = result[destIndex+2];
-                        int4 destColor = (int4)(dr, dg, db, destZAlpha);
-                        int4 blendedColor = blendColors(srcColor, destColor, talpha);
-                        result[destIndex] = blendedColor.x;
-                        result[destIndex+1] = blendedColor.y;
-                        result[destIndex+2] = blendedColor.z;
-
-                        // assign new zindex if it's greater
-                        if (zdindex > destZValue) {
-                            zvalues[destZIndex] = zdindex;
-                            zvalues[destZIndex+1] = blendedColor.w;
-                        }
-                    }
+                // mix the existing color with new color if necessary
+                int4 destColor = (int4)(dr, dg, db, zAlpha);
+                int4 blendedColor = blendColors(srcColor, destColor, talpha);
+                dr = (uchar) blendedColor.x;
+                dg = (uchar) blendedColor.y;
+                db = (uchar) blendedColor.z;
+
+                // assign new zindex if it's greater
+                if (zdindex > destZValue) {
+                    destZValue = zdindex;
+                    destZAlpha = blendedColor.w;
                 }
             }
         }
+
+        result[destIndex] = dr;
+        result[destIndex+1] = dg;
+        result[destIndex+2] = db;
     }
-    """ % (width, height, pcount, colorDimensions, precisionMultiplier)
+    """ % (width, height, pcount, colorDimensions, precisionMultiplier, TILE_SIZE, tilesX)
 
     return loadGPUProgram(srcCode)
 
 def clipsToImageGPU(width, height, flatPixelData, properties, colorDimensions, precision, gpuProgram=None, baseImage=None):
-    count, pcount = properties.shape
-
-    # blank image if no clip data
-    if count <= 0 and baseImage is None:
-        return np.zeros((height, width, 3), dtype=np.uint8)
-    # base image if exists
-    elif count <= 0:
-        return np.array(baseImage, dtype=np.uint8)
-
-    properties = properties.reshape(-1)
-    zvalues = np.zeros(width * height * 2, dtype=np.int32)
-    result = np.zeros(width * height * 3, dtype=np.uint8) if baseImage is None else np.array(baseImage, dtype=np.uint8).reshape(-1)
-    # baseImage = np.copy(result)
-
-    ctx = prg = None
-    if gpuProgram is not None:
-        ctx, prg = gpuProgram
-    else:
-        ctx, prg = loadMakeImageProgram(width, height, pcount, colorDimensions, precision)
-
-    # Create queue for each kernel execution
-    queue = cl.CommandQueue(ctx)
-    mf = cl.mem_flags
-
-    bufIn1 =  cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=flatPixelData)
-    bufIn2 =  cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=properties)
-    bufInZ = cl.Buffer(ctx, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=zvalues)
-    # bufInB =  cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=baseImage)
-    bufOut = cl.Buffer(ctx, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=result)
-    prg.makeImage(queue, (count, ), None , bufIn1, bufIn2, bufInZ, bufOut)
-
-    # Copy result
-    cl.enqueue_copy(queue, result, bufOut)
-    result = result.reshape(height, width, 3)
-    return result
+    renderSession = GPURenderSession(width, height, colorDimensions, precision, gpuProgram=gpuProgram, pixelData=flatPixelData)
+    return renderSession.render(properties, baseImage=baseImage)
+
+# keeps the makeImage program, queue, and buffers alive across frames so the clip pixel atlas is only uploaded once
+class GPURenderSession:
+
+    def __init__(self, width, height, colorDimensions=3, precision=3, gpuProgram=None, pixelData=None, pixelAtlas=None):
+        self.width = width
+        self.height = height
+        self.colorDimensions = colorDimensions
+        self.precision = precision
+
+        if gpuProgram is None:
+            gpuProgram = loadMakeImageProgram(width, height, Clip.gpuPropertyCount, colorDimensions, precision)
+        self.ctx, self.prg = gpuProgram
+        # programs are shared, so each session gets its own kernel
+        self.kernel = cl.Kernel(self.prg, "makeImage")
+        self.queue = cl.CommandQueue(self.ctx)
+        # frames from a thread pool share one queue and one set of buffers
+        self.lock = threading.Lock()
+
+        mf = cl.mem_flags
+        self.result = np.zeros(width * height * 3, dtype=np.uint8)
+        self.bufOut = cl.Buffer(self.ctx, mf.READ_WRITE, size=self.result.nbytes)
+        self.bufProps = None
+        self.propsCapacity = 0
+        tilesX, tilesY = getTileCount(width, height)
+        self.bufTileRanges = cl.Buffer(self.ctx, mf.READ_ONLY, size=tilesX * tilesY * 2 * 4)
+        self.bufTileClips = None
+        self.tileClipsCapacity = 0
+
+        self.bufPixels = None
+        self.staticSize = 0
+        self.scratchCapacity = 0
+        self.pixelAtlas = pixelAtlas
+        if pixelData is not None:
+            self.setPixelData(pixelData, pixelAtlas)
+
+    def ensurePropertyCapacity(self, size):
+        if size <= self.propsCapacity:
+            return
+        self.propsCapacity = max(size, self.propsCapacity * 2)
+        self.bufProps = cl.Buffer(self.ctx, cl.mem_flags.READ_ONLY, size=self.propsCapacity * 4)
+
+    def ensureTileClipsCapacity(self, size):
+        if size <= self.tileClipsCapacity and self.bufTileClips is not None:
+            return
+        self.tileClipsCapacity = max(size, self.tileClipsCapacity * 2, 1)
+        self.bufTileClips = cl.Buffer(self.ctx, cl.mem_flags.READ_ONLY, size=self.tileClipsCapacity * 4)
+
+    def ensureScratchCapacity(self, size):
+        if size <= self.scratchCapacity and self.bufPixels is not None:
+            return
+        # grow the scratch region after the resident atlas; copy the atlas over on the device rather than re-uploading it
+        scratchCapacity = max(size, self.scratchCapacity * 2)
+        bufPixels = cl.Buffer(self.ctx, cl.mem_flags.READ_ONLY, size=max(1, self.staticSize + scratchCapacity))
+        if self.bufPixels is not None and self.staticSize > 0:
+            cl.enqueue_copy(self.queue, bufPixels, self.bufPixels, byte_count=self.staticSize)
+        self.bufPixels = bufPixels
+        self.scratchCapacity = scratchCapacity
+
+    def getDynamicOffset(self):
+        # per-frame pixels (e.g. rotated, blurred, or resampled clips) are written after the resident atlas
+        return self.staticSize
+
+    def render(self, properties, dynamicPixels=None, baseImage=None):
+        count, pcount = properties.shape
+
+        if count <= 0 and baseImage is None:
+            return np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        elif count <= 0:
+            return np.array(baseImage, dtype=np.uint8)
+
+        # only the clips that can be seen in each tile are composited there
+        tileRanges, tileClips, tilesX = getClipTiles(properties, self.width, self.height, self.precision, self.colorDimensions)
+        properties = np.ascontiguousarray(properties.reshape(-1), dtype=np.int32)
+        dynamicSize = 0 if dynamicPixels is None else dynamicPixels.size
+
+        with self.lock:
+            self.ensurePropertyCapacity(properties.size)
+            self.ensureScratchCapacity(dynamicSize)
+            self.ensureTileClipsCapacity(tileClips.size)
+            cl.enqueue_copy(self.queue, self.bufProps, properties)
+            cl.enqueue_copy(self.queue, self.bufTileRanges, np.ascontiguousarray(tileRanges.reshape(-1)))
+            if tileClips.size > 0:
+                cl.enqueue_copy(self.queue, self.bufTileClips, tileClips)
+            if dynamicSize > 0:
+                cl.enqueue_copy(self.queue, self.bufPixels, dynamicPixels, device_offset=self.staticSize)
+
+            # reset the canvas on the device
+            if baseImage is None:
+                cl.enqueue_fill_buffer(self.queue, self.bufOut, np.uint8(0), 0, self.result.nbytes)
+            else:
+                cl.enqueue_copy(self.queue, self.bufOut, np.array(baseImage, dtype=np.uint8).reshape(-1))
+
+            self.kernel(self.queue, (self.width, self.height), None, self.bufPixels, self.bufProps, self.bufTileRanges, self.bufTileClips, self.bufOut)
+
+            result = np.empty(self.width * self.height * 3, dtype=np.uint8)
+            cl.enqueue_copy(self.queue, result, self.bufOut)
+
+        return result.reshape(self.height, self.width, 3)
+
+    def setPixelData(self, pixelData, pixelAtlas=None):
+        pixelData = np.ascontiguousarray(pixelData, dtype=np.uint8).reshape(-1)
+        self.staticSize = pixelData.size
+        self.pixelAtlas = pixelAtlas
+        self.bufPixels = cl.Buffer(self.ctx, cl.mem_flags.READ_ONLY, size=max(1, self.staticSize + self.scratchCapacity))
+        if self.staticSize > 0:
+            cl.enqueue_copy(self.queue, self.bufPixels, pixelData)
+            self.queue.finish()
 
 def clipsToImageGPULite(width, height, flatPixelData, properties):
     count, pcount = properties.shape
     properties = properties.reshape(-1)
     result = np.zeros(width * height * 3, dtype=np.uint8)
 
-    # the kernel function
+    # the sizes are arguments rather than part of the source, so every call uses the same program
     srcCode = """
     int4 getPixel(__global uchar *pdata, int x, int y, int h, int w, int dim, int offset);
     int4 getPixel(__global uchar *pdata, int x, int y, int h, int w, int dim, int offset) {
@@ -250,11 +359,8 @@ def clipsToImageGPULite(width, height, flatPixelData, properties):
         return (int4)(r, g, b, 0);
     }
 
-    __kernel void makeImageLite(__global uchar *pdata, __global int *props, __global uchar *result){
-        int canvasW = %d;
-        int canvasH = %d;
+    __kernel void makeImageLite(__global uchar *pdata, __global int *props, __global uchar *result, int canvasW, int canvasH, int pcount){
         int i = get_global_id(0);
-        int pcount = %d;
         int colorDimensions = 3;
         int offset = props[i*pcount];
         int x = props[i*pcount+1];
@@ -275,7 +381,7 @@ def clipsToImageGPULite(width, height, flatPixelData, properties):
             }
         }
     }
-    """ % (width, height, pcount)
+    """
 
     ctx, prg = loadGPUProgram(srcCode)
     # Create queue for each kernel execution
@@ -285,14 +391,53 @@ def clipsToImageGPULite(width, height, flatPixelData, properties):
     bufIn1 =  cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=flatPixelData)
     bufIn2 =  cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=properties)
     bufOut = cl.Buffer(ctx, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=result)
-    prg.makeImageLite(queue, (count, ), None , bufIn1, bufIn2, bufOut)
+    cl.Kernel(prg, "makeImageLite")(queue, (count, ), None , bufIn1, bufIn2, bufOut, np.int32(width), np.int32(height), np.int32(pcount))
 
     # Copy result
     cl.enqueue_copy(queue, result, bufOut)
     result = result.reshape(height, width, 3)
     return result
 
-def loadGPUProgram(srcCode):
+def buildGPUProgram(ctx, srcCode, cacheDir=GPU_PROGRAM_CACHE_DIR):
+    devices = ctx.devices
+    filenames = []
+    if cacheDir:
+        key = getGPUProgramKey(srcCode, devices)
+        filenames = [os.path.join(cacheDir, "%s_%s.bin" % (key, i)) for i in range(len(devices))]
+
+    # load the binaries if they were compiled before; a driver can still refuse them, so fall back to compiling
+    if len(filenames) > 0 and all([os.path.isfile(fn) for fn in filenames]):
+        try:
+            binaries = []
+            for fn in filenames:
+                with open(fn, "rb") as f:
+                    binaries.append(f.read())
+            return cl.Program(ctx, devices, binaries).build()
+        except (cl.Error, IOError) as e:
+            print("Warning: could not load compiled program %s (%s); compiling it again" % (filenames[0], e))
+
+    prg = cl.Program(ctx, srcCode).build()
+
+    # write to a temporary file first so other processes never read a partial binary
+    if len(filenames) > 0:
+        try:
+            if not os.path.isdir(cacheDir):
+                os.makedirs(cacheDir, exist_ok=True)
+            for fn, binary in zip(filenames, prg.get_info(cl.program_info.BINARIES)):
+                tmpFn = "%s.%s.tmp" % (fn, os.getpid())
+                with open(tmpFn, "wb") as f:
+                    f.write(binary)
+                os.replace(tmpFn, fn)
+        except (cl.Error, IOError, OSError) as e:
+            print("Warning: could not save compiled program to %s (%s)" % (cacheDir, e))
+
+    return prg
+
+def getGPUContext():
+    pid = os.getpid()
+    if pid in gpuContexts:
+        return gpuContexts[pid]
+
     # Get platforms, both CPU and GPU
     plat = cl.get_platforms()
     GPUs = plat[0].get_devices(device_type=cl.device_type.GPU)
@@ -304,7 +449,24 @@ def loadGPUProgram(srcCode):
         print("Warning: using CPU instead of GPU")
         ctx = cl.Context(CPU)
 
-    # Kernel function instantiation
-    prg = cl.Program(ctx, srcCode).build()
-
-    return (ctx, prg)
+    gpuContexts[pid] = ctx
+    return ctx
+
+# a compiled program only works with the devices and driver it was compiled for
+def getGPUProgramKey(srcCode, devices):
+    h = hashlib.sha1(srcCode.encode("utf8"))
+    for device in devices:
+        h.update(("\n%s\n%s\n%s\n%s" % (device.platform.name, device.platform.version, device.name, device.driver_version)).encode("utf8"))
+    h.update(("\n%s" % (cl.VERSION,)).encode("utf8"))
+    return h.hexdigest()
+
+# programs are kept for the rest of the process unless cache is False, e.g. for source that changes every frame
+def loadGPUProgram(srcCode, cache=True):
+    with gpuProgramsLock:
+        ctx = getGPUContext()
+        if not cache:
+            return (ctx, cl.Program(ctx, srcCode).build())
+        key = (os.getpid(), srcCode)
+        if key not in gpuPrograms:
+            gpuPrograms[key] = buildGPUProgram(ctx, srcCode)
+        return (ctx, gpuPrograms[key])
@@ -10,7 +10,10 @@ import os
 from pprint import pprint
 import re
 import shutil
+import socket
 import sys
+import threading
+import time
 import zipfile
 
 try:
@@ -154,6 +157,116 @@ def getNestedValue(d, string):
 def getZeroPadding(count):
     return len(str(count))
 
+# lock a file by atomically creating it; this works across machines on a shared filesystem with no other coordination;
+# while the lock is held its modification time is refreshed every heartbeatSeconds, so a lock left behind is taken over:
+# right away if it belongs to a process that is no longer running on this machine, or once it hasn't been refreshed
+# for staleSeconds if it belongs to another machine
+def acquireLock(fn, wait=False, pollSeconds=5.0, staleSeconds=300.0, heartbeatSeconds=60.0):
+    waiting = False
+    while True:
+        try:
+            fd = os.open(fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            contents = "%s %s %s\n" % (socket.gethostname(), os.getpid(), time.time())
+            os.write(fd, contents.encode("utf8"))
+            os.close(fd)
+            startLockHeartbeat(fn, contents, heartbeatSeconds)
+            return True
+        except FileExistsError:
+            contents = readLockFile(fn)
+            if contents is not None and isLockStale(fn, contents, staleSeconds):
+                removeStaleLock(fn, contents, staleSeconds)
+                continue
+            if not wait:
+                return False
+            if not waiting:
+                print("Waiting for %s (%s)..." % (fn, (contents or "").strip()))
+                waiting = True
+            time.sleep(pollSeconds)
+
+def isLockStale(fn, contents, staleSeconds=300.0):
+    parts = contents.strip().split(" ")
+    if len(parts) < 2:
+        return False
+    # another machine's processes can't be checked, so go by how long ago it was refreshed
+    if parts[0] != socket.gethostname():
+        try:
+            return time.time() - os.path.getmtime(fn) > staleSeconds
+        except OSError:
+            return False
+    try:
+        os.kill(int(parts[1]), 0)
+    except ProcessLookupError:
+        return True
+    except (OSError, ValueError):
+        return False
+    return False
+
+def readLockFile(fn):
+    try:
+        with open(fn, "r", encoding="utf8") as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+def releaseLock(fn):
+    heartbeat = lockHeartbeats.pop(fn, None)
+    contents = None
+    if heartbeat is not None:
+        contents, stopEvent, thread = heartbeat
+        stopEvent.set()
+        thread.join()
+    # don't remove a lock that another process has taken over since
+    if contents is not None and readLockFile(fn) != contents:
+        return
+    if os.path.isfile(fn):
+        os.remove(fn)
+
+def removeStaleLock(fn, contents, staleSeconds=300.0):
+    print("Removing stale lock %s (%s)" % (fn, contents.strip()))
+    # move it out of the way first so only one process removes it
+    staleFn = "%s.%s.stale" % (fn, os.getpid())
+    try:
+        os.rename(fn, staleFn)
+    except OSError:
+        return
+    # another process may have replaced (or refreshed) the lock between reading it and moving it, in which case put it back
+    if readLockFile(staleFn) != contents or not isLockStale(staleFn, contents, staleSeconds):
+        try:
+            os.link(staleFn, fn)
+        except OSError:
+            print("Warning: could not restore lock %s, which was taken over while it was being removed" % fn)
+    try:
+        os.remove(staleFn)
+    except OSError:
+        pass
+
+# locks this process holds: filename => (contents, stop event, heartbeat thread)
+lockHeartbeats = {}
+
+def startLockHeartbeat(fn, contents, heartbeatSeconds=60.0):
+    stopEvent = threading.Event()
+    def beat():
+        while not stopEvent.wait(heartbeatSeconds):
+            # stop refreshing it if another process has taken it over
+            if readLockFile(fn) != contents:
+                return
+            try:
+                os.utime(fn, None)
+            except OSError:
+                pass
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    lockHeartbeats[fn] = (contents, stopEvent, thread)
+
+# hardlink a file to a new name (or copy it where links aren't supported), replacing whatever is there
+def linkFile(src, dst):
+    if os.path.isfile(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
 def makeDirectories(filenames):
     if not isinstance(filenames, list):
         filenames = [filenames]
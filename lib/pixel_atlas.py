@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from PIL import Image
+from pprint import pprint
+import sys
+
+# all of the clips' frame pixels packed into one contiguous uint8 array, plus a table of where each (clip, frame) lives;
+# indexing it like the old list of lists (atlas[clipIndex][frameIndex]) returns a view, never a copy;
+# with mipmaps, each frame is followed by copies of itself at 1/2, 1/4, 1/8... its size for drawing it small;
+# with a scale below 1 (for previews), frames are shrunk by that much as they're added and the full size pixels aren't kept
+class PixelAtlas:
+
+    def __init__(self, colors=3, clipCount=0, mipmaps=False, scale=1.0):
+        self.colors = colors
+        self.mipmaps = mipmaps
+        self.scale = scale
+        self.chunks = []
+        self.size = 0
+        self.frameOffsets = []
+        self.frameShapes = []
+        self.frameMipCounts = []
+        self.clipFrameIds = [[] for i in range(clipCount)]
+        self.data = np.zeros(0, dtype=np.uint8)
+
+    @staticmethod
+    def fromClipsPixelData(clipsPixelData, colors=3, mipmaps=False):
+        atlas = PixelAtlas(colors, clipCount=len(clipsPixelData), mipmaps=mipmaps)
+        for i, clipPixelData in enumerate(clipsPixelData):
+            frameIds = []
+            if clipPixelData is not None:
+                frameIds = [atlas.addFrame(pixels) for pixels in clipPixelData]
+            atlas.setClipFrames(i, frameIds)
+        return atlas.finalize()
+
+    def __getitem__(self, clipIndex):
+        return PixelAtlasClip(self, clipIndex)
+
+    def __len__(self):
+        return len(self.clipFrameIds)
+
+    def addFrame(self, pixels):
+        if self.scale < 1.0:
+            pixels = self.scalePixels(pixels)
+        frameId = self.addPixels(pixels)
+        if not self.mipmaps:
+            return frameId
+
+        # each level is resampled from the one before it; the levels' frame ids follow the frame's
+        h, w, c = pixels.shape
+        mode = "RGBA" if c > 3 else "RGB"
+        im = Image.fromarray(np.ascontiguousarray(pixels[:,:,:4], dtype=np.uint8), mode=mode)
+        mipCount = 0
+        while w > 1 and h > 1:
+            w = int(w / 2)
+            h = int(h / 2)
+            im = im.resize((w, h), resample=Image.LANCZOS)
+            self.addPixels(np.array(im))
+            mipCount += 1
+        self.frameMipCounts[frameId] = mipCount
+        return frameId
+
+    def addPixels(self, pixels):
+        h, w, c = pixels.shape
+        pixels = pixels.astype(np.uint8)
+        # pixels are size 3, but need size 4
+        if self.colors > c:
+            fillVals = np.full((h, w, 1), 255, dtype='uint8')
+            pixels = np.concatenate((pixels, fillVals), axis=2)
+        elif self.colors < c:
+            pixels = pixels[:,:,:self.colors]
+        pixels = np.ascontiguousarray(pixels).reshape(-1)
+        self.chunks.append(pixels)
+        self.frameOffsets.append(self.size)
+        self.frameShapes.append((h, w, self.colors))
+        self.frameMipCounts.append(0)
+        self.size += pixels.size
+        return len(self.frameOffsets) - 1
+
+    def finalize(self):
+        if len(self.chunks) > 0:
+            self.data = np.concatenate(self.chunks)
+        self.chunks = []
+        self.frameOffsets = np.array(self.frameOffsets, dtype=np.int64)
+        self.frameShapes = np.array(self.frameShapes, dtype=np.int32).reshape(-1, 3)
+        self.frameMipCounts = np.array(self.frameMipCounts, dtype=np.int64)
+        # flatten the per-clip frame lists so lookups for many clips at once are a single gather
+        self.clipFrameCounts = np.array([len(ids) for ids in self.clipFrameIds], dtype=np.int64)
+        self.clipFrameStarts = np.zeros(len(self.clipFrameIds), dtype=np.int64)
+        if len(self.clipFrameIds) > 1:
+            self.clipFrameStarts[1:] = np.cumsum(self.clipFrameCounts)[:-1]
+        self.clipFrameTable = np.concatenate([np.array(ids, dtype=np.int64) for ids in self.clipFrameIds]) if len(self.clipFrameIds) > 0 else np.zeros(0, dtype=np.int64)
+        return self
+
+    def getFrame(self, frameId):
+        offset = self.frameOffsets[frameId]
+        h, w, c = tuple(self.frameShapes[frameId])
+        return self.data[offset:offset+h*w*c].reshape(h, w, c)
+
+    def getFrameIds(self, clipIndices, frameIndices):
+        return self.clipFrameTable[self.clipFrameStarts[clipIndices] + frameIndices]
+
+    # the smallest mipmap level of each frame that is still at least the given size
+    def getMipFrameIds(self, frameIds, widths, heights):
+        mipIds = np.array(frameIds, dtype=np.int64)
+        if not self.mipmaps or len(mipIds) <= 0:
+            return mipIds
+        for level in range(1, int(np.max(self.frameMipCounts[frameIds])) + 1):
+            levelIds = frameIds + level
+            hasLevel = self.frameMipCounts[frameIds] >= level
+            levelShapes = self.frameShapes[np.where(hasLevel, levelIds, frameIds)]
+            isBigEnough = hasLevel & (levelShapes[:,1] >= widths) & (levelShapes[:,0] >= heights)
+            if not np.any(isBigEnough):
+                break
+            mipIds[isBigEnough] = levelIds[isBigEnough]
+        return mipIds
+
+    def getFrameShapes(self, clipIndices, frameIndices):
+        return self.frameShapes[self.getFrameIds(clipIndices, frameIndices)]
+
+    def getOffsets(self, clipIndices, frameIndices):
+        return self.frameOffsets[self.getFrameIds(clipIndices, frameIndices)]
+
+    def scalePixels(self, pixels):
+        h, w, c = pixels.shape
+        sw = max(1, int(round(w * self.scale)))
+        sh = max(1, int(round(h * self.scale)))
+        if sw == w and sh == h:
+            return pixels
+        mode = "RGBA" if c > 3 else "RGB"
+        im = Image.fromarray(np.ascontiguousarray(pixels[:,:,:4], dtype=np.uint8), mode=mode)
+        # averaging whole blocks of pixels is much faster than resampling, and just as good when shrinking by a whole number
+        factor = int(round(1.0 / self.scale))
+        if abs(factor * self.scale - 1.0) < 0.001 and w % factor == 0 and h % factor == 0:
+            im = im.reduce(factor)
+        else:
+            im = im.resize((sw, sh), resample=Image.BOX)
+        return np.array(im)
+
+    def setClipFrames(self, clipIndex, frameIds):
+        while len(self.clipFrameIds) <= clipIndex:
+            self.clipFrameIds.append([])
+        self.clipFrameIds[clipIndex] = frameIds
+
+class PixelAtlasClip:
+
+    def __init__(self, atlas, clipIndex):
+        self.atlas = atlas
+        self.clipIndex = clipIndex
+
+    def __getitem__(self, frameIndex):
+        frameIds = self.atlas.clipFrameIds[self.clipIndex]
+        return self.atlas.getFrame(frameIds[frameIndex])
+
+    def __iter__(self):
+        for frameId in self.atlas.clipFrameIds[self.clipIndex]:
+            yield self.atlas.getFrame(frameId)
+
+    def __len__(self):
+        return len(self.atlas.clipFrameIds[self.clipIndex])
@@ -1,5 +1,6 @@
 import multiprocessing
 import sys
+import threading
 
 def beep():
     print('\007')
@@ -9,6 +10,69 @@ def getThreadCount(target=-1):
     threads = min(target, cpuCount) if target > 0 else cpuCount
     return threads
 
+# like ThreadPool.imap (results come back in the same order as the items), except that the threads stop taking new items
+# when they are more than maxAhead items ahead of the result being used, so unused results don't pile up;
+# items are taken from the iterable one at a time, so it doesn't need to be thread-safe
+def imapOrdered(fn, items, threads, maxAhead=None):
+    items = iter(items)
+    maxAhead = max(1, maxAhead if maxAhead is not None else threads * 2)
+    results = {}
+    state = {"taken": 0, "next": 0, "exhausted": False, "stopped": False, "error": None}
+    condition = threading.Condition()
+
+    def work():
+        while True:
+            with condition:
+                while not state["exhausted"] and not state["stopped"] and state["taken"] >= state["next"] + maxAhead:
+                    condition.wait()
+                if state["exhausted"] or state["stopped"]:
+                    return
+                try:
+                    item = next(items)
+                except BaseException as e:
+                    state["exhausted"] = True
+                    if not isinstance(e, StopIteration):
+                        state["error"] = e
+                    condition.notify_all()
+                    return
+                index = state["taken"]
+                state["taken"] += 1
+            try:
+                result = fn(item)
+            except BaseException as e:
+                with condition:
+                    state["error"] = e
+                    state["stopped"] = True
+                    condition.notify_all()
+                return
+            with condition:
+                results[index] = result
+                condition.notify_all()
+
+    workers = [threading.Thread(target=work, daemon=True) for i in range(max(1, threads))]
+    for worker in workers:
+        worker.start()
+    try:
+        while True:
+            with condition:
+                index = state["next"]
+                while index not in results and state["error"] is None and not (state["exhausted"] and index >= state["taken"]):
+                    condition.wait()
+                if state["error"] is not None:
+                    raise state["error"]
+                if index not in results:
+                    break
+                result = results.pop(index)
+                state["next"] += 1
+                condition.notify_all()
+            yield result
+    finally:
+        with condition:
+            state["stopped"] = True
+            condition.notify_all()
+        for worker in workers:
+            worker.join()
+
 def printCommand(command):
     pcommand = command[:]
     for i, p in enumerate(pcommand):
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+# Splits a render across machines that share a filesystem, with no coordinator: the frames are split into chunks that are dealt out
+# to the shards in turn; each shard holds a lock file while it renders and appends every frame it finishes to its own manifest,
+# and whichever shard finds every manifest complete encodes the video
+
+from lib.io_utils import *
+from lib.math_utils import *
+import os
+from pprint import pprint
+import sys
+
+# "3/6" => (3, 6)
+def parseShard(string):
+    parts = string.strip().split("/")
+    if len(parts) != 2:
+        print("Invalid shard %s; expected e.g. 3/6 for the third of six shards" % string)
+        sys.exit()
+    index, count = tuple([int(v) for v in parts])
+    if count < 1 or not (1 <= index <= count):
+        print("Invalid shard %s; the shard must be between 1 and %s" % (string, count))
+        sys.exit()
+    return (index, count)
+
+def getShardFilename(outputFramePattern, index, count, ext):
+    dirname = os.path.dirname(outputFramePattern)
+    return os.path.join(dirname, "shard_%s_of_%s.%s" % (index, count, ext))
+
+# deal out chunks of frames to the shards in turn so each gets a mix of cheap and expensive parts of the composition;
+# frames that build on the frame before them are split into one contiguous block per shard instead
+def getShardFrames(frames, index, count, chunkSize, contiguous=False):
+    frameCount = len(frames)
+    if contiguous:
+        chunkSize = ceilInt(1.0 * frameCount / count)
+    chunkSize = max(1, chunkSize)
+    shardFrames = []
+    for i, start in enumerate(range(0, frameCount, chunkSize)):
+        if i % count == index - 1:
+            shardFrames += frames[start:start+chunkSize]
+    return shardFrames
+
+def getShardManifests(outputFramePattern, count):
+    return [getShardFilename(outputFramePattern, i+1, count, "txt") for i in range(count)]
+
+# a single line is written per frame, so a line without a newline was cut off
+def readManifest(fn):
+    frames = set([])
+    contents = readTextFile(fn)
+    for line in contents.split("\n")[:-1]:
+        line = line.strip()
+        if len(line) > 0:
+            frames.add(int(line))
+    return frames
+
+def appendToManifest(fn, frame):
+    fd = os.open(fn, os.O_CREAT | os.O_APPEND | os.O_WRONLY)
+    os.write(fd, ("%s\n" % frame).encode("utf8"))
+    os.close(fd)
+
+def getCompletedFrames(outputFramePattern, count):
+    frames = set([])
+    for fn in getShardManifests(outputFramePattern, count):
+        frames.update(readManifest(fn))
+    return frames
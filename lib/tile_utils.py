@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+# Bins clips into square tiles of the canvas so each tile only composites the clips that touch it.
+# Clips are kept in the same order within each tile, so the result is the same as compositing every clip in turn;
+# and a tile can skip every clip before the last one that paints over the whole tile with opaque pixels
+# and is in front of everything before it, since that clip would overwrite whatever they drew.
+
+import numpy as np
+from pprint import pprint
+import sys
+
+TILE_SIZE = 16
+
+def getTileCount(width, height, tileSize=TILE_SIZE):
+    tilesX = int((width + tileSize - 1) / tileSize)
+    tilesY = int((height + tileSize - 1) / tileSize)
+    return (tilesX, tilesY)
+
+# the canvas rectangle each clip's pixels land in, calculated with the same float32 math as the makeImage kernel;
+# properties are rows of [offset, x, y, w, h, tw, th, alpha, zindex, brightness]
+def getClipRects(properties, precisionMultiplier):
+    pm = np.float32(precisionMultiplier)
+    xF = properties[:,1].astype(np.float32) / pm
+    yF = properties[:,2].astype(np.float32) / pm
+    x = np.floor(xF)
+    y = np.floor(yF)
+    twF = properties[:,5].astype(np.float32) / pm
+    thF = properties[:,6].astype(np.float32) / pm
+    tw = np.ceil((xF - x) + twF)
+    th = np.ceil((yF - y) + thF)
+    return (x.astype(np.int64), y.astype(np.int64), tw.astype(np.int64), th.astype(np.int64))
+
+# returns (tileRanges, tileClips, tilesX): tileClips lists clip rows tile by tile,
+# and tileRanges[tile] is the [start, end) of that tile's clips in tileClips, after skipping clips that can't be seen
+def getClipTiles(properties, width, height, precision, colorDimensions, tileSize=TILE_SIZE):
+    precisionMultiplier = int(10 ** precision)
+    tilesX, tilesY = getTileCount(width, height, tileSize)
+    tileCount = tilesX * tilesY
+    x, y, tw, th = getClipRects(properties, precisionMultiplier)
+
+    # cull clips that wouldn't draw anything: off the canvas, empty, or transparent
+    visible = (properties[:,7] > 0) & (properties[:,3] > 0) & (properties[:,4] > 0) & (tw > 0) & (th > 0) & (x < width) & (y < height) & (x + tw > 0) & (y + th > 0)
+    rows = np.nonzero(visible)[0]
+    x, y, tw, th = (x[rows], y[rows], tw[rows], th[rows])
+    tx0 = np.maximum(x, 0) // tileSize
+    tx1 = (np.minimum(x + tw, width) - 1) // tileSize
+    ty0 = np.maximum(y, 0) // tileSize
+    ty1 = (np.minimum(y + th, height) - 1) // tileSize
+
+    # one entry per (clip, tile) it touches, then grouped by tile without changing the order of clips
+    nx = tx1 - tx0 + 1
+    counts = nx * (ty1 - ty0 + 1)
+    entryClips = np.repeat(np.arange(len(rows)), counts)
+    entryStarts = np.repeat(np.cumsum(counts) - counts, counts)
+    local = np.arange(len(entryClips)) - entryStarts
+    entryTileX = tx0[entryClips] + local % nx[entryClips]
+    entryTileY = ty0[entryClips] + local // nx[entryClips]
+    entryTiles = entryTileY * tilesX + entryTileX
+    order = np.argsort(entryTiles, kind="stable")
+    entryClips = entryClips[order]
+    entryTiles = entryTiles[order]
+    entryTileX = entryTileX[order]
+    entryTileY = entryTileY[order]
+    tileEnds = np.cumsum(np.bincount(entryTiles, minlength=tileCount))
+    tileStarts = tileEnds - np.bincount(entryTiles, minlength=tileCount)
+
+    # a clip paints over a whole tile if the tile is within its interior (the edge pixels blend with transparency),
+    # its pixels have no alpha channel, and its alpha is exactly 1
+    opaque = (colorDimensions <= 3) & (properties[rows,7] == precisionMultiplier)
+    covers = opaque[entryClips] & \
+        (entryTileX * tileSize >= x[entryClips] + 2) & (np.minimum((entryTileX + 1) * tileSize, width) <= x[entryClips] + tw[entryClips] - 2) & \
+        (entryTileY * tileSize >= y[entryClips] + 2) & (np.minimum((entryTileY + 1) * tileSize, height) <= y[entryClips] + th[entryClips] - 2)
+    if np.any(covers):
+        # ... and it is in front of every clip before it in the tile (and of the empty canvas, which has a zindex of 0)
+        zs = properties[rows,8].astype(np.int64)[entryClips]
+        zMin = min(0, int(np.min(zs)))
+        zSpan = int(np.max(zs)) - zMin + 1
+        groupedZs = entryTiles.astype(np.int64) * zSpan + (zs - zMin)
+        zsBefore = np.zeros(len(zs), dtype=np.int64)
+        if len(zs) > 1:
+            zsBefore[1:] = np.maximum.accumulate(groupedZs)[:-1] - entryTiles[1:].astype(np.int64) * zSpan + zMin
+        isFirst = np.arange(len(zs)) == tileStarts[entryTiles]
+        zsBefore[isFirst] = 0
+        occluders = np.nonzero(covers & (zs > np.maximum(zsBefore, 0)))[0]
+        np.maximum.at(tileStarts, entryTiles[occluders], occluders)
+
+    tileRanges = np.zeros((tileCount, 2), dtype=np.int32)
+    tileRanges[:,0] = tileStarts
+    tileRanges[:,1] = tileEnds
+    tileClips = rows[entryClips].astype(np.int32)
+    return (tileRanges, tileClips, tilesX)
+
+# the parts of the canvas each clip still needs to be drawn in, as rows of (clip, x0, y0, x1, y1) ordered by clip:
+# one rectangle per run of neighboring tiles in a row, with runs that line up across rows merged together;
+# clips that don't need to be drawn at all have no rectangles
+def getClipWindows(properties, width, height, precision, colorDimensions, tileSize=TILE_SIZE):
+    tileRanges, tileClips, tilesX = getClipTiles(properties, width, height, precision, colorDimensions, tileSize)
+    tileCounts = tileRanges[:,1] - tileRanges[:,0]
+    liveTiles = np.repeat(np.arange(len(tileRanges)), tileCounts)
+    liveEntries = np.arange(len(liveTiles)) - np.repeat(np.cumsum(tileCounts) - tileCounts, tileCounts) + np.repeat(tileRanges[:,0], tileCounts)
+    liveClips = tileClips[liveEntries].astype(np.int64)
+    if len(liveClips) <= 0:
+        return np.zeros((0, 5), dtype=np.int64)
+
+    # runs of neighboring tiles in the same row of the same clip
+    order = np.lexsort((liveTiles, liveClips))
+    clips = liveClips[order]
+    tileX = liveTiles[order] % tilesX
+    tileY = liveTiles[order] // tilesX
+    newRun = np.ones(len(clips), dtype=bool)
+    newRun[1:] = (clips[1:] != clips[:-1]) | (tileY[1:] != tileY[:-1]) | (tileX[1:] != tileX[:-1] + 1)
+    runStarts = np.nonzero(newRun)[0]
+    runEnds = np.append(runStarts[1:], len(clips)) - 1
+    runClips = clips[runStarts]
+    runY = tileY[runStarts]
+    runX0 = tileX[runStarts]
+    runX1 = tileX[runEnds] + 1
+
+    # merge a run into the one above it if both are the only run in their row and they span the same tiles
+    newRow = np.ones(len(runClips), dtype=bool)
+    newRow[1:] = (runClips[1:] != runClips[:-1]) | (runY[1:] != runY[:-1])
+    rowIds = np.cumsum(newRow) - 1
+    aloneInRow = np.bincount(rowIds)[rowIds] == 1
+    merges = np.zeros(len(runClips), dtype=bool)
+    merges[1:] = (runClips[1:] == runClips[:-1]) & (runY[1:] == runY[:-1] + 1) & (runX0[1:] == runX0[:-1]) & (runX1[1:] == runX1[:-1]) & aloneInRow[1:] & aloneInRow[:-1]
+    windowStarts = np.nonzero(~merges)[0]
+    windowEnds = np.append(windowStarts[1:], len(runClips)) - 1
+
+    windows = np.zeros((len(windowStarts), 5), dtype=np.int64)
+    windows[:,0] = runClips[windowStarts]
+    windows[:,1] = runX0[windowStarts] * tileSize
+    windows[:,2] = runY[windowStarts] * tileSize
+    windows[:,3] = np.minimum(runX1[windowStarts] * tileSize, width)
+    windows[:,4] = np.minimum((runY[windowEnds] + 1) * tileSize, height)
+    return windows
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# Records what a render spends its time on as a timeline in the Chrome trace event format
+# (open it in chrome://tracing or https://ui.perfetto.dev), or as one JSON event per line if the filename ends in .jsonl.
+# Every process appends its own events to the same file as they happen, so a trace is still readable if the render is interrupted;
+# that's also why the Chrome format's array is never closed, which the format allows.
+# Nothing is traced unless a Tracer is created: the helpers below take None and return a span that does nothing
+
+import json
+import os
+import threading
+import time
+
+class Tracer:
+
+    def __init__(self, fn, processName="main"):
+        self.fn = fn
+        self.jsonLines = fn.endswith(".jsonl")
+        # every process measures time from the same moment so their events line up
+        self.epoch = time.time()
+        with open(fn, "w") as f:
+            if not self.jsonLines:
+                f.write("[\n")
+        self.open(processName)
+
+    # each process gets its own file handle, and names itself in the timeline
+    def __getstate__(self):
+        return (self.fn, self.jsonLines, self.epoch)
+
+    def __setstate__(self, state):
+        self.fn, self.jsonLines, self.epoch = state
+        self.fd = None
+        self.pid = None
+        self.clockOffset = time.time() - time.perf_counter()
+
+    def close(self):
+        if self.fd is not None and self.pid == os.getpid():
+            os.close(self.fd)
+        self.fd = None
+
+    def counter(self, name, **values):
+        self.write({"name": name, "ph": "C", "ts": self.now(), "args": values})
+
+    # microseconds since the tracer was created
+    def now(self):
+        return (time.perf_counter() + self.clockOffset - self.epoch) * 1000000.0
+
+    def open(self, processName):
+        self.pid = os.getpid()
+        self.clockOffset = time.time() - time.perf_counter()
+        self.fd = os.open(self.fn, os.O_CREAT | os.O_APPEND | os.O_WRONLY)
+        self.write({"name": "process_name", "ph": "M", "args": {"name": processName}})
+
+    def span(self, name, **args):
+        return TraceSpan(self, name, args)
+
+    # one write per event, so events from different processes don't interleave
+    def write(self, event):
+        # a forked worker inherits the tracer without being pickled
+        if self.pid != os.getpid():
+            self.open("worker %s" % os.getpid())
+        if self.fd is None:
+            return
+        event["pid"] = self.pid
+        event["tid"] = threading.get_ident()
+        line = json.dumps(event, separators=(",", ":")) + ("\n" if self.jsonLines else ",\n")
+        os.write(self.fd, line.encode("utf8"))
+
+class TraceSpan:
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = self.tracer.now()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = self.tracer.now()
+        self.tracer.write({"name": self.name, "ph": "X", "ts": self.start, "dur": end - self.start, "args": self.args})
+        return False
+
+    # add counts to the span once they're known
+    def set(self, **args):
+        self.args.update(args)
+
+class NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **args):
+        pass
+
+nullSpan = NullSpan()
+
+def traceCounter(tracer, name, **values):
+    if tracer is not None:
+        tracer.counter(name, **values)
+
+def traceSpan(tracer, name, **args):
+    if tracer is None:
+        return nullSpan
+    return tracer.span(name, **args)
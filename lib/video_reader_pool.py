@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+# Keeps video readers (each an open ffmpeg process) between frames when rendering on the fly, so a clip that plays its
+# source forward can read the next frame from where its reader left off instead of opening and seeking the file every frame.
+# A file can have several readers, e.g. for clips playing different parts of it; each request goes to the reader that can
+# reach its frame by moving forward the least. At most maxReaders are kept open, and the least recently used is replaced first.
+# Threads can share a pool: a reader is only used by one thread at a time, and a thread waits if every reader is busy and there's no room for another. Each process gets its own empty copy
+# (with the same counters) when it's pickled
+
+from collections import OrderedDict
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+import multiprocessing
+import numpy as np
+import subprocess
+import threading
+import time
+
+# an ffmpeg rawvideo pipe that reads a video forward from wherever it was last opened; frames are chosen and
+# seeked to the same way as streamVideoFrames in lib/video_utils.py
+class VideoReader:
+
+    def __init__(self, fn, infos):
+        self.fn = fn
+        self.fps = infos["video_fps"]
+        self.width, self.height = infos["video_size"]
+        self.frameSize = self.width * self.height * 3
+        self.proc = None
+        self.pos = -1 # the last frame read
+        self.pixels = None
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdout.close()
+            self.proc.terminate()
+            self.proc.wait()
+            self.proc = None
+        self.pos = -1
+
+    def getFrame(self, frame):
+        if self.proc is None or frame < self.pos or self.pixels is None:
+            self.open(frame)
+        while self.pos < frame:
+            data = self.proc.stdout.read(self.frameSize)
+            # past the end of what ffmpeg could give us; keep using the last frame
+            if len(data) < self.frameSize:
+                self.pos = frame
+                break
+            self.pixels = np.frombuffer(data, dtype=np.uint8).reshape(self.height, self.width, 3)
+            self.pos += 1
+        if self.pixels is None:
+            print("Could not read pixels for %s at frame %s" % (self.fn, frame))
+            return np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        return self.pixels
+
+    def open(self, frame):
+        self.close()
+        # ffmpeg's seeking can land a frame either side of where we ask, so seek a bit early
+        # and let the trim filter drop everything before the frame we need
+        startT = max(0, (frame - 0.5) / self.fps)
+        seekT = max(0, startT - 1.0)
+        inputArgs = ['-i', self.fn]
+        if seekT > 0:
+            inputArgs = ['-ss', "%.06f" % seekT, '-i', self.fn]
+        command = ['ffmpeg'] + inputArgs + ['-loglevel', 'error', '-f', 'image2pipe', '-vsync', '0', '-vf', "trim=start=%.06f" % (startT - seekT), '-pix_fmt', 'rgb24', '-vcodec', 'rawvideo', '-']
+        self.proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL, bufsize=self.frameSize+100)
+        self.pos = frame - 1
+        self.pixels = None
+
+class VideoReaderPool:
+
+    def __init__(self, maxReaders=32, maxSkipFrames=100):
+        self.maxReaders = max(1, maxReaders)
+        self.maxSkipFrames = maxSkipFrames # read forward this many frames at most before seeking instead
+        self.hits = multiprocessing.Value('l', 0) # frames read by moving an open reader forward
+        self.seeks = multiprocessing.Value('l', 0) # frames an open reader had to seek for
+        self.misses = multiprocessing.Value('l', 0) # frames that needed a new reader
+        self.decodeSeconds = multiprocessing.Value('d', 0.0)
+        self.reset()
+
+    def __getstate__(self):
+        return (self.maxReaders, self.maxSkipFrames, self.hits, self.seeks, self.misses, self.decodeSeconds)
+
+    def __setstate__(self, state):
+        self.maxReaders, self.maxSkipFrames, self.hits, self.seeks, self.misses, self.decodeSeconds = state
+        self.reset()
+
+    # the idle reader of this file that is closest behind the frame; failing that, a new reader if there's room,
+    # or else the least recently used reader of this file (which will have to seek), or the least recently used reader of any file
+    def acquire(self, fn, frame):
+        with self.lock:
+            idle = [entry for entry in self.entries.values() if not entry["busy"]]
+            while len(idle) <= 0 and len(self.entries) >= self.maxReaders:
+                self.released.wait()
+                idle = [entry for entry in self.entries.values() if not entry["busy"]]
+            idleForFile = [entry for entry in idle if entry["fn"] == fn]
+            ahead = [entry for entry in idleForFile if entry["reader"].pos <= frame <= entry["reader"].pos + self.maxSkipFrames]
+            counter = self.misses
+            if len(ahead) > 0:
+                entry = min(ahead, key=lambda e: frame - e["reader"].pos)
+                counter = self.hits
+            elif len(self.entries) < self.maxReaders:
+                entry = self.addEntry(fn)
+            elif len(idleForFile) > 0:
+                entry = idleForFile[0]
+                counter = self.seeks
+            else:
+                self.removeEntry(idle[0])
+                entry = self.addEntry(fn)
+            entry["busy"] = True
+            self.entries.move_to_end(id(entry))
+        self.addCount(counter)
+        return entry
+
+    def addCount(self, counter, amount=1):
+        with counter.get_lock():
+            counter.value += amount
+
+    def addEntry(self, fn):
+        entry = {"fn": fn, "reader": None, "busy": False, "lock": threading.Lock()}
+        self.entries[id(entry)] = entry
+        return entry
+
+    def close(self):
+        with self.lock:
+            for entry in list(self.entries.values()):
+                self.removeEntry(entry)
+            self.reset()
+
+    def getDuration(self, fn):
+        return self.getInfos(fn)["video_duration"]
+
+    # each file is only probed once
+    def getInfos(self, fn):
+        with self.lock:
+            if fn not in self.infos:
+                self.infos[fn] = ffmpeg_parse_infos(fn)
+            return self.infos[fn]
+
+    # times are in seconds; returns the frames in the same order as the times, but reads them in time order
+    def getFrames(self, fn, times):
+        frames = [None for t in times]
+        for i, t in sorted(enumerate(times), key=lambda it: it[1]):
+            frames[i] = self.getFrame(fn, t)
+        return frames
+
+    def getFrame(self, fn, t):
+        infos = self.getInfos(fn)
+        frame = int(infos["video_fps"] * t + 0.00001)
+        entry = self.acquire(fn, frame)
+        try:
+            with entry["lock"]:
+                startTime = time.time()
+                if entry["reader"] is None:
+                    entry["reader"] = VideoReader(fn, infos)
+                pixels = entry["reader"].getFrame(frame)
+                self.addCount(self.decodeSeconds, time.time() - startTime)
+        finally:
+            with self.lock:
+                entry["busy"] = False
+                # don't keep readers that couldn't be opened
+                if entry["reader"] is None:
+                    self.removeEntry(entry)
+                self.released.notify()
+        return pixels
+
+    def getStats(self):
+        return {
+            "hits": self.hits.value,
+            "seeks": self.seeks.value,
+            "misses": self.misses.value,
+            "decodeSeconds": self.decodeSeconds.value
+        }
+
+    def printStats(self):
+        stats = self.getStats()
+        total = stats["hits"] + stats["seeks"] + stats["misses"]
+        if total > 0:
+            print("Video readers: %s frames read forward, %s seeks, %s new readers (%s%% read forward); %ss decoding" % (stats["hits"], stats["seeks"], stats["misses"], round(100.0 * stats["hits"] / total, 1), round(stats["decodeSeconds"], 1)))
+
+    def removeEntry(self, entry):
+        if entry["reader"] is not None:
+            entry["reader"].close()
+        self.entries.pop(id(entry), None)
+
+    def reset(self):
+        self.entries = OrderedDict() # least recently used first
+        self.infos = {}
+        self.lock = threading.Lock()
+        self.released = threading.Condition(self.lock)
@@ -1,16 +1,31 @@
 # -*- coding: utf-8 -*-
 
+from bisect import bisect_left
+import copy
 from functools import partial
 from lib.cache_utils import *
 from lib.clip import *
+from lib.clip_batch import *
 from lib.collection_utils import *
+from lib.cpu_utils import *
+from lib.frame_writer import *
 from lib.gpu_utils import *
 from lib.image_utils import *
 from lib.math_utils import *
+from lib.pixel_atlas import *
 from lib.processing_utils import *
+from lib.shard_utils import *
+from lib.trace_utils import *
+from lib.video_reader_pool import *
 from moviepy.editor import VideoFileClip
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
 import multiprocessing
 from multiprocessing import Pool
+from multiprocessing.util import Finalize
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
 from multiprocessing.dummy import Pool as ThreadPool
 import numpy as np
 import os
@@ -61,14 +76,30 @@ def addVideoArgs(parser):
     parser.add_argument('-probe', dest="PROBE", action="store_true", help="Just spit out duration info?")
     parser.add_argument('-frame', dest="OUTPUT_SINGLE_FRAME", default=-1, type=int, help="Output only a single frame (indicated frame number)")
     parser.add_argument('-frange', dest="FRAME_RANGE", default="1,0", help="Frame range to render")
-
-def clipsToFrame(p, clips, pixelData, precision=3, customClipToArrFunction=None, baseImage=None, gpuProgram=None, postProcessingFunction=None, preProcessingFunction=None, globalArgs={}):
+    parser.add_argument('-backend', dest="BACKEND", default="opencl", help="Backend for compositing clips: opencl or numpy")
+    parser.add_argument('-cachethreads', dest="CACHE_THREADS", default=1, type=int, help="Amount of source videos to build frame caches for in parallel processes")
+    parser.add_argument('-procs', dest="PROCESSES", default=1, type=int, help="Amount of processes to render frames in; each renders its own ranges of frames")
+    parser.add_argument('-stream', dest="STREAM_OUTPUT", action="store_true", help="Pipe frames straight to ffmpeg instead of saving them as images first? (frames aren't kept, so rendering can't be resumed)")
+    parser.add_argument('-sizesample', dest="SIZE_SAMPLE", default=0.5, type=float, help="Seconds between frames checked when calculating clips' max sizes (frames around keyframes are always checked); sampled sizes can miss a clip's widest frame, so they get a 2%% margin; 0 checks every frame exactly (slower)")
+    parser.add_argument('-nomips', dest="NO_MIPMAPS", action="store_true", help="Don't keep smaller copies (1/2, 1/4, 1/8...) of cached clip frames for drawing clips small? Uses a third less memory, but shrunken clips are resampled every frame")
+    parser.add_argument('-effectmem', dest="EFFECT_MEMORY", default=256, type=int, help="Memory (in MB) for remembering rotated and blurred clip frames between frames; 0 to turn this off")
+    parser.add_argument('-rotstep', dest="ROTATION_STEP", default=0.0, type=float, help="Round clip rotations to this many degrees so more rotated frames can be reused; 0 for no rounding")
+    parser.add_argument('-blurstep', dest="BLUR_STEP", default=0.0, type=float, help="Round clip blur radii to this many pixels so more blurred frames can be reused; 0 for no rounding")
+    parser.add_argument('-noreuse', dest="NO_REUSE", action="store_true", help="Render every frame, even if it's drawn from exactly the same clips as the frame before it?")
+    parser.add_argument('-shard', dest="SHARD", default="", help="Render one shard of the frames, e.g. 3/6 for the third of six; shards can run on different machines that share the output and cache directories, and the video is encoded once every shard is done")
+    parser.add_argument('-readers', dest="MAX_READERS", default=32, type=int, help="Amount of source video readers to keep open between frames when rendering clips on the fly; 0 to open each video for every frame")
+    parser.add_argument('-trace', dest="TRACE", default="", help="Save a timeline of where the render spends its time to this file, for chrome://tracing or ui.perfetto.dev (or one JSON event per line if it ends in .jsonl)")
+    parser.add_argument('-preview', dest="PREVIEW", default=1.0, type=float, help="Render a quick preview at this scale (e.g. 0.25) from smaller copies of the cached clip frames, streamed to a low quality *_preview.mp4; 1 for a full render")
+    parser.add_argument('-cachemem', dest="CACHE_MEMORY", default=256, type=int, help="Memory (in MB) each frame cache process can use for buffering frames before writing them to disk")
+
+def clipsToFrame(p, clips, pixelData, precision=3, customClipToArrFunction=None, baseImage=None, gpuProgram=None, postProcessingFunction=None, preProcessingFunction=None, renderSession=None, frameWriter=None, clipArr=None, clipLayer=None, frameSaver=None, globalArgs={}):
     filename = p["filename"]
     width = p["width"]
     height = p["height"]
 
     frame = getValue(p, "frame", 1)
     ms = getValue(p, "ms", 0)
+    scale = getValue(p, "scale", 1.0)
     overwrite = getValue(p, "overwrite", False)
     verbose = getValue(p, "verbose", False)
     debug = getValue(p, "debug", False)
@@ -77,76 +108,117 @@ def clipsToFrame(p, clips, pixelData, precision=3, customClipToArrFunction=None,
     frameAlpha = getValue(globalArgs, "frameAlpha", None)
     isSequential = getValue(globalArgs, "isSequential", False)
     container = getValue(globalArgs, "container", None)
-
-    im = None
-    fileExists = filename and os.path.isfile(filename) and not overwrite
-    clipArr = None
-    returnValue = None
-
-    globalArgsCopy = globalArgs.copy()
-    globalArgsCopy["frame"] = frame
-    globalArgsCopy["debug"] = debug
-
-    if not fileExists and saveFrame or not saveFrame or isSequential:
-        clipArr = clipsToNpArr(clips, ms, width, height, precision, customClipToArrFunction=customClipToArrFunction, globalArgs=globalArgsCopy)
-
-    # frame does not exist, create frame image
-    if not fileExists:
-        im = Image.new(mode="RGBA", size=(width, height), color=(0, 0, 0, 255))
-        if preProcessingFunction is not None:
-            baseImage = preProcessingFunction(baseImage, ms, globalArgs=globalArgs)
-        if pixelData is None:
-            im = clipsToFrameOnTheFly(clips, clipArr, width, height, precision, baseImage=baseImage, globalArgs=globalArgsCopy)
-        else:
-            im = clipsToFrameGPU(clipArr, width, height, pixelData, precision, baseImage=baseImage, gpuProgram=gpuProgram, globalArgs=globalArgs)
-        im = im.convert("RGB")
-        # check to see if we're applying container-level effects
-        if container is not None:
+    lastFrame = getValue(globalArgs, "lastFrame", None)
+    frameManifest = getValue(globalArgs, "frameManifest", None)
+    tracer = getValue(globalArgs, "tracer", None)
+
+    frameSpan = traceSpan(tracer, "frame", frame=frame)
+    with frameSpan:
+        im = None
+        fileExists = filename and os.path.isfile(filename) and not overwrite
+        returnValue = None
+
+        globalArgsCopy = globalArgs.copy()
+        globalArgsCopy["frame"] = frame
+        globalArgsCopy["debug"] = debug
+
+        if clipArr is None and (not fileExists and saveFrame or not saveFrame or isSequential):
+            with traceSpan(tracer, "clip state"):
+                clipArr = getFrameClipArr(p, clips, precision, customClipToArrFunction, globalArgs)
+
+        # frames that are processed depending on their time can't be reused
+        signature = None
+        if lastFrame is not None and not fileExists and preProcessingFunction is None and postProcessingFunction is None:
             # right now we only care about blur
-            blur = container.vector.getBlur(ms)
-            if blur > 0.0:
-                im = blurImage(im, blur)
-        # check to see if there's post-processing to be done
-        if postProcessingFunction is not None:
-            im = postProcessingFunction(im, ms, globalArgs=globalArgs)
-        # save if necessary
-        if saveFrame:
-            im.save(filename)
-            print("Saved frame %s" % filename)
-        if frameAlpha is None:
-            returnValue = im
-
-    # frame has alpha, so darken for next frame
-    if frameAlpha is not None and 0.0 <= frameAlpha < 1.0:
-        if im is None:
+            containerBlur = container.vector.getBlur(ms) * scale if container is not None else 0.0
+            signature = getFrameSignature(clipArr, width, height, containerBlur)
+        previousFrame = lastFrame.get(signature, baseImage) if signature is not None else None
+
+        # nothing changed since the last frame, so reuse it
+        if previousFrame is not None:
+            previousFilename, im = previousFrame
+            frameSpan.set(reused=True)
+            if frameWriter is not None:
+                frameWriter.write(frame, im)
+            elif saveFrame and previousFilename is not None:
+                linkFile(previousFilename, filename)
+                print("Saved frame %s (same as %s)" % (filename, previousFilename))
+                if frameManifest is not None:
+                    appendToManifest(frameManifest, frame)
+            elif saveFrame:
+                saveFrameFile(im, filename, frame, frameManifest, frameSaver, tracer)
+            if frameAlpha is None:
+                returnValue = im
+
+        # frame does not exist, create frame image
+        elif not fileExists:
+            im = Image.new(mode="RGBA", size=(width, height), color=(0, 0, 0, 255))
+            if preProcessingFunction is not None:
+                baseImage = preProcessingFunction(baseImage, ms, globalArgs=globalArgs)
+            if clipLayer is not None:
+                im = compositeClipPixels(clipLayer, width, height, precision, baseImage, gpuProgram, renderSession, globalArgs)
+            elif pixelData is None:
+                im = clipsToFrameOnTheFly(clips, clipArr, width, height, precision, baseImage=baseImage, globalArgs=globalArgsCopy)
+            else:
+                im = clipsToFrameGPU(clipArr, width, height, pixelData, precision, baseImage=baseImage, gpuProgram=gpuProgram, renderSession=renderSession, globalArgs=globalArgs)
+            im = im.convert("RGB")
+            with traceSpan(tracer, "frame effects"):
+                # check to see if we're applying container-level effects
+                if container is not None:
+                    # right now we only care about blur
+                    blur = container.vector.getBlur(ms) * scale
+                    if blur > 0.0:
+                        im = blurImage(im, blur)
+                # check to see if there's post-processing to be done
+                if postProcessingFunction is not None:
+                    im = postProcessingFunction(im, ms, globalArgs=globalArgs)
+            # save if necessary
+            if frameWriter is not None:
+                with traceSpan(tracer, "stream"):
+                    frameWriter.write(frame, im)
+            elif saveFrame:
+                saveFrameFile(im, filename, frame, frameManifest, frameSaver, tracer)
+            # a frame that is still being saved can't be linked to yet
+            if signature is not None:
+                lastFrame.set(signature, baseImage, filename if frameWriter is None and frameSaver is None and saveFrame else None, im)
+            if frameAlpha is None:
+                returnValue = im
+
+        # frame was rendered by a previous run; stream it as-is
+        elif frameWriter is not None:
             im = Image.open(filename)
-        blackOverlay = Image.new(mode="RGB", size=im.size, color=(0, 0, 0))
-        im = Image.blend(im, blackOverlay, frameAlpha)
-        returnValue = im
+            frameWriter.write(frame, im)
+
+        # frame has alpha, so darken for next frame
+        if frameAlpha is not None and 0.0 <= frameAlpha < 1.0:
+            if im is None:
+                im = Image.open(filename)
+            blackOverlay = Image.new(mode="RGB", size=im.size, color=(0, 0, 0))
+            im = Image.blend(im, blackOverlay, frameAlpha)
+            returnValue = im
 
     return returnValue
 
+# only marks the frame done once it's completely saved
+def saveFrameFile(im, filename, frame, frameManifest=None, frameSaver=None, tracer=None):
+    def onSaved():
+        print("Saved frame %s" % filename)
+        if frameManifest is not None:
+            appendToManifest(frameManifest, frame)
+    if frameSaver is not None:
+        frameSaver.save(im, filename, onSaved)
+    else:
+        saveFrameImage(im, filename, tracer)
+        onSaved()
+
 def clipsToFrameOnTheFly(clips, clipArrs, width, height, precision=3, baseImage=None, globalArgs={}):
     debug = getValue(globalArgs, "debug", False)
-    vthreads = getValue(globalArgs, "vthreads", 1)
-    precisionMultiplier = int(10 ** precision)
-
-    validClips = []
-    validClipArrs = []
-    for i in range(len(clipArrs)):
-        clip = clipArrToDict(clipArrs[i], precision)
-        # only take clips that are visible
-        if clip["width"] > 0.0 and clip["height"] > 0.0 and clip["alpha"] > 0.0:
-            clip["filename"] = clips[i].props["filename"]
-            clip["t"] = clips[i].props["start"] + clips[i].props["dur"] * clip["tn"]
-            validClips.append(clip)
-            validClipArrs.append(clipArrs[i])
 
     if debug:
         if baseImage is None:
             baseImage = Image.new(mode="RGB", size=(width, height), color=(0, 0, 0))
         draw = ImageDraw.Draw(baseImage)
-        for clip in validClips:
+        for clip in getVisibleClipsOnTheFly(clips, clipArrs, precision)[0]:
             x = clip["x"]
             y = clip["y"]
             w = clip["width"]
@@ -155,130 +227,200 @@ def clipsToFrameOnTheFly(clips, clipArrs, width, height, precision=3, baseImage=
             color = (c, c, c)
             draw.rectangle([x, y, x+w, y+h], fill=color)
     else:
-        validClips = addIndices(validClips, "_index")
-        filenames = groupList(validClips, "filename")
-        threads = getThreadCount(min(len(filenames), vthreads))
+        clipLayer = gatherClipPixelsOnTheFly(clips, clipArrs, width, height, precision, globalArgs)
+        baseImage = compositeClipPixels(clipLayer, width, height, precision, baseImage, globalArgs=globalArgs)
+
+    return baseImage
+
+# reads the visible clips' frames from their source videos and gathers them like gatherClipPixels
+def gatherClipPixelsOnTheFly(clips, clipArrs, width, height, precision=3, globalArgs={}):
+    vthreads = getValue(globalArgs, "vthreads", 1)
+    validClips, validClipArrs = getVisibleClipsOnTheFly(clips, clipArrs, precision)
+    validClips = addIndices(validClips, "_index")
+    filenames = groupList(validClips, "filename")
+    threads = getThreadCount(min(len(filenames), vthreads))
+    with traceSpan(getValue(globalArgs, "tracer", None), "decode", files=len(filenames), clips=len(validClips)):
         pool = ThreadPool(threads)
-        pixelData = pool.map(samplesToPixels, filenames)
+        pixelData = pool.map(partial(samplesToPixels, readerPool=getValue(globalArgs, "readerPool", None)), filenames)
         pool.close()
         pool.join()
-        clipsPixelData = [[] for i in range(len(validClips))]
-        for pd in pixelData:
-            for i, pixels in pd:
-                clipsPixelData[i] = [pixels]
-        baseImage = clipsToFrameGPU(validClipArrs, width, height, clipsPixelData, precision, baseImage, globalArgs=globalArgs)
+    clipsPixelData = [[] for i in range(len(validClips))]
+    for pd in pixelData:
+        for i, pixels in pd:
+            clipsPixelData[i] = [pixels]
+    return gatherClipPixels(validClipArrs, width, height, clipsPixelData, precision, globalArgs=globalArgs)
 
-    return baseImage
+def getVisibleClipsOnTheFly(clips, clipArrs, precision=3):
+    validClips = []
+    validClipArrs = []
+    for i in range(len(clipArrs)):
+        clip = clipArrToDict(clipArrs[i], precision)
+        # only take clips that are visible
+        if clip["width"] > 0.0 and clip["height"] > 0.0 and clip["alpha"] > 0.0:
+            clip["filename"] = clips[i].props["filename"]
+            clip["t"] = clips[i].props["start"] + clips[i].props["dur"] * clip["tn"]
+            validClips.append(clip)
+            validClipArrs.append(clipArrs[i])
+    return (validClips, validClipArrs)
 
-def clipsToFrameGPU(clips, width, height, clipsPixelData, precision=3, baseImage=None, gpuProgram=None, globalArgs={}):
+def clipsToFrameGPU(clips, width, height, clipsPixelData, precision=3, baseImage=None, gpuProgram=None, renderSession=None, globalArgs={}):
+    clipLayer = gatherClipPixels(clips, width, height, clipsPixelData, precision, renderSession, globalArgs)
+    return compositeClipPixels(clipLayer, width, height, precision, baseImage, gpuProgram, renderSession, globalArgs)
+
+# draws the gathered clips on top of the base image
+def compositeClipPixels(clipLayer, width, height, precision=3, baseImage=None, gpuProgram=None, renderSession=None, globalArgs={}):
+    c = getValue(globalArgs, "colors", 3)
+    properties, pixelData = clipLayer
+    with traceSpan(getValue(globalArgs, "tracer", None), "composite"):
+        if renderSession is not None:
+            pixels = renderSession.render(properties, dynamicPixels=pixelData, baseImage=baseImage)
+        elif getValue(globalArgs, "backend", "opencl") == "numpy":
+            pixels = clipsToImageCPU(width, height, pixelData, properties, c, precision, baseImage=baseImage)
+        else:
+            pixels = clipsToImageGPU(width, height, pixelData, properties, c, precision, gpuProgram=gpuProgram, baseImage=baseImage)
+    return Image.fromarray(pixels, mode="RGB")
+
+# works out where each visible clip is drawn and collects the pixels that aren't already resident (resized, rotated, or blurred as needed);
+# returns the (properties, pixelData) for compositing, which doesn't depend on what they're drawn on top of
+def gatherClipPixels(clips, width, height, clipsPixelData, precision=3, renderSession=None, globalArgs={}):
     c = getValue(globalArgs, "colors", 3)
     offset = 0
     maxScaleFactor = 2.0
     precisionMultiplier = int(10 ** precision)
+    # clips whose pixels are already resident in the render session's atlas only need their offsets written
+    pixelAtlas = renderSession.pixelAtlas if renderSession is not None else None
+    effectCache = getValue(globalArgs, "effectCache", None)
+    tracer = getValue(globalArgs, "tracer", None)
+    effectHits = effectMisses = 0
 
-    # filter out clips with no pixels, or zero [width, height, alpha]
-    # keep track of how many pixels we'll need
-    indices = []
-    pixelCount = 0
-    for i in range(len(clips)):
-        clip = clipArrToDict(clips[i], precision)
-        frameCount = len(clipsPixelData[i])
-        # only take clips that are visible
-        if frameCount > 0 and clip["width"] > 0.0 and clip["height"] > 0.0 and clip["alpha"] > 0.0:
-            indices.append(i)
-            tn = clip["tn"]
-            h, w, _ = clipsPixelData[i][roundInt(tn * (frameCount-1))].shape
-            # we want to resample if scaled too much
-            scaleFactor = 1.0 * w / clip["width"]
-            if scaleFactor > maxScaleFactor:
-                w = roundInt(clip["width"])
-                h = roundInt(clip["height"])
-            # we need to resize if blurred or rotated
-            if clip["blur"] > 0.0 or clip["rotation"] % 360.0 > 0.0:
-                _x, _y, newW, newH = bboxRotate(0, 0, roundInt(clip["width"]), roundInt(clip["height"]), angle=45.0)
-                w = roundInt(newW)
-                h = roundInt(newH)
-            pixelCount += int(h*w*c)
+    clips = np.array(clips, dtype=np.int32).reshape(-1, Clip.npPropertyCount())
+    clipCount = len(clips)
+    # x, y, width, height, alpha, tn, zindex, rotation, blur, brightness
+    clipValues = clips.astype(np.float64) / precisionMultiplier
+    if pixelAtlas is not None:
+        frameCounts = pixelAtlas.clipFrameCounts
+    else:
+        frameCounts = np.array([len(clipsPixelData[i]) for i in range(clipCount)], dtype=np.int64)
 
+    # filter out clips with no pixels, or zero [width, height, alpha]
+    isDrawn = (frameCounts > 0) & (clipValues[:,2] > 0.0) & (clipValues[:,3] > 0.0) & (clipValues[:,4] > 0.0)
+    # ... and clips that are completely off the canvas, leaving room for the bigger bounding box of rotated or blurred clips
+    margins = np.where((clipValues[:,8] > 0.0) | (np.mod(clipValues[:,7], 360.0) > 0.0), clipValues[:,2] + clipValues[:,3], 0.0) + 2.0
+    isDrawn = isDrawn & (clipValues[:,0] + clipValues[:,2] + margins > 0.0) & (clipValues[:,0] - margins < width) & (clipValues[:,1] + clipValues[:,3] + margins > 0.0) & (clipValues[:,1] - margins < height)
+    indices = np.nonzero(isDrawn)[0]
     validCount = len(indices)
+    frameIndices = np.round(clipValues[indices,5] * (frameCounts[indices]-1)).astype(np.int64)
+    frameIds = None
+    if pixelAtlas is not None:
+        # use the smallest copy of each frame that is at least as big as the clip is drawn, so it rarely needs resampling
+        frameIds = pixelAtlas.getMipFrameIds(pixelAtlas.getFrameIds(indices, frameIndices), clipValues[indices,2], clipValues[indices,3])
+        shapes = pixelAtlas.frameShapes[frameIds]
+    else:
+        shapes = np.array([clipsPixelData[i][j].shape for i, j in zip(indices, frameIndices)], dtype=np.int32).reshape(-1, 3)
+
+    # we want to resample if scaled too much, and we need to resize if blurred or rotated
+    scaleFactors = shapes[:,1] / clipValues[indices,2]
+    needsProcessing = (scaleFactors > maxScaleFactor) | (clipValues[indices,8] > 0.0) | (np.mod(clipValues[indices,7], 360.0) > 0.0)
+    isResident = ~needsProcessing if pixelAtlas is not None else np.zeros(validCount, dtype=bool)
+
     propertyCount = Clip.gpuPropertyCount
     properties = np.zeros((validCount, propertyCount), dtype=np.int32)
-    pixelData = np.zeros(pixelCount, dtype=np.uint8)
-    for i, clipIndex in enumerate(indices):
-        clipArr = clips[clipIndex]
-        x, y, tw, th, alpha, t, zindex, rotation, blur, brightness = tuple(clipArr)
-        clip = clipArrToDict(clipArr, precision)
-        clipPixelData = clipsPixelData[clipIndex]
-        frameCount = len(clipPixelData)
-        tn = clip["tn"]
-        pixels = clipPixelData[roundInt(tn * (frameCount-1))]
-        h, w, _c = pixels.shape
-        # we want to resample if scaled too much
-        scaleFactor = 1.0 * w / clip["width"]
-        if scaleFactor > maxScaleFactor or clip["blur"] > 0.0 or clip["rotation"] % 360.0 > 0.0:
-            rw = roundInt(clip["width"])
-            rh = roundInt(clip["height"])
-            im = None
-            # assume we are debugging if single pixel
-            if h==1 and w==1:
-                newPixels = np.zeros((rh, rw, _c), dtype=np.uint8)
-                newPixels[:,:] = pixels[0,0]
-                im = Image.fromarray(newPixels, mode="RGB")
-            else:
-                im = Image.fromarray(pixels, mode="RGB")
-
-            # apply effects before resize for better quality
-            if clip["blur"] > 0.0 or clip["rotation"] % 360.0 > 0.0:
-                im, _x, _y = applyEffects(im, 0, 0, clip["rotation"], clip["blur"], colors=c)
-                # retrieve new coordinates based on target/resized size
-                newX, newY, newW, newH = bboxRotate(clip["x"], clip["y"], roundInt(clip["width"]), roundInt(clip["height"]), angle=45.0)
-                rw = roundInt(newW)
-                rh = roundInt(newH)
-                # x, y, tw, th changes if we rotate or blur
-                x = roundInt(newX * precisionMultiplier)
-                y = roundInt(newY * precisionMultiplier)
-                tw = roundInt(newW * precisionMultiplier)
-                th = roundInt(newH * precisionMultiplier)
-
-            # resize image
-            imW, imH = im.size
-            if imW != rw or imH != rh:
-                resampleType = Image.LANCZOS if imW > rw else Image.NEAREST
-                im = im.resize((rw, rh), resample=resampleType)
-
-            # im.save("output/test_pil.png")
-            pixels = np.array(im)
+    # [offset, x, y, w, h, tw, th, alpha, zindex, brightness]
+    properties[:,[1, 2, 5, 6, 7, 8, 9]] = clips[indices][:,[0, 1, 2, 3, 4, 6, 9]]
+    properties[:,3] = shapes[:,1]
+    properties[:,4] = shapes[:,0]
+    if pixelAtlas is not None:
+        properties[isResident,0] = pixelAtlas.frameOffsets[frameIds[isResident]]
+
+    gatherSpan = traceSpan(tracer, "gather")
+    with gatherSpan:
+        pixelChunks = []
+        dynamicOffset = renderSession.getDynamicOffset() if renderSession is not None else 0
+        for i in np.nonzero(~isResident)[0]:
+            clipIndex = indices[i]
+            x, y, tw, th, alpha, t, zindex, rotation, blur, brightness = tuple(clips[clipIndex])
+            clip = clipArrToDict(clips[clipIndex], precision)
+            pixels = pixelAtlas.getFrame(frameIds[i]) if pixelAtlas is not None else clipsPixelData[clipIndex][frameIndices[i]]
             h, w, _c = pixels.shape
-        # pixels are size 3, but need size 4
-        if c > _c:
-            fillVals = np.full((h, w, 1), 255, dtype='uint8')
-            pixels = np.concatenate((pixels, fillVals), axis=2)
-        properties[i] = np.array([offset, x, y, w, h, tw, th, alpha, zindex, brightness])
-        px0 = offset
-        px1 = px0 + int(h*w*c)
-        pixelData[px0:px1] = pixels.reshape(-1)
-        offset += int(h*w*c)
-
-    pixels = clipsToImageGPU(width, height, pixelData, properties, c, precision, gpuProgram=gpuProgram, baseImage=baseImage)
-    return Image.fromarray(pixels, mode="RGB")
+            if needsProcessing[i]:
+                rw = roundInt(clip["width"])
+                rh = roundInt(clip["height"])
+                rotation = clip["rotation"]
+                blur = clip["blur"]
+                if effectCache is not None:
+                    rotation, blur = effectCache.quantize(rotation, blur)
+                hasEffects = blur > 0.0 or rotation % 360.0 > 0.0
+                if hasEffects:
+                    # retrieve new coordinates based on target/resized size
+                    newX, newY, newW, newH = bboxRotate(clip["x"], clip["y"], roundInt(clip["width"]), roundInt(clip["height"]), angle=45.0)
+                    rw = roundInt(newW)
+                    rh = roundInt(newH)
+                    # x, y, tw, th changes if we rotate or blur
+                    x = roundInt(newX * precisionMultiplier)
+                    y = roundInt(newY * precisionMultiplier)
+                    tw = roundInt(newW * precisionMultiplier)
+                    th = roundInt(newH * precisionMultiplier)
+
+                # rotating and blurring is slow, so reuse the result if this frame has been drawn the same way before;
+                # only frames in the atlas have ids that stay the same from frame to frame
+                cacheKey = None
+                newPixels = None
+                if hasEffects and effectCache is not None and frameIds is not None:
+                    cacheKey = (frameIds[i], rotation, blur, rw, rh)
+                    newPixels = effectCache.get(cacheKey)
+
+                if cacheKey is not None:
+                    if newPixels is not None:
+                        effectHits += 1
+                    else:
+                        effectMisses += 1
+
+                if newPixels is None:
+                    with traceSpan(tracer, "effects", rotation=rotation, blur=blur, width=rw, height=rh):
+                        im = None
+                        # assume we are debugging if single pixel
+                        if h==1 and w==1:
+                            newPixels = np.zeros((rh, rw, _c), dtype=np.uint8)
+                            newPixels[:,:] = pixels[0,0]
+                            im = Image.fromarray(newPixels[:,:,:3], mode="RGB")
+                        else:
+                            im = Image.fromarray(pixels[:,:,:3], mode="RGB")
+
+                        # apply effects before resize for better quality
+                        if hasEffects:
+                            im, _x, _y = applyEffects(im, 0, 0, rotation, blur, colors=c)
+
+                        # resize image
+                        imW, imH = im.size
+                        if imW != rw or imH != rh:
+                            resampleType = Image.LANCZOS if imW > rw else Image.NEAREST
+                            im = im.resize((rw, rh), resample=resampleType)
+
+                        # im.save("output/test_pil.png")
+                        newPixels = np.array(im)
+                        if cacheKey is not None:
+                            effectCache.put(cacheKey, newPixels)
+
+                pixels = newPixels
+                h, w, _c = pixels.shape
+            # pixels are size 3, but need size 4
+            if c > _c:
+                fillVals = np.full((h, w, 1), 255, dtype='uint8')
+                pixels = np.concatenate((pixels, fillVals), axis=2)
+            properties[i] = np.array([dynamicOffset + offset, x, y, w, h, tw, th, alpha, zindex, brightness])
+            pixelChunks.append(pixels.astype(np.uint8).reshape(-1))
+            offset += int(h*w*c)
+        pixelData = np.concatenate(pixelChunks) if len(pixelChunks) > 0 else np.zeros(0, dtype=np.uint8)
+        gatherSpan.set(clips=clipCount, visible=validCount, uploaded=len(pixelChunks), uploadedBytes=offset, effectHits=effectHits, effectMisses=effectMisses)
+    traceCounter(tracer, "clips", visible=validCount, uploaded=len(pixelChunks))
+    traceCounter(tracer, "uploaded bytes", bytes=offset)
+    traceCounter(tracer, "effect cache", hits=effectHits, misses=effectMisses)
+    return (properties, pixelData)
 
 def compileFrames(infile, fps, outfile, padZeros, audioFile=None, quality="high"):
     print("Compiling frames...")
     padStr = '%0'+str(padZeros)+'d'
-
-    # https://trac.ffmpeg.org/wiki/Encode/H.264
-    # presets: veryfast, faster, fast, medium, slow, slower, veryslow
-    #   slower = better quality
-    # crf: 0 is lossless, 23 is the default, and 51 is worst possible quality
-    #   17 or 18 to be visually lossless or nearly so
-    preset = "veryslow"
-    crf = "18"
-    if quality=="medium":
-        preset = "medium"
-        crf = "23"
-    elif quality=="low":
-        preset = "medium"
-        crf = "28"
+    preset, crf = getEncodingSettings(quality)
 
     if audioFile:
         command = ['ffmpeg','-y',
@@ -342,6 +484,24 @@ def frameToMs(frame, fps, roundResult=True):
         result = roundInt(result)
     return result
 
+def getFrameClipArr(p, clips, precision=3, customClipToArrFunction=None, globalArgs={}):
+    globalArgsCopy = globalArgs.copy()
+    globalArgsCopy["frame"] = getValue(p, "frame", 1)
+    globalArgsCopy["debug"] = getValue(p, "debug", False)
+    # clips are laid out in the full size container, then scaled down with it for previews
+    scale = getValue(p, "scale", 1.0)
+    clipArr = clipsToNpArr(clips, getValue(p, "ms", 0), getValue(p, "containerWidth", p["width"]), getValue(p, "containerHeight", p["height"]), precision, customClipToArrFunction=customClipToArrFunction, globalArgs=globalArgsCopy)
+    if scale != 1.0:
+        clipArr = scaleClipArr(clipArr, scale)
+    return clipArr
+
+def scaleClipArr(clipArr, scale):
+    clipArr = np.array(clipArr, dtype=np.int32).reshape(-1, Clip.npPropertyCount())
+    # x, y, width, height, and blur
+    columns = [0, 1, 2, 3, 8]
+    clipArr[:,columns] = np.round(clipArr[:,columns] * scale).astype(np.int32)
+    return clipArr
+
 def getAlpha(clip):
     alpha = clip["alpha"] if "alpha" in clip and clip["alpha"] < 1.0 else 1.0
     return roundInt(alpha*255)
@@ -400,19 +560,12 @@ def getSolidPixels(color, width=100, height=100):
     return pixels
 
 def getVideoClipImage(video, videoDur, clip=None, t=None, resizeMode="fill", resampleType="default"):
-    videoT = clip["t"] / 1000.0 if t is None else t / 1000.0
+    videoT = getVideoSourceTime(clip["t"] if t is None else t, videoDur)
     cw = None
     ch = None
     if clip is not None:
         cw = roundInt(clip["width"])
         ch = roundInt(clip["height"])
-    delta = videoDur - videoT
-    # check if we need to loop video clip
-    if delta < 0:
-        videoT = videoT % videoDur
-    # hack: ffmpeg sometimes has trouble reading the very end of the video; choose 500ms from end
-    elif delta < 0.5:
-        videoT = videoDur - 0.5
     # a numpy array representing the RGB picture of the clip
     try:
         videoPixels = video.get_frame(videoT)
@@ -437,6 +590,33 @@ def getVideoClipImageFromFile(fn, nt=0.5):
     del video
     return image
 
+# ffmpeg filter that does the same resize/crop as image_utils.resizeImage
+def getVideoResizeFilter(w, h, mode="fill", resampleType="default"):
+    flags = {
+        Image.NEAREST: "neighbor",
+        Image.BILINEAR: "bilinear",
+        Image.BICUBIC: "bicubic"
+    }
+    flag = flags[resampleType] if resampleType in flags else "lanczos"
+    if mode=="warp":
+        return "scale=%d:%d:flags=%s" % (w, h, flag)
+    elif mode=="contain":
+        return "scale=%d:%d:force_original_aspect_ratio=decrease:flags=%s,pad=%d:%d:(ow-iw)/2:(oh-ih)/2" % (w, h, flag, w, h)
+    else:
+        return "scale=%d:%d:force_original_aspect_ratio=increase:flags=%s,crop=%d:%d" % (w, h, flag, w, h)
+
+# time in ms => time in seconds that we can actually read from the video
+def getVideoSourceTime(t, videoDur):
+    videoT = t / 1000.0
+    delta = videoDur - videoT
+    # check if we need to loop video clip
+    if delta < 0:
+        videoT = videoT % videoDur
+    # hack: ffmpeg sometimes has trouble reading the very end of the video; choose 500ms from end
+    elif delta < 0.5:
+        videoT = videoDur - 0.5
+    return videoT
+
 def getRotation(clip):
     rotation = clip["rotation"] if "rotation" in clip else 0.0
     angle = normalizeAngle(rotation)
@@ -448,12 +628,106 @@ def hasAudio(filename):
 def isVideoExtension(ext):
     return (ext in ['.mp4', '.mov', '.avi', '.wmv'])
 
-def loadVideoPixelData(clips, fps, cacheDir="tmp/", width=None, height=None, verifyData=True, cache=True, resizeMode="fill"):
+# counts frames finished by cache-building processes so the parent can report overall progress
+cacheProgressCounter = None
+
+def initCacheWorker(counter):
+    global cacheProgressCounter
+    cacheProgressCounter = counter
+
+def addCacheProgress(count, step=None, total=None):
+    if cacheProgressCounter is not None:
+        with cacheProgressCounter.get_lock():
+            cacheProgressCounter.value += count
+    elif step is not None and total is not None:
+        printProgress(step, total)
+
+# verifies one source video's frame cache and extracts whichever frames its clips are missing;
+# clipProps are the props (start, dur, maxWidth, maxHeight, resizeMode) of the clips that use this video
+def buildVideoFrameCache(fn, clipProps, fps, frameCache, legacyCacheFn=None, verifyData=True, resizeMode="fill"):
+    msStep = frameToMs(1, fps, False)
+    cacheFn = frameCache.fn
+    loaded = False
+    if cacheFn is not None:
+        loaded = len(frameCache) > 0
+        # convert caches from the old bz2-pickled format
+        if legacyCacheFn is not None and not frameCache.exists() and os.path.isfile(legacyCacheFn + ".bz2"):
+            loaded = frameCache.migrate(legacyCacheFn)
+
+    # Verify loaded data
+    if loaded and verifyData:
+        print("Verifying cache data for %s..." % cacheFn)
+        for props in clipProps:
+            start = props["start"]
+            end = start + props["dur"]
+            ms = start
+            while ms < end:
+                t = roundInt(ms)
+                ms += msStep
+                index = frameCache.getIndex(t)
+                if index is None:
+                    print("%s not found in %s. Resetting cache data" % (t, cacheFn))
+                    loaded = False
+                    break
+                clipH, clipW, _ = frameCache.getShape(index)
+                if roundInt(props["maxWidth"]) > clipW:
+                    print("Clip width is too small (%s > %s) for %s at %s. Resetting cache data" % (props["maxWidth"], clipW, cacheFn, t))
+                    loaded = False
+                    break
+                # TODO: Add check for aspect ratio?
+            if not loaded:
+                break
+        print("Verified cache data for %s" % cacheFn)
+
+    # gather every frame this file's clips need at the largest size any of them needs; frames already in the cache are kept
+    needed = {}
+    ts = set([])
+    for props in clipProps:
+        start = props["start"]
+        end = start + props["dur"]
+        clipW = roundInt(props["maxWidth"])
+        clipH = roundInt(props["maxHeight"])
+        clipResizeMode = getValue(props, "resizeMode", resizeMode)
+        ms = start
+        while ms < end:
+            t = roundInt(ms)
+            ms += msStep
+            ts.add(t)
+            if loaded or (t in needed and needed[t][1] >= clipW):
+                continue
+            # already exists, check size
+            existIndex = frameCache.getIndex(t)
+            if existIndex is not None and clipW <= frameCache.getShape(existIndex)[1]:
+                continue
+            needed[t] = (t, clipW, clipH, clipResizeMode)
+
+    requests = list(needed.values())
+    requestCount = len(requests)
+    addCacheProgress(len(ts) - requestCount)
+
+    # then extract them in one pass through the video and append them to the cache
+    if not loaded:
+        print("No cache for %s, rebuilding..." % fn)
+        for j, (index, pixels) in enumerate(streamVideoFrames(fn, requests)):
+            frameCache.append(requests[index][0], pixels)
+            addCacheProgress(1, j+1, requestCount)
+        frameCache.flush()
+
+    return frameCache
+
+# process pool entry point: builds the cache on disk and leaves loading it to the parent
+def buildVideoFrameCacheFile(p, fps, verifyData=True, resizeMode="fill", bufferSize=-1):
+    frameCache = FrameCache(p["cacheFn"], bufferSize=bufferSize)
+    buildVideoFrameCache(p["filename"], p["clipProps"], fps, frameCache, legacyCacheFn=p["legacyCacheFn"], verifyData=verifyData, resizeMode=resizeMode)
+    frameCache.close()
+    return p["filename"]
+
+def loadVideoPixelData(clips, fps, cacheDir="tmp/", width=None, height=None, verifyData=True, cache=True, resizeMode="fill", colors=3, threads=1, memoryBudget=256, mipmaps=True, scale=1.0, tracer=None):
     # load videos
     filenames = list(set([clip.props["filename"] for clip in clips]))
     fileCount = len(filenames)
     msStep = frameToMs(1, fps, False)
-    clipsPixelData = [None] * len(clips)
+    pixelAtlas = PixelAtlas(colors, clipCount=len(clips), mipmaps=mipmaps, scale=scale)
 
     for i, clip in enumerate(clips):
         if "maxWidth" in clip.props and "maxHeight" in clip.props:
@@ -465,110 +739,81 @@ def loadVideoPixelData(clips, fps, cacheDir="tmp/", width=None, height=None, ver
         if "maxHeight" not in clip.props:
             clip.setProp("maxHeight", clip.props["height"])
 
+    fileClips = {}
+    for clip in clips:
+        fileClips.setdefault(clip.props["filename"], []).append(clip)
+    jobs = []
+    for fn in filenames:
+        jobs.append({
+            "filename": fn,
+            "cacheFn": cacheDir + os.path.basename(fn) + ".frames",
+            "legacyCacheFn": cacheDir + os.path.basename(fn) + ".p",
+            "clipProps": [{key: clip.props[key] for key in ("start", "dur", "maxWidth", "maxHeight", "resizeMode") if key in clip.props} for clip in fileClips[fn]]
+        })
+
+    # build each file's cache in its own process; the caches are independent, so the parent only has to load the results
+    threads = getThreadCount(min(threads, fileCount))
+    bufferSize = int(memoryBudget * 1024 * 1024)
+    if cache and threads > 1 and fileCount > 1:
+        totalFrames = 0
+        for job in jobs:
+            ts = set([])
+            for props in job["clipProps"]:
+                ms = props["start"]
+                while ms < props["start"] + props["dur"]:
+                    ts.add(roundInt(ms))
+                    ms += msStep
+            totalFrames += len(ts)
+        print("Building frame caches for %s files in %s processes..." % (fileCount, threads))
+        with traceSpan(tracer, "build frame caches", files=fileCount, frames=totalFrames):
+            counter = multiprocessing.Value('l', 0)
+            pool = Pool(threads, initializer=initCacheWorker, initargs=(counter,), maxtasksperchild=1)
+            pbuildVideoFrameCacheFile = partial(buildVideoFrameCacheFile, fps=fps, verifyData=verifyData, resizeMode=resizeMode, bufferSize=bufferSize)
+            result = pool.map_async(pbuildVideoFrameCacheFile, jobs, chunksize=1)
+            while not result.ready():
+                result.wait(1.0)
+                printProgress(min(counter.value, totalFrames), max(totalFrames, 1))
+            result.get()
+            pool.close()
+            pool.join()
+        printProgress(1, 1)
+        print("")
+        # the caches are complete now, so don't check them again
+        verifyData = False
+
     # only open one video at a time
-    for i, fn in enumerate(filenames):
-        # check for cache fors filename
-        cacheFn = cacheDir + os.path.basename(fn) + ".p"
-        loaded = False
-        fileCacheData = []
-        if cache:
-            loaded, fileCacheData = loadCacheFile(cacheFn)
-        vclips = [c for c in clips if fn==c.props["filename"]]
-        valid = True
-
-        # Verify loaded data
-        if loaded and verifyData:
-            print("Verifying cache data for %s..." % cacheFn)
-            clipTimesSet = set(fileCacheData[0])
+    for i, job in enumerate(jobs):
+        fn = job["filename"]
+        frameCache = FrameCache(job["cacheFn"] if cache else None, bufferSize=bufferSize)
+        vclips = fileClips[fn]
+        with traceSpan(tracer, "frame cache", file=os.path.basename(fn)):
+            buildVideoFrameCache(fn, job["clipProps"], fps, frameCache, legacyCacheFn=job["legacyCacheFn"] if cache else None, verifyData=verifyData, resizeMode=resizeMode)
+
+        # pack the frames this file's clips use into the atlas; clips that share a timestamp share the frame
+        atlasSpan = traceSpan(tracer, "pack frames", file=os.path.basename(fn))
+        with atlasSpan:
+            frameIds = {}
             for clip in vclips:
                 start = clip.props["start"]
                 end = start + clip.props["dur"]
                 ms = start
+                clipFrameIds = []
                 while ms < end:
                     t = roundInt(ms)
                     ms += msStep
-                    if t not in clipTimesSet:
-                        print("%s not found in %s. Resetting cache data" % (t, cacheFn))
-                        loaded = False
-                        break
-                    index = fileCacheData[0].index(t)
-                    clipH, clipW, _ = fileCacheData[1][index].shape
-                    if roundInt(clip.props["maxWidth"]) > clipW:
-                        print("Clip width is too small (%s > %s) for %s at %s. Resetting cache data" % (clip.props["maxWidth"], clipW, cacheFn, t))
-                        loaded = False
-                        break
-                    # TODO: Add check for aspect ratio?
-                if not loaded:
-                    break
-            print("Verified cache data for %s" % cacheFn)
-
-        if not loaded:
-            print("No cache for %s, rebuilding..." % fn)
-            video = VideoFileClip(fn, audio=False)
-            videoDur = video.duration
-            clipTimes = []
-            clipPixels = []
-
-            # Already loaded cache data; append to it rather than overwrite it
-            if len(fileCacheData) > 0:
-                clipTimes, clipPixels = fileCacheData
-
-            # extract frames from videos
-            vclipCount = len(vclips)
-            for j, clip in enumerate(vclips):
-                start = clip.props["start"]
-                end = start + clip.props["dur"]
-                ms = start
-                while ms < end:
-                    fclip = clip.props.copy()
-                    fclip["width"] = fclip["maxWidth"]
-                    fclip["height"] = fclip["maxHeight"]
-                    t = roundInt(ms)
-                    ms += msStep
-                    # already exists, check size
-                    existIndex = None
-                    if t in set(clipTimes):
-                        existIndex = clipTimes.index(t)
-                        clipH, clipW, _ = clipPixels[existIndex].shape
-                        if roundInt(fclip["width"]) <= clipW:
-                            continue
-                    clipResizeMode = getValue(clip.props, "resizeMode", resizeMode)
-                    clipImg = getVideoClipImage(video, videoDur, fclip, t, clipResizeMode)
-                    if existIndex is not None:
-                        clipPixels[existIndex] = np.array(clipImg, dtype=np.uint8)
-                    else:
-                        clipTimes.append(t)
-                        clipPixels.append(np.array(clipImg, dtype=np.uint8))
-                printProgress(j+1, vclipCount)
-
-            # save cache data
-            fileCacheData = (clipTimes, clipPixels)
-
-            if cache:
-                saveCacheFile(cacheFn, fileCacheData, overwrite=True)
-
-            # close video to free up memory
-            video.reader.close()
-            del video
-
-        # assign pixel data to clips
-        for clip in vclips:
-            start = clip.props["start"]
-            end = start + clip.props["dur"]
-            ms = start
-            pixelData = []
-            while ms < end:
-                t = roundInt(ms)
-                ms += msStep
-                index = fileCacheData[0].index(t)
-                pixelData.append(fileCacheData[1][index])
-            clipsPixelData[clip.props["index"]] = pixelData
-            # clip.setProp("framePixelData", pixelData)
+                    if t not in frameIds:
+                        frameIds[t] = pixelAtlas.addFrame(frameCache.getFrame(frameCache.getIndex(t)))
+                    clipFrameIds.append(frameIds[t])
+                pixelAtlas.setClipFrames(clip.props["index"], clipFrameIds)
+            atlasSpan.set(clips=len(vclips), frames=len(frameIds))
+        frameCache.close()
 
         printProgress(i+1, fileCount)
 
+    pixelAtlas.finalize()
+
     print("Finished loading pixel data.")
-    return clipsPixelData
+    return pixelAtlas
 
 def loadVideoPixelDataDebug(clipCount):
     clipsPixelData = np.zeros((clipCount, 1, 1, 1, 3))
@@ -576,6 +821,86 @@ def loadVideoPixelDataDebug(clipCount):
         clipsPixelData[i, 0, 0, 0] = getRandomColor(i)
     return clipsPixelData
 
+# every time a clip's size, position, or visibility could change direction, i.e. its and its parents' keyframes
+def getClipBreakpoints(clips):
+    names = set(["pos", "size", "scale", "translate", "alpha"])
+    breakpoints = set([])
+    vectors = {}
+    for clip in clips:
+        v = clip.vector
+        while v is not None and id(v) not in vectors:
+            vectors[id(v)] = v
+            v = v.parent
+    for v in vectors.values():
+        breakpoints.update([k["ms"] for k in v.keyframes if k["name"] in names])
+    return sorted(breakpoints)
+
+# Each clip's widest visible width across the frames, without evaluating every clip at every frame:
+# between keyframes, eased tweens only move one way, so a clip is widest at one end of the frames it is visible for.
+# Check the frames either side of every keyframe plus a frame every sampleSeconds, and wherever a clip appears or disappears
+# between two checked frames, bisect to the frame where it does. A clip that is only visible between two checked frames is missed,
+# and custom clip functions can do anything, so for those this is a best guess; set sampleSeconds to 0 to check every frame
+def getClipWidthMaxes(frames, clips, containerW, containerH, fps, precision=3, customClipToArrFunction=None, sampleSeconds=0.5, sampleMargin=0.02, globalArgs={}):
+    clipWidthMaxes = np.zeros(len(clips), dtype=np.int32)
+    frameMs = sorted([frame["ms"] for frame in frames])
+    frameCount = len(frameMs)
+    if frameCount <= 0:
+        return clipWidthMaxes
+
+    step = roundInt(sampleSeconds * fps)
+    if step <= 1:
+        positions = set(range(frameCount))
+    else:
+        positions = set(range(0, frameCount, step))
+        positions.add(frameCount-1)
+        for ms in getClipBreakpoints(clips):
+            i = bisect_left(frameMs, ms)
+            positions.update([j for j in (i-1, i) if 0 <= j < frameCount])
+    positions = sorted(positions)
+
+    # widths regardless of visibility, and which clips are visible, so we can tell which clips could be wider between two frames;
+    # custom clip functions need the container's size to lay clips out though, and hide the clips that are off of it
+    precisionMultiplier = int(10 ** precision)
+    clipsW, clipsH = (containerW, containerH) if customClipToArrFunction is not None else (None, None)
+    def getWidths(i):
+        clipArr = clipsToNpArr(clips, frameMs[i], clipsW, clipsH, precision, customClipToArrFunction=customClipToArrFunction, globalArgs=globalArgs).astype(np.int64)
+        x, y, widths, heights, alphas = tuple([clipArr[:,j] for j in range(5)])
+        visible = (x+widths > 0) & (y+heights > 0) & (x < containerW*precisionMultiplier) & (y < containerH*precisionMultiplier) & (alphas > 0)
+        np.maximum(clipWidthMaxes, np.where(visible, widths, 0), out=clipWidthMaxes)
+        return (widths, visible)
+
+    # a clip that only appears (or disappears) between two frames is widest where it does if it is wider at the end where it's not visible
+    def refine(i0, frame0, i1, frame1):
+        widths0, visible0 = frame0
+        widths1, visible1 = frame1
+        if i1 - i0 <= 1:
+            return 0
+        hiddenWidths = np.where(visible0, widths1, widths0)
+        shownWidths = np.where(visible0, widths0, widths1)
+        if not np.any((visible0 != visible1) & (hiddenWidths > shownWidths) & (hiddenWidths > clipWidthMaxes)):
+            return 0
+        i = int((i0 + i1) / 2)
+        frame = getWidths(i)
+        return 1 + refine(i0, frame0, i, frame) + refine(i, frame, i1, frame1)
+
+    refined = 0
+    prevPosition = positions[0]
+    prevFrame = getWidths(prevPosition)
+    for j, position in enumerate(positions[1:]):
+        frame = getWidths(position)
+        refined += refine(prevPosition, prevFrame, position, frame)
+        prevPosition = position
+        prevFrame = frame
+        printProgress(j+2, len(positions))
+    print("")
+    checked = len(positions) + refined
+    print("Checked %s of %s frames" % (formatNumber(checked), formatNumber(frameCount)))
+    # frames that weren't checked can still be a little wider (e.g. where the container and a clip scale in opposite directions, or with
+    # custom clip functions), so leave some room rather than caching those clips smaller than they're drawn
+    if checked < frameCount and sampleMargin > 0:
+        clipWidthMaxes = np.ceil(clipWidthMaxes * (1.0 + sampleMargin)).astype(np.int32)
+    return clipWidthMaxes
+
 def loadVideoPixelDataFromFrames(frames, clips, containerW, containerH, fps, cacheDir="tmp/", cacheKey="sample", verifyData=True, cache=True, debug=False, precision=3, customClipToArrFunction=None, customClipToArrCalcFunction=None, globalArgs={}):
     frameCount = len(frames)
     clipCount = len(clips)
@@ -595,22 +920,16 @@ def loadVideoPixelDataFromFrames(frames, clips, containerW, containerH, fps, cac
 
     if not loaded or len(clipWidthMaxes) != clipCount or recalculateClipSizes:
         print("Calculating clip size/position from frame sequence...")
-        clipWidthMaxes = np.zeros(clipCount, dtype=np.int32)
-        clipCompare = np.zeros((2, clipCount), dtype=np.int32)
         ccfunction = customClipToArrFunction
         # override custom clip arr function for calcuation
         if customClipToArrCalcFunction is "default":
             ccfunction = None
         elif customClipToArrCalcFunction is not None:
             ccfunction = customClipToArrCalcFunction
-        for i, frame in enumerate(frames):
-            ms = frame["ms"]
-            # frameClips = clipsToDictsGPU(clips, ms, container, precision)
-            frameClips = clipsToNpArr(clips, ms, containerW, containerH, precision, customClipToArrFunction=ccfunction, globalArgs=globalArgs)
-            clipCompare[0] = clipWidthMaxes
-            clipCompare[1] = frameClips[:,2] # just take the width (2)
-            clipWidthMaxes = np.amax(clipCompare, axis=0)
-            printProgress(i+1, frameCount)
+        if ccfunction is None:
+            globalArgs = addClipBatch(clips, globalArgs)
+        with traceSpan(getValue(globalArgs, "tracer", None), "clip sizes"):
+            clipWidthMaxes = getClipWidthMaxes(frames, clips, containerW, containerH, fps, precision, ccfunction, getValue(globalArgs, "sizeSample", 0.5), globalArgs=globalArgs)
         if cache:
             saveCacheFile(cacheDir+cacheFile, clipWidthMaxes, overwrite=True)
 
@@ -632,7 +951,7 @@ def loadVideoPixelDataFromFrames(frames, clips, containerW, containerH, fps, cac
         clip.setProp("maxHeight", height)
         # print("%s, %s" % (clip.props["width"], clip.props["height"]))
 
-    clipsPixelData = loadVideoPixelData(clips, fps, cacheDir=cacheDir, verifyData=verifyData, cache=cache, resizeMode=resizeMode)
+    clipsPixelData = loadVideoPixelData(clips, fps, cacheDir=cacheDir, verifyData=verifyData, cache=cache, resizeMode=resizeMode, colors=getValue(globalArgs, "colors", 3), threads=getValue(globalArgs, "cachethreads", 1), memoryBudget=getValue(globalArgs, "cachemem", 256), mipmaps=getValue(globalArgs, "mipmaps", True), scale=getValue(globalArgs, "previewScale", 1.0), tracer=getValue(globalArgs, "tracer", None))
 
     return clipsPixelData
 
@@ -642,17 +961,105 @@ def msToFrame(ms, fps):
 def parseVideoArgs(args):
     d = vars(args)
     d["THREADS"] = min(args.THREADS, multiprocessing.cpu_count()) if args.THREADS > 0 else multiprocessing.cpu_count()
+    if "PROCESSES" in d:
+        d["PROCESSES"] = min(args.PROCESSES, multiprocessing.cpu_count()) if args.PROCESSES > 0 else multiprocessing.cpu_count()
+    if "CACHE_THREADS" in d:
+        d["CACHE_THREADS"] = min(args.CACHE_THREADS, multiprocessing.cpu_count()) if args.CACHE_THREADS > 0 else multiprocessing.cpu_count()
     d["AUDIO_OUTPUT_FILE"] = args.OUTPUT_FILE.replace(".mp4", ".mp3")
+    # previews share the audio with the full render, but not its frames or video
+    if "PREVIEW" in d:
+        d["PREVIEW"] = args.PREVIEW if 0.0 < args.PREVIEW < 1.0 else 1.0
+        if d["PREVIEW"] < 1.0:
+            d["OUTPUT_FILE"] = appendToBasename(args.OUTPUT_FILE, "_preview")
+            d["OUTPUT_FRAME"] = appendToBasename(args.OUTPUT_FRAME, "_preview")
     d["MS_PER_FRAME"] = frameToMs(1, args.FPS, False)
     d["CACHE_VIDEO"] = args.CACHE_VIDEO
     d["VOLUME_RANGE"] = tuple([float(v) for v in args.VOLUME_RANGE.strip().split(",")]) if "VOLUME_RANGE" in d else (0.0, 1.0)
     d["ALPHA_RANGE"] =  tuple([float(v) for v in args.ALPHA_RANGE.strip().split(",")])
     d["BRIGHTNESS_RANGE"] =  tuple([float(v) for v in args.BRIGHTNESS_RANGE.strip().split(",")])
     d["FRAME_RANGE"] =  tuple([int(v) for v in args.FRAME_RANGE.strip().split(",")])
+    if "SHARD" in d:
+        d["SHARD"] = parseShard(args.SHARD) if len(args.SHARD.strip()) > 0 else None
     d["VIDEO_THREADS"] = args.VIDEO_THREADS if "VIDEO_THREADS" in d else 1
     if args.OUTPUT_SINGLE_FRAME > 0:
         d["VIDEO_ONLY"] = True
 
+def createRenderSession(width, height, colorDimensions, precision, backend="opencl", gpuProgram=None, pixelAtlas=None):
+    if backend == "numpy":
+        renderSession = CPURenderSession(width, height, colorDimensions, precision)
+    else:
+        renderSession = GPURenderSession(width, height, colorDimensions, precision, gpuProgram=gpuProgram)
+    if pixelAtlas is not None:
+        renderSession.setPixelData(pixelAtlas.data, pixelAtlas)
+    return renderSession
+
+# per-process state for the process pools in processFrames; set once when each worker starts
+renderWorkerState = {}
+
+def initClipArrWorker(clips, precision, customClipToArrFunction, globalArgs):
+    renderWorkerState.update({
+        "clips": clips,
+        "precision": precision,
+        "customClipToArrFunction": customClipToArrFunction,
+        "globalArgs": globalArgs
+    })
+
+def initRenderWorker(clips, pixelAtlas, sharedMemoryName, precision, customClipToArrFunction, postProcessingFunction, preProcessingFunction, collectFrames, globalArgs):
+    initClipArrWorker(clips, precision, customClipToArrFunction, globalArgs)
+    p0 = globalArgs["_firstFrame"]
+    colorDimensions = getValue(globalArgs, "colors", 3)
+    backend = getValue(globalArgs, "backend", "opencl")
+    gpuProgram = None
+    if backend != "numpy":
+        gpuProgram = loadMakeImageProgram(p0["width"], p0["height"], Clip.gpuPropertyCount, colorDimensions, precision)
+    renderSession = None
+    if pixelAtlas is not None:
+        # attach to the parent's copy of the pixels rather than receiving our own
+        if sharedMemoryName is not None:
+            sharedMemory = shared_memory.SharedMemory(name=sharedMemoryName)
+            pixelAtlas.data = np.ndarray((pixelAtlas.size,), dtype=np.uint8, buffer=sharedMemory.buf)
+            renderWorkerState["sharedMemory"] = sharedMemory
+        renderSession = createRenderSession(p0["width"], p0["height"], colorDimensions, precision, backend, gpuProgram, pixelAtlas)
+    # each worker gets its own copy of the reader pool; close its readers when the worker exits rather than leaving ffmpeg running
+    readerPool = getValue(globalArgs, "readerPool", None)
+    if readerPool is not None:
+        Finalize(readerPool, readerPool.close, exitpriority=10)
+    renderWorkerState.update({
+        "pixelData": pixelAtlas,
+        "gpuProgram": gpuProgram,
+        "renderSession": renderSession,
+        "postProcessingFunction": postProcessingFunction,
+        "preProcessingFunction": preProcessingFunction,
+        "collectFrames": collectFrames
+    })
+
+def frameToClipArr(p):
+    s = renderWorkerState
+    return getFrameClipArr(p, s["clips"], s["precision"], s["customClipToArrFunction"], s["globalArgs"])
+
+# renders a contiguous range of frames in a worker process; returns the frames themselves if the parent is streaming them
+def renderFrameRange(params):
+    s = renderWorkerState
+    frameCollector = FrameCollector() if s["collectFrames"] else None
+    for p in params:
+        clipsToFrame(p, clips=s["clips"], pixelData=s["pixelData"], precision=s["precision"], customClipToArrFunction=s["customClipToArrFunction"], baseImage=getValue(s["globalArgs"], "baseImage", None), gpuProgram=s["gpuProgram"], postProcessingFunction=s["postProcessingFunction"], preProcessingFunction=s["preProcessingFunction"], renderSession=s["renderSession"], frameWriter=frameCollector, globalArgs=s["globalArgs"])
+    return frameCollector.frames if frameCollector is not None else []
+
+# everything about rendering a sequential frame that doesn't depend on the frame before it: where its clips are and their pixels
+def prepareFrame(item, clips, pixelData, precision=3, customClipToArrFunction=None, renderSession=None, globalArgs={}):
+    p, clipArr = item
+    clipLayer = None
+    if clipArr is None:
+        with traceSpan(getValue(globalArgs, "tracer", None), "clip state", frame=getValue(p, "frame", 1)):
+            clipArr = getFrameClipArr(p, clips, precision, customClipToArrFunction, globalArgs)
+    fileExists = p["filename"] and os.path.isfile(p["filename"]) and not getValue(p, "overwrite", False)
+    if not fileExists:
+        if pixelData is not None:
+            clipLayer = gatherClipPixels(clipArr, p["width"], p["height"], pixelData, precision, renderSession, globalArgs)
+        elif not getValue(p, "debug", False):
+            clipLayer = gatherClipPixelsOnTheFly(clips, clipArr, p["width"], p["height"], precision, globalArgs)
+    return (p, clipArr, clipLayer)
+
 def processFrames(params, clips, clipsPixelData, threads=1, precision=3, verbose=True, customClipToArrFunction=None, postProcessingFunction=None, preProcessingFunction=None, globalArgs={}):
     if len(params) < 1:
         return
@@ -660,6 +1067,8 @@ def processFrames(params, clips, clipsPixelData, threads=1, precision=3, verbose
     count = len(params)
     print("Processing %s frames" % count)
     threads = getThreadCount(threads)
+    procs = getValue(globalArgs, "procs", 1)
+    procs = getThreadCount(procs) if procs > 1 else 1
 
     frameAlpha = getValue(globalArgs, "frameAlpha", 1.0)
     isSequential = getValue(globalArgs, "isSequential", False)
@@ -668,35 +1077,257 @@ def processFrames(params, clips, clipsPixelData, threads=1, precision=3, verbose
     if propagateFrames:
         isSequential = True
 
-    # load gpu program
     p0 = params[0]
     colorDimensions = getValue(globalArgs, "colors", 3)
+    backend = getRenderBackend(getValue(globalArgs, "backend", "opencl"))
+    if backend != getValue(globalArgs, "backend", "opencl"):
+        globalArgs = dict(globalArgs, backend=backend)
+
+    # calculate every clip's properties in one go per frame
+    if customClipToArrFunction is None:
+        globalArgs = addClipBatch(clips, globalArgs)
+
+    # reuse the last frame when the next one is drawn from exactly the same clips
+    if getValue(globalArgs, "reuseFrames", True) and "lastFrame" not in globalArgs:
+        globalArgs = globalArgs.copy()
+        globalArgs["lastFrame"] = LastFrame()
+
+    # remember rotated and blurred clip frames between frames
+    effectCache = None
+    effectMemory = getValue(globalArgs, "effectmem", 256)
+    if effectMemory > 0 and "effectCache" not in globalArgs:
+        effectCache = EffectCache(int(effectMemory * 1024 * 1024), rotationStep=getValue(globalArgs, "rotationStep", 0.0), blurStep=getValue(globalArgs, "blurStep", 0.0))
+        globalArgs = globalArgs.copy()
+        globalArgs["effectCache"] = effectCache
+
+    # frames rendered on the fly read their clips' pixels from video readers that are kept open between frames
+    readerPool = None
+    maxReaders = getValue(globalArgs, "maxReaders", 32)
+    if clipsPixelData is None and maxReaders > 0 and "readerPool" not in globalArgs:
+        readerPool = VideoReaderPool(maxReaders)
+        globalArgs = globalArgs.copy()
+        globalArgs["readerPool"] = readerPool
+
+    pixelAtlas = None
+    if clipsPixelData is not None:
+        pixelAtlas = clipsPixelData
+        if not isinstance(pixelAtlas, PixelAtlas) or pixelAtlas.colors != colorDimensions:
+            pixelAtlas = PixelAtlas.fromClipsPixelData(clipsPixelData, colorDimensions, mipmaps=getValue(globalArgs, "mipmaps", True))
+        # the kernel addresses pixels with 32-bit offsets, so larger atlases are packed per frame instead
+        if pixelAtlas.size >= np.iinfo(np.int32).max:
+            print("Warning: pixel data is too large (%s bytes) to keep resident; packing it per frame" % formatNumber(pixelAtlas.size))
+            pixelAtlas = None
+
+    if procs > 1 and pixelAtlas is not None and shared_memory is None:
+        print("Warning: multiprocessing.shared_memory is not available (Python 3.8+), so rendering frames in one process")
+        procs = 1
+    elif procs > 1 and clipsPixelData is not None and pixelAtlas is None:
+        procs = 1
+
+    # pipe frames straight to an encoder rather than saving images
+    frameWriter = None
+    streamOutput = getValue(globalArgs, "streamOutput", None)
+    if streamOutput is not None:
+        frameWriter = FrameWriter(streamOutput["filename"], p0["width"], p0["height"], streamOutput["fps"], audioFile=getValue(streamOutput, "audioFile", None), quality=getValue(streamOutput, "quality", "high"), startFrame=getValue(p0, "frame", 1), maxBuffer=max(threads, procs)*4)
+
+    # render independent ranges of frames in separate processes; workers get the clips once when they start
+    # and attach to the clip pixels through shared memory
+    if procs > 1 and not isSequential:
+        sharedMemory = None
+        workerAtlas = None
+        pool = None
+        finished = False
+        # the shared pixels can be as big as the whole atlas, so they (and the workers) are cleaned up however rendering ends
+        try:
+            if pixelAtlas is not None:
+                workerAtlas = copy.copy(pixelAtlas)
+                workerAtlas.data = None
+                if pixelAtlas.size > 0:
+                    sharedMemory = shared_memory.SharedMemory(create=True, size=pixelAtlas.size)
+                    np.ndarray((pixelAtlas.size,), dtype=np.uint8, buffer=sharedMemory.buf)[:] = pixelAtlas.data
+            workerArgs = globalArgs.copy()
+            workerArgs["_firstFrame"] = p0
+            rangeSize = max(1, ceilInt(1.0 * count / (procs * 4)))
+            ranges = [params[i:i+rangeSize] for i in range(0, count, rangeSize)]
+            print("Rendering %s frames in %s processes..." % (count, procs))
+            pool = Pool(procs, initializer=initRenderWorker, initargs=(clips, workerAtlas, sharedMemory.name if sharedMemory is not None else None, precision, customClipToArrFunction, postProcessingFunction, preProcessingFunction, frameWriter is not None, workerArgs))
+            completed = 0
+            for frames in pool.imap(renderFrameRange, ranges):
+                for frame, pixels in frames:
+                    frameWriter.write(frame, pixels)
+                completed += 1
+                if verbose:
+                    printProgress(completed, len(ranges))
+            finished = True
+        finally:
+            if pool is not None:
+                if finished:
+                    pool.close()
+                else:
+                    pool.terminate()
+                pool.join()
+            if sharedMemory is not None:
+                sharedMemory.close()
+                sharedMemory.unlink()
+        if frameWriter is not None:
+            frameWriter.close()
+        if effectCache is not None:
+            effectCache.printStats()
+        if readerPool is not None:
+            readerPool.printStats()
+        return
+
+    # sequential frames can't be rendered out of order, but the clip positions for upcoming frames can be calculated in other processes
+    clipArrs = None
+    clipArrPool = None
+    if procs > 1:
+        print("Calculating clip positions in %s processes..." % procs)
+        clipArrPool = Pool(procs, initializer=initClipArrWorker, initargs=(clips, precision, customClipToArrFunction, globalArgs))
+        clipArrs = clipArrPool.imap(frameToClipArr, params, chunksize=max(1, min(8, int(count / (procs * 4)))))
+
+    # load gpu program
     pcount = Clip.gpuPropertyCount
-    gpuProgram = loadMakeImageProgram(p0["width"], p0["height"], pcount, colorDimensions, precision)
+    gpuProgram = None
+    if backend != "numpy":
+        gpuProgram = loadMakeImageProgram(p0["width"], p0["height"], pcount, colorDimensions, precision)
+
+    # upload all the clip pixels to the device once and reuse them for every frame
+    renderSession = None
+    if clipsPixelData is not None:
+        renderSession = createRenderSession(p0["width"], p0["height"], colorDimensions, precision, backend, gpuProgram, pixelAtlas)
 
     if threads > 1 and not isSequential:
         pool = ThreadPool(threads)
-        pclipsToFrame = partial(clipsToFrame, clips=clips, pixelData=clipsPixelData, precision=precision, customClipToArrFunction=customClipToArrFunction, baseImage=baseImage, gpuProgram=gpuProgram, postProcessingFunction=postProcessingFunction, preProcessingFunction=preProcessingFunction, globalArgs=globalArgs)
+        pclipsToFrame = partial(clipsToFrame, clips=clips, pixelData=clipsPixelData, precision=precision, customClipToArrFunction=customClipToArrFunction, baseImage=baseImage, gpuProgram=gpuProgram, postProcessingFunction=postProcessingFunction, preProcessingFunction=preProcessingFunction, renderSession=renderSession, frameWriter=frameWriter, globalArgs=globalArgs)
         pool.map(pclipsToFrame, params)
         pool.close()
         pool.join()
     else:
+        items = ((p, next(clipArrs) if clipArrs is not None else None) for p in params)
+        frames = ((p, clipArr, None) for p, clipArr in items)
+        frameSaver = None
+        # only compositing onto the previous frame has to happen in order: clip positions and pixels for upcoming frames are
+        # gathered in other threads ahead of time, and finished frames are saved in others while the next one is composited
+        if threads > 1:
+            pprepareFrame = partial(prepareFrame, clips=clips, pixelData=clipsPixelData, precision=precision, customClipToArrFunction=customClipToArrFunction, renderSession=renderSession, globalArgs=globalArgs)
+            frames = imapOrdered(pprepareFrame, items, threads, threads * 2)
+            if frameWriter is None:
+                frameSaver = FrameSaver(threads, tracer=getValue(globalArgs, "tracer", None))
         prevImage = None
-        for i, p in enumerate(params):
+        for i, (p, clipArr, clipLayer) in enumerate(frames):
             baseImage = prevImage if propagateFrames else baseImage
-            prevImage = clipsToFrame(p, clips=clips, pixelData=clipsPixelData, precision=precision, customClipToArrFunction=customClipToArrFunction, baseImage=baseImage, gpuProgram=gpuProgram, postProcessingFunction=postProcessingFunction, preProcessingFunction=preProcessingFunction, globalArgs=globalArgs)
+            prevImage = clipsToFrame(p, clips=clips, pixelData=clipsPixelData, precision=precision, customClipToArrFunction=customClipToArrFunction, baseImage=baseImage, gpuProgram=gpuProgram, postProcessingFunction=postProcessingFunction, preProcessingFunction=preProcessingFunction, renderSession=renderSession, frameWriter=frameWriter, clipArr=clipArr, clipLayer=clipLayer, frameSaver=frameSaver, globalArgs=globalArgs)
             if verbose:
                 printProgress(i+1, count)
+        if frameSaver is not None:
+            frameSaver.close()
 
-def samplesToPixels(f):
-    video = VideoFileClip(f["filename"], audio=False)
-    videoDur = video.duration
+    if clipArrPool is not None:
+        clipArrPool.close()
+        clipArrPool.join()
+
+    if frameWriter is not None:
+        frameWriter.close()
+
+    if effectCache is not None:
+        effectCache.printStats()
+
+    if readerPool is not None:
+        readerPool.close()
+        readerPool.printStats()
+
+def samplesToPixels(f, readerPool=None):
     fclips = f["items"]
     pixelData = [0 for i in range(len(fclips))]
-    for i, fclip in enumerate(fclips):
-        clipImg = getVideoClipImage(video, videoDur, {"width": ceilInt(fclip["width"]), "height": ceilInt(fclip["height"]), "t": fclip["t"]})
-        pixels = np.array(clipImg)
-        pixelData[i] = (fclip["_index"], pixels)
-    video.reader.close()
-    del video
+    requests = [(fclip["t"], ceilInt(fclip["width"]), ceilInt(fclip["height"]), "fill") for fclip in fclips]
+    # read from readers that stay open between frames
+    if readerPool is not None:
+        videoDur = readerPool.getDuration(f["filename"])
+        frames = readerPool.getFrames(f["filename"], [getVideoSourceTime(t, videoDur) for t, w, h, resizeMode in requests])
+        for i, pixels in enumerate(frames):
+            t, w, h, resizeMode = requests[i]
+            clipImg = resizeImage(Image.fromarray(pixels, mode="RGB"), w, h, resizeMode)
+            pixelData[i] = (fclips[i]["_index"], np.array(clipImg, dtype=np.uint8))
+        return pixelData
+    for i, pixels in streamVideoFrames(f["filename"], requests):
+        pixelData[i] = (fclips[i]["_index"], pixels)
     return pixelData
+
+# Decode every requested frame of a video in a single, in-order pass through an ffmpeg rawvideo pipe rather than seeking for each one;
+# requests is a list of (t, width, height, resizeMode) where t is in ms and width/height are None for the video's own size.
+# Yields (requestIndex, pixels) in the order the frames are decoded. Frames are chosen the same way moviepy's get_frame chooses them.
+def streamVideoFrames(fn, requests, resampleType="default", maxSkipFrames=100):
+    if len(requests) <= 0:
+        return
+
+    infos = ffmpeg_parse_infos(fn)
+    fps = infos["video_fps"]
+    videoDur = infos["video_duration"]
+    videoW, videoH = infos["video_size"]
+
+    entries = []
+    for i, (t, w, h, resizeMode) in enumerate(requests):
+        videoT = getVideoSourceTime(t, videoDur)
+        frame = int(fps * videoT + 0.00001)
+        entries.append((frame, videoT, i))
+    entries = sorted(entries)
+
+    # if every request wants the same size, let ffmpeg do the resizing; otherwise, decode at full size and resize each frame ourselves
+    targets = set([(t[1] if t[1] is None else roundInt(t[1]), t[2] if t[2] is None else roundInt(t[2]), t[3]) for t in requests])
+    outW, outH = (videoW, videoH)
+    vf = "scale=%d:%d" % (videoW, videoH)
+    scaleInFFmpeg = False
+    if len(targets) == 1:
+        targetW, targetH, targetMode = list(targets)[0]
+        if targetW is not None and targetH is not None:
+            outW, outH = (targetW, targetH)
+            vf = getVideoResizeFilter(targetW, targetH, targetMode, resampleType)
+            scaleInFFmpeg = True
+    frameSize = outW * outH * 3
+
+    # merge requests into runs that can be read straight through; only seek again if the next frame is far away
+    segments = []
+    for entry in entries:
+        if len(segments) <= 0 or (entry[0] - segments[-1][-1][0]) > maxSkipFrames:
+            segments.append([])
+        segments[-1].append(entry)
+
+    for segment in segments:
+        # ffmpeg's seeking can land a frame either side of where we ask, so seek a bit early
+        # and let the trim filter drop everything before the first frame we need
+        startT = max(0, (segment[0][0] - 0.5) / fps)
+        seekT = max(0, startT - 1.0)
+        inputArgs = ['-i', fn]
+        if seekT > 0:
+            inputArgs = ['-ss', "%.06f" % seekT, '-i', fn]
+        segmentVf = "trim=start=%.06f,%s" % (startT - seekT, vf)
+        command = ['ffmpeg'] + inputArgs + ['-loglevel', 'error', '-f', 'image2pipe', '-vsync', '0', '-vf', segmentVf, '-pix_fmt', 'rgb24', '-vcodec', 'rawvideo', '-']
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL, bufsize=frameSize+100)
+
+        # stop ffmpeg even if whoever is reading the frames fails or stops early
+        try:
+            pos = segment[0][0] - 1
+            pixels = None
+            for frame, videoT, i in segment:
+                while pos < frame:
+                    data = proc.stdout.read(frameSize)
+                    pos += 1
+                    # past the end of what ffmpeg could give us; keep using the last frame
+                    if len(data) < frameSize:
+                        pos = frame
+                        break
+                    pixels = np.frombuffer(data, dtype=np.uint8).reshape(outH, outW, 3)
+                t, w, h, resizeMode = requests[i]
+                if pixels is None:
+                    print("Could not read pixels for %s at time %s" % (fn, videoT))
+                    blankW, blankH = (outW, outH) if w is None or h is None else (roundInt(w), roundInt(h))
+                    yield (i, np.zeros((blankH, blankW, 3), dtype=np.uint8))
+                elif scaleInFFmpeg or w is None or h is None:
+                    yield (i, pixels)
+                else:
+                    clipImg = resizeImage(Image.fromarray(pixels, mode="RGB"), w, h, resizeMode, resampleType)
+                    yield (i, np.array(clipImg, dtype=np.uint8))
+        finally:
+            proc.stdout.close()
+            proc.terminate()
+            proc.wait()
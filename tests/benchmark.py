@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+# Rendering benchmark that doesn't need any downloaded media: generates synthetic source videos and sample sheets,
+# then renders each composition at several sizes and records how fast each step was
+#   python3 tests/benchmark.py -backend numpy                       # save a baseline
+#   python3 tests/benchmark.py -backend numpy -compare              # compare against the saved baseline
+#   python3 tests/benchmark.py -scales 256 -comps proliferation     # just one case
+# Steps are timed from each render's -trace output: building the frame cache and calculating clip sizes (on a cold cache),
+# rendering a short sequence from the middle of the composition, and rendering a single frame (on a warm cache)
+
+import argparse
+import inspect
+import math
+import os
+from pprint import pprint
+import random
+import re
+import subprocess
+import sys
+import time
+
+# add parent directory to sys path to import relative modules
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+from lib.io_utils import *
+from lib.math_utils import *
+from lib.processing_utils import *
+
+# input
+parser = argparse.ArgumentParser()
+parser.add_argument('-scales', dest="SCALES", default="256,4096,16384", help="Comma-separated list of clip counts; each must be a square number")
+parser.add_argument('-comps', dest="COMPOSITIONS", default="proliferation,shuffle,orbits,waves,stretch,flow,falling,splice", help="Comma-separated list of compositions to benchmark")
+parser.add_argument('-dir', dest="WORK_DIR", default="tmp/benchmark/", help="Directory for the synthetic media, caches, and rendered frames")
+parser.add_argument('-baseline', dest="BASELINE_FILE", default="output/benchmark_baseline.json", help="Baseline file to save to or compare against")
+parser.add_argument('-compare', dest="COMPARE", action="store_true", help="Compare against the baseline instead of saving a new one?")
+parser.add_argument('-tolerance', dest="TOLERANCE", default=0.15, type=float, help="How much worse than the baseline a result can be before it is flagged, e.g. 0.15 for 15%")
+parser.add_argument('-videos', dest="VIDEO_COUNT", default=8, type=int, help="Number of synthetic source videos")
+parser.add_argument('-vdur', dest="VIDEO_DURATION", default=60, type=int, help="Duration of each synthetic source video in seconds")
+parser.add_argument('-vsize', dest="VIDEO_SIZE", default="320x180", help="Size of the synthetic source videos")
+parser.add_argument('-frames', dest="SEQUENCE_FRAMES", default=48, type=int, help="Number of frames in the rendered sequence")
+parser.add_argument('-width', dest="WIDTH", default=1280, type=int, help="Output video width")
+parser.add_argument('-height', dest="HEIGHT", default=720, type=int, help="Output video height")
+parser.add_argument('-fps', dest="FPS", default=24, type=int, help="Output video frames per second")
+parser.add_argument('-backend', dest="BACKEND", default="opencl", help="Backend for compositing clips: opencl or numpy")
+parser.add_argument('-args', dest="EXTRA_ARGS", default="", help="Any other arguments to pass to every render, e.g. \"-procs 4\"")
+parser.add_argument('-seed', dest="RANDOM_SEED", default=3, type=int, help="Seed for generating the sample sheets")
+a = parser.parse_args()
+
+SCALES = [int(v) for v in a.SCALES.strip().split(",")]
+COMPOSITIONS = [v.strip() for v in a.COMPOSITIONS.strip().split(",")]
+# renders run from the repository's directory
+WORK_DIR = os.path.abspath(a.WORK_DIR)
+MEDIA_DIR = os.path.join(WORK_DIR, "media/")
+makeDirectories([MEDIA_DIR, a.BASELINE_FILE])
+
+# the start and end grid of each composition as a fraction of the full grid; the larger of the two must be the full grid
+# or the composition will only use some of the clips
+GRID_RATIOS = {
+    "proliferation": (1.0/8, 1.0),
+    "shuffle": (1.0, 1.0/2),
+    "orbits": (1.0/2, 1.0),
+    "waves": (1.0, 1.0/4),
+    "stretch": (1.0/4, 1.0),
+    "flow": (1.0, 1.0),
+    "falling": (1.0, 1.0/4),
+    "splice": (1.0, 1.0/4)
+}
+
+# waves always plays 8,192 of the clips, so it needs more than that
+MIN_CLIPS = {
+    "waves": 8193
+}
+
+# how each result is compared to the baseline: True if higher is better
+METRICS = [
+    ("cacheSeconds", False),
+    ("sizeSeconds", False),
+    ("sequenceFps", True),
+    ("singleFrameSeconds", False),
+    ("peakRssMB", False)
+]
+
+def getSpanSeconds(events, name):
+    return sum([e["dur"] for e in events if e.get("ph")=="X" and e.get("name")==name]) / 1000000.0
+
+# generate colorful moving test patterns with a tone, different for every video
+def makeVideos():
+    filenames = []
+    for i in range(a.VIDEO_COUNT):
+        fn = "synthetic_%s.mp4" % zeroPad(i+1, a.VIDEO_COUNT)
+        filenames.append(fn)
+        path = MEDIA_DIR + fn
+        if os.path.isfile(path):
+            continue
+        command = ['ffmpeg','-y',
+                    '-f','lavfi','-i','testsrc2=size=%s:rate=%s:duration=%s' % (a.VIDEO_SIZE, a.FPS, a.VIDEO_DURATION),
+                    '-f','lavfi','-i','sine=frequency=%s:duration=%s' % (220 * (i+1), a.VIDEO_DURATION),
+                    '-vf','hue=h=%s' % roundInt(360.0 * i / a.VIDEO_COUNT),
+                    '-c:v','libx264','-preset','ultrafast','-pix_fmt','yuv420p',
+                    '-c:a','aac','-shortest',
+                    path]
+        printCommand(command)
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return filenames
+
+# one sample per grid cell, with the columns the compositions expect from samples_to_grid.py and friends
+def makeSamples(filenames, count):
+    fn = os.path.join(WORK_DIR, "samples_%s.csv" % count)
+    if os.path.isfile(fn):
+        return fn
+    rand = random.Random(a.RANDOM_SEED + count)
+    cols = roundInt(math.sqrt(count))
+    samples = []
+    for i in range(count):
+        dur = rand.randint(400, 1200)
+        samples.append({
+            "filename": filenames[i % len(filenames)],
+            "start": rand.randint(0, a.VIDEO_DURATION * 1000 - dur - 100),
+            "dur": dur,
+            "gridX": i % cols,
+            "gridY": int(i / cols),
+            "tsne": rand.random(),
+            "tsne2": rand.random(),
+            "stsne": rand.random(),
+            "power": rand.random(),
+            "hz": rand.uniform(60, 2000),
+            "clarity": rand.random()
+        })
+    writeCsv(fn, samples)
+    return fn
+
+# run a composition and return its log, its trace events, and its peak memory use in MB (None if it can't be measured)
+def render(name, label, args):
+    logFn = os.path.join(WORK_DIR, "%s.log" % label)
+    traceFn = os.path.join(WORK_DIR, "%s.trace.jsonl" % label)
+    if os.path.isfile(traceFn):
+        os.remove(traceFn)
+    command = [sys.executable, "compositions/%s.py" % name] + args + ["-trace", traceFn] + a.EXTRA_ARGS.split()
+    printCommand(command)
+    peakRss = None
+    with open(logFn, "w") as f:
+        proc = subprocess.Popen(command, cwd=parentdir, stdout=f, stderr=subprocess.STDOUT)
+        # wait4 gives this render's own resource usage (along with the processes it waited for); it's only on Unix, so memory isn't measured elsewhere
+        if hasattr(os, "wait4"):
+            _pid, status, usage = os.wait4(proc.pid, 0)
+            # the process is already reaped, so tell Popen how it exited
+            proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            # kilobytes on Linux, bytes on macOS
+            peakRss = usage.ru_maxrss / 1024.0 if sys.platform != "darwin" else usage.ru_maxrss / 1024.0 / 1024.0
+        else:
+            proc.wait()
+    if proc.returncode != 0:
+        print("Render failed; see %s" % logFn)
+        return (readTextFile(logFn), [], None, False)
+    events = readLDJSON(traceFn) if os.path.isfile(traceFn) else []
+    return (readTextFile(logFn), events, peakRss, True)
+
+def benchmark(name, count, samplesFn):
+    g = roundInt(math.sqrt(count))
+    ratio0, ratio1 = GRID_RATIOS[name]
+    g0 = max(2, roundInt(g * ratio0))
+    g1 = max(2, roundInt(g * ratio1))
+    label = "%s_%s" % (name, count)
+    runDir = os.path.join(WORK_DIR, label)
+    cacheDir = os.path.join(runDir, "cache/")
+    outputFrame = os.path.join(runDir, "frames/frame.%s.png")
+    removeDir(runDir)
+    makeDirectories([cacheDir, outputFrame])
+    args = ["-in", samplesFn, "-dir", MEDIA_DIR,
+            "-grid", "%sx%s" % (g, g), "-grid0", "%sx%s" % (g0, g0), "-grid1", "%sx%s" % (g1, g1),
+            "-width", str(a.WIDTH), "-height", str(a.HEIGHT), "-fps", str(a.FPS),
+            "-backend", a.BACKEND, "-vo", "-cache", "-cd", cacheDir, "-ckey", label,
+            "-outframe", outputFrame, "-out", os.path.join(runDir, "out.mp4")]
+
+    log, events, peakRss, success = render(name, label + "_probe", args + ["-probe"])
+    match = re.search(r"Total frames: (\d+)", log)
+    if match is None:
+        print("Could not probe %s" % label)
+        return None
+    totalFrames = int(match.group(1))
+
+    # a short sequence from the middle, where the most clips are usually on screen; starting after the first frame means the video isn't encoded
+    frameCount = min(a.SEQUENCE_FRAMES, max(1, totalFrames - 1))
+    frameStart = max(2, int(totalFrames / 2) - int(frameCount / 2))
+    frameEnd = min(totalFrames, frameStart + frameCount - 1)
+    frameCount = frameEnd - frameStart + 1
+    log, events, peakRss, success = render(name, label + "_sequence", args + ["-frange", "%s,%s" % (frameStart, frameEnd)])
+    if not success:
+        return None
+    sizeSeconds = getSpanSeconds(events, "clip sizes")
+    renderSeconds = getSpanSeconds(events, "render frames")
+    result = {
+        "clips": count,
+        "totalFrames": totalFrames,
+        "sequenceFrames": frameCount,
+        "cacheSeconds": getSpanSeconds(events, "load pixel data") - sizeSeconds,
+        "sizeSeconds": sizeSeconds,
+        "sequenceFps": frameCount / renderSeconds if renderSeconds > 0 else 0.0
+    }
+    if peakRss is not None:
+        result["peakRssMB"] = peakRss
+
+    log, events, _peakRss, success = render(name, label + "_single", args + ["-frame", str(frameStart), "-overwrite"])
+    if not success:
+        return None
+    result["singleFrameSeconds"] = getSpanSeconds(events, "render frames")
+    return result
+
+def compare(results, baseline):
+    regressions = []
+    print("")
+    print("%-24s %-20s %12s %12s %8s" % ("Case", "Metric", "Baseline", "Now", "Change"))
+    for key in sorted(results):
+        if key not in baseline:
+            print("%-24s (not in baseline)" % key)
+            continue
+        for metric, higherIsBetter in METRICS:
+            if metric not in results[key]:
+                continue
+            before = baseline[key].get(metric, 0)
+            now = results[key].get(metric, 0)
+            if before <= 0:
+                continue
+            change = 1.0 * (now - before) / before
+            worse = -change if higherIsBetter else change
+            flag = ""
+            if worse > a.TOLERANCE:
+                flag = " <- regression"
+                regressions.append((key, metric))
+            print("%-24s %-20s %12s %12s %+7.1f%%%s" % (key, metric, round(before, 3), round(now, 3), change * 100.0, flag))
+    print("")
+    return regressions
+
+startTime = logTime()
+filenames = makeVideos()
+results = {}
+for count in SCALES:
+    samplesFn = makeSamples(filenames, count)
+    for name in COMPOSITIONS:
+        if name not in GRID_RATIOS:
+            print("Unknown composition %s; skipping" % name)
+            continue
+        key = "%s/%s" % (name, count)
+        if count < MIN_CLIPS.get(name, 0):
+            print("%s needs at least %s clips; skipping %s" % (name, formatNumber(MIN_CLIPS[name]), key))
+            continue
+        print("Benchmarking %s..." % key)
+        result = benchmark(name, count, samplesFn)
+        if result is None:
+            continue
+        results[key] = result
+        pprint(result)
+
+if a.COMPARE:
+    baseline = readJSON(a.BASELINE_FILE)
+    if "results" not in baseline:
+        print("No baseline in %s; run without -compare first" % a.BASELINE_FILE)
+        sys.exit(1)
+    regressions = compare(results, baseline["results"])
+    if len(regressions) > 0:
+        print("%s regressions of more than %s%%" % (len(regressions), roundInt(a.TOLERANCE * 100)))
+        logTime(startTime, "Total execution time")
+        sys.exit(1)
+    print("No regressions")
+else:
+    writeJSON(a.BASELINE_FILE, {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "settings": {key: value for key, value in vars(a).items() if key not in ("COMPARE", "BASELINE_FILE", "TOLERANCE")},
+        "results": results
+    }, pretty=True)
+
+logTime(startTime, "Total execution time")